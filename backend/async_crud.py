@@ -0,0 +1,202 @@
+from datetime import datetime
+
+from sqlalchemy import and_, delete, func, insert, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+import crud
+import models
+import schemas
+import search
+
+# AsyncSession versions of the crud functions the endpoints use, with the
+# same names and arguments. Query conditions are shared with crud.
+
+
+def __caffs_select(tags: list[str] | None = None, match_all: bool = True, prefix: bool = False):
+    return select(models.Caff).where(*crud.tag_conditions(tags, match_all, prefix))
+
+
+async def get_caff_by_id(id: int, db: AsyncSession):
+    return await db.scalar(select(models.Caff).where(models.Caff.id == id))
+
+
+async def get_caff_by_content_hash(content_hash: str, db: AsyncSession):
+    return await db.scalar(select(models.Caff).where(models.Caff.content_hash == content_hash)
+                           .order_by(models.Caff.id).limit(1))
+
+
+async def get_caff_ids_by_content_hashes(content_hashes: list[str], db: AsyncSession) -> dict[str, int]:
+    if not content_hashes:
+        return {}
+    result = await db.execute(select(models.Caff.content_hash, func.min(models.Caff.id))
+                              .where(models.Caff.content_hash.in_(content_hashes)).group_by(models.Caff.content_hash))
+    return dict(result.all())
+
+
+async def is_rawfile_referenced(rawfile: str, db: AsyncSession):
+    return await db.scalar(select(models.Caff.id).where(models.Caff.rawfile == rawfile).limit(1)) is not None
+
+
+async def get_caff_by_id_with_comments(id: int, db: AsyncSession):
+    return await db.scalar(select(models.Caff).options(selectinload(models.Caff.comments))
+                           .where(models.Caff.id == id))
+
+
+async def get_caffs_page(db: AsyncSession, limit: int, after_id: int | None = None, tags: list[str] | None = None,
+                         match_all: bool = True, prefix: bool = False, with_comments: bool = False):
+    stmt = __caffs_select(tags, match_all, prefix)
+    if with_comments:
+        stmt = stmt.options(selectinload(models.Caff.comments))
+    if after_id is not None:
+        stmt = stmt.where(models.Caff.id > after_id)
+    return (await db.scalars(stmt.order_by(models.Caff.id).limit(limit))).all()
+
+
+async def stream_caffs(db: AsyncSession, batch_size: int, tags: list[str] | None = None,
+                       match_all: bool = True, prefix: bool = False):
+    stmt = __caffs_select(tags, match_all, prefix).order_by(models.Caff.id) \
+        .execution_options(yield_per=batch_size)
+    return await db.stream_scalars(stmt)
+
+
+async def iter_caffs_with_comments(db: AsyncSession, batch_size: int):
+    async def rows():
+        after_id = None
+        while True:
+            caffs = await get_caffs_page(db, batch_size, after_id=after_id, with_comments=True)
+            for caff in caffs:
+                yield caff
+            if len(caffs) < batch_size:
+                return
+            after_id = caffs[-1].id
+    return rows()
+
+
+async def search_caffs(db: AsyncSession, terms: list[str], match_all: bool, limit: int, offset: int = 0):
+    if not terms:
+        return []
+    frequencies = dict((await db.execute(crud.document_frequencies(terms))).all())
+    idf = crud.search_idf(terms, frequencies, await db.scalar(select(func.count(models.Caff.id))), match_all)
+    if idf is None:
+        return []
+    ranked = (await db.execute(crud.ranked_caff_ids(idf, match_all, limit, offset))).all()
+    caffs = {caff.id: caff for caff in (await db.scalars(
+        select(models.Caff).where(models.Caff.id.in_([id for id, _ in ranked])))).all()}
+    return [(caffs[id], score) for id, score in ranked if id in caffs]
+
+
+async def create_comment(db: AsyncSession, comment: schemas.CommentBase, collection_id: int):
+    db_comment = models.Comment(text=comment.text, author_id=comment.author_id, date=comment.date,
+                                collection_id=collection_id)
+    db.add(db_comment)
+    await db.flush()
+    await index_comment(db_comment.id, collection_id, comment.text, db)
+    await db.commit()
+    await db.refresh(db_comment)
+    return db_comment
+
+
+async def index_comment(comment_id: int, collection_id: int, text: str | None, db: AsyncSession):
+    await db.execute(crud.unindex_comment(comment_id))
+    terms = search.term_rows(collection_id, search.COMMENT, comment_id, text)
+    if terms:
+        await db.execute(insert(models.SearchTerm), terms)
+
+
+async def get_comment_by_id(comment_id: int, db: AsyncSession):
+    return await db.scalar(select(models.Comment).where(models.Comment.id == comment_id))
+
+
+async def update_comment_by_id(comment_id: int, comment: schemas.CommentBase, db: AsyncSession):
+    # comment may be the loaded row, read it before the update expires it
+    text = comment.text
+    await db.execute(update(models.Comment).where(models.Comment.id == comment_id)
+                     .values(text=text, date=comment.date))
+    collection_id = await db.scalar(select(models.Comment.collection_id).where(models.Comment.id == comment_id))
+    if collection_id is not None:
+        await index_comment(comment_id, collection_id, text, db)
+    await db.commit()
+    return 1
+
+
+async def delete_comment_by_id(comment_id: int, db: AsyncSession):
+    comment = await get_comment_by_id(comment_id=comment_id, db=db)
+    await db.delete(comment)
+    await db.execute(crud.unindex_comment(comment_id))
+    await db.commit()
+
+
+async def delete_caff_by_id(caff_id: int, db: AsyncSession):
+    try:
+        ciff_ids = select(models.Ciff.id).where(models.Ciff.collection_id == caff_id)
+        await db.execute(models.ciff_tags.delete().where(models.ciff_tags.c.ciff_id.in_(ciff_ids.scalar_subquery())))
+        await db.execute(delete(models.Ciff).where(models.Ciff.collection_id == caff_id))
+        await db.execute(delete(models.Comment).where(models.Comment.collection_id == caff_id))
+        await db.execute(delete(models.SearchTerm).where(models.SearchTerm.caff_id == caff_id))
+        deleted = (await db.execute(delete(models.Caff).where(models.Caff.id == caff_id))).rowcount
+        await db.commit()
+        return deleted == 1
+    except Exception as _:
+        await db.rollback()
+        return False
+
+
+def __logs_select(filters: schemas.LogFilter | None = None):
+    stmt = crud.filter_logs(select(models.Log), filters)
+    return stmt.order_by(models.Log.date.desc(), models.Log.id.desc())
+
+
+async def get_logs_page(db: AsyncSession, limit: int, before: tuple[datetime, int] | None = None,
+                        filters: schemas.LogFilter | None = None):
+    stmt = __logs_select(filters)
+    if before is not None:
+        date, id = before
+        stmt = stmt.where(or_(models.Log.date < date,
+                              and_(models.Log.date == date, models.Log.id < id)))
+    return (await db.scalars(stmt.limit(limit))).all()
+
+
+async def stream_logs(db: AsyncSession, batch_size: int, filters: schemas.LogFilter | None = None):
+    return await db.stream_scalars(__logs_select(filters).execution_options(yield_per=batch_size))
+
+
+async def count_logs_by_level_and_hour(db: AsyncSession, filters: schemas.LogFilter | None = None):
+    hour = crud.hour_bucket(db.bind.dialect.name).label("hour")
+    stmt = select(hour, models.Log.level, func.count(models.Log.id).label("count"))
+    stmt = crud.filter_logs(stmt, filters)
+    return (await db.execute(stmt.group_by(hour, models.Log.level).order_by(hour, models.Log.level))).all()
+
+
+async def get_user_by_userid(user_id: str, db: AsyncSession):
+    return await db.scalar(select(models.User).where(models.User.user_id == user_id))
+
+
+async def get_users_by_userids(user_ids: list[str], db: AsyncSession):
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    users = (await db.scalars(select(models.User).where(models.User.user_id.in_(user_ids)))).all()
+    return {user.user_id: user for user in users}
+
+
+async def create_user(user: schemas.User, db: AsyncSession):
+    model_user = models.User(user_id=user.user_id, username=user.username)
+    db.add(model_user)
+    await db.commit()
+    await db.refresh(model_user)
+    return model_user
+
+
+class BlockingCrud:
+    # The same awaitable interface over the blocking crud module, used when
+    # the async engine is not configured
+    def __getattr__(self, name: str):
+        fn = getattr(crud, name)
+
+        async def call(*args, **kwargs):
+            return fn(*args, **kwargs)
+        return call
+
+
+blocking = BlockingCrud()
@@ -0,0 +1,124 @@
+from datetime import datetime
+import gzip
+from itertools import groupby
+from json import dumps
+from os import makedirs, path
+from queue import Empty, Full, Queue
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Callable
+
+from sqlalchemy.orm import Session
+
+import crud
+
+
+class AuditLogWriter:
+    # Audit records are queued in memory and inserted in batches by a
+    # background thread, so logging never costs the request a transaction.
+    def __init__(self, session_factory: Callable[[], Session], max_queue: int = 10000,
+                 batch_size: int = 500, flush_interval: float = 1.0):
+        self.session_factory = session_factory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.__queue: Queue = Queue(maxsize=max_queue)
+        self.__stopping = Event()
+        self.__thread: Thread | None = None
+        self.__lock = Lock()
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return self.__queue.qsize()
+
+    def submit(self, level: str, user_id: str, text: str, date: datetime | None = None) -> bool:
+        self.start()
+        record = {"level": level, "text": text, "author_id": user_id,
+                  "date": date or datetime.now()}
+        try:
+            self.__queue.put_nowait(record)
+            return True
+        except Full:
+            with self.__lock:
+                self.dropped += 1
+            return False
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        with self.__lock:
+            if self.__thread is None:
+                self.__stopping.clear()
+                self.__thread = Thread(target=self.__run, name="audit-log-writer", daemon=True)
+                self.__thread.start()
+
+    def stop(self, timeout: float | None = 10):
+        # Flushes everything still queued before returning
+        thread = self.__thread
+        if thread is None:
+            return
+        self.__stopping.set()
+        thread.join(timeout)
+        self.__thread = None
+
+    def __next_batch(self) -> list[dict]:
+        batch = []
+        deadline = monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - monotonic()
+            if timeout <= 0 or (self.__stopping.is_set() and self.__queue.empty()):
+                break
+            try:
+                batch.append(self.__queue.get(timeout=min(timeout, 0.1)))
+            except Empty:
+                continue
+        return batch
+
+    def __write(self, batch: list[dict]):
+        db = self.session_factory()
+        try:
+            crud.create_logs(batch, db)
+            self.written += len(batch)
+        except Exception as e:
+            db.rollback()
+            self.failed += len(batch)
+            print("Could not write audit logs:", e)
+        finally:
+            db.close()
+
+    def __run(self):
+        while not (self.__stopping.is_set() and self.__queue.empty()):
+            batch = self.__next_batch()
+            if batch:
+                self.__write(batch)
+
+
+def archive_logs(logs: list, archive_dir: str):
+    # One gzip member per batch and day, appended to logs-YYYY-MM-DD.jsonl.gz
+    makedirs(archive_dir, exist_ok=True)
+    for day, rows in groupby(logs, key=lambda log: log.date.date()):
+        with gzip.open(path.join(archive_dir, f"logs-{day.isoformat()}.jsonl.gz"), "at") as f:
+            for log in rows:
+                f.write(dumps({"id": log.id, "level": log.level, "text": log.text,
+                               "date": log.date.isoformat(), "author_id": log.author_id}) + "\n")
+
+
+def prune_logs(session_factory: Callable[[], Session], cutoff: datetime, batch_size: int = 5000,
+               archive_dir: str | None = None) -> int:
+    # Deletes (and optionally archives) logs older than cutoff, oldest day
+    # first and one batch per transaction, so the table is never locked for long
+    pruned = 0
+    while True:
+        db = session_factory()
+        try:
+            logs = crud.get_logs_before(cutoff, batch_size, db)
+            if not logs:
+                return pruned
+            if archive_dir is not None:
+                archive_logs(logs, archive_dir)
+            crud.delete_logs_by_ids([log.id for log in logs], db)
+            pruned += len(logs)
+        finally:
+            db.close()
@@ -1,15 +1,19 @@
+from collections import OrderedDict
 from enum import Enum
-import sys
-import requests
+from hashlib import sha256
+from threading import Lock
+from time import time
 from typing import Optional
 
 from fastapi import HTTPException, status
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 from jose import JWTError, jwt
 from jose.constants import ALGORITHMS
 
+from jwks import JWKS, jwks_url_for_realm
+
 
 class RealmAccess(BaseModel):
     roles: list[str]
@@ -56,29 +60,51 @@ class User(BaseModel):
     role: Role
 
 
+class TokenCache:
+    # LRU of already verified tokens, an entry never outlives the token's exp
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__entries: OrderedDict[str, tuple[float, User]] = OrderedDict()
+        self.__lock = Lock()
+
+    @staticmethod
+    def __key(token: str) -> str:
+        return sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> User | None:
+        key = self.__key(token)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            expires, user = entry
+            if expires <= time():
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return user
+
+    def put(self, token: str, user: User, exp: int):
+        if self.maxsize <= 0:
+            return
+        key = self.__key(token)
+        expires = min(exp, time() + self.ttl)
+        with self.__lock:
+            self.__entries[key] = (expires, user)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+
 class Auth:
-    def __init__(self, keycloak_realm_url: str):
-        # Why doing this?
-        # Because we want to fetch public key on start
-        # Later we would verify incoming JWT tokens
-        try:
-            r = requests.get(keycloak_realm_url, timeout=3)
-            r.raise_for_status()
-            response_json = r.json()
-        except requests.exceptions.HTTPError as errh:
-            print("Http Error:", errh)
-            sys.exit(1)
-        except requests.exceptions.ConnectionError as errc:
-            print("Error Connecting:", errc)
-            sys.exit(1)
-        except requests.exceptions.Timeout as errt:
-            print("Timeout Error:", errt)
-            sys.exit(1)
-        except requests.exceptions.RequestException as err:
-            print("OOps: Something Else", err)
-            sys.exit(1)
-
-        self.__SECRET_KEY = f'-----BEGIN PUBLIC KEY-----\r\n{response_json["public_key"]}\r\n-----END PUBLIC KEY-----'
+    def __init__(self, keycloak_realm_url: str, token_cache_size: int = 1024, token_cache_ttl: int = 300,
+                 jwks_url: str | None = None, jwks_refresh_interval: int = 300):
+        self.__token_cache = TokenCache(token_cache_size, token_cache_ttl)
+        # Keys are fetched on startup and refreshed in the background,
+        # so importing the app never waits on Keycloak
+        self.keys = JWKS(jwks_url or jwks_url_for_realm(keycloak_realm_url),
+                         refresh_interval=jwks_refresh_interval)
 
     async def __parse_jwt(self, token: str):
         credentials_exception = HTTPException(
@@ -87,65 +113,30 @@ class Auth:
             headers={"WWW-Authenticate": "Bearer"},
         )
         try:
-            payload = jwt.decode(token, self.__SECRET_KEY, algorithms=[ALGORITHMS.RS256],
+            kid = jwt.get_unverified_header(token).get("kid")
+            key = await self.keys.get_key(kid)
+            if key is None:
+                raise JWTError("Unknown signing key: "+str(kid))
+            payload = jwt.decode(token, key, algorithms=[ALGORITHMS.RS256],
                                  options={"verify_signature": True, "verify_aud": False, "exp": True})
-            username: str = payload.get("username")
-            exp: int = payload.get("exp")
-            iat: int = payload.get("iat")
-            auth_time: int = payload.get("auth_time")
-            jti: str = payload.get("jti")
-            iss: str = payload.get("iss")
-            aud: str = payload.get("aud")
-            sub: str = payload.get("sub")
-            typ: str = payload.get("typ")
-            azp: str = payload.get("azp")
-            session_state: str = payload.get("session_state")
-            acr: str = payload.get("acr")
-            realm_access: dict = payload.get("realm_access")
-            scope: str = payload.get("scope")
-            sid: str = payload.get("sid")
-            email: str = payload.get("email")
-            email_verified: bool = payload.get("email_verified")
-            name: str = payload.get("name")
-            preferred_username: str = payload.get("preferred_username")
-            given_name: str = payload.get("given_name")
-            family_name: str = payload.get("family_name")
-            realm_access: RealmAccess = payload.get("realm_access")
-            resource_access: ResourceAccess = payload.get("resource_access")
-            token_data = JWT(username=username,
-                             exp=exp,
-                             iat=iat,
-                             auth_time=auth_time,
-                             jti=jti,
-                             iss=iss,
-                             aud=aud,
-                             sub=sub,
-                             typ=typ,
-                             azp=azp,
-                             session_state=session_state,
-                             acr=acr,
-                             realm_access=realm_access,
-                             scope=scope,
-                             sid=sid,
-                             email=email,
-                             email_verified=email_verified,
-                             name=name,
-                             preferred_username=preferred_username,
-                             given_name=given_name,
-                             family_name=family_name,
-                             resource_access=resource_access)
-        except JWTError as e:
+            token_data = JWT(**payload)
+        except (JWTError, ValidationError) as e:
             print(e)
             raise credentials_exception
         return token_data
 
     async def get_user(self, token) -> User | None:
+        user = self.__token_cache.get(token)
+        if user is not None:
+            return user
         try:
             jwt = await self.__parse_jwt(token)
             role = Role.USER
             if "caff-admin" in jwt.realm_access.roles:
                 role = Role.ADMIN
-            return User(id=jwt.sub, name=jwt.name, role=role)
+            user = User(id=jwt.sub, name=jwt.name, role=role)
+            self.__token_cache.put(token, user, jwt.exp)
+            return user
         except Exception as e:
             print(e)
             return None
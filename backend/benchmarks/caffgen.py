@@ -0,0 +1,50 @@
+"""Synthetic CAFF files laid out like caff-parser/res/1.caff.
+
+    header (id 1):    "CAFF", header_size = 20, num_anim
+    credits (id 2):   year, month, day, hour, minute, creator_len, creator
+    animation (id 3): duration, then a CIFF with caption "\\n", tags "\\0" and RGB pixels
+"""
+from random import Random
+from struct import Struct
+
+import numpy as np
+
+_BLOCK = Struct("<BQ")
+_HEADER = Struct("<4sQQ")
+_CREDITS = Struct("<HBBBBQ")
+_CIFF_HEADER = Struct("<4sQQQQ")
+_U64 = Struct("<Q")
+
+TAGS = ["landscape", "sunset", "mountains", "city", "night", "portrait", "animal", "sea",
+        "forest", "snow", "abstract", "macro", "street", "sky", "river", "desert"]
+
+
+def block(block_id: int, payload: bytes) -> bytes:
+    return _BLOCK.pack(block_id, len(payload)) + payload
+
+
+def pixels(width: int, height: int, seed: int) -> bytes:
+    # A gradient with a seeded offset: cheap to make, and frames differ so the
+    # previews do real work
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.stack([(x + seed * 7) % 256, (y + seed * 13) % 256, ((x + y) // 2 + seed * 29) % 256], axis=-1)
+    return rgb.astype(np.uint8).tobytes()
+
+
+def ciff(width: int, height: int, caption: str, tags: list[str], seed: int) -> bytes:
+    meta = caption.encode() + b"\n" + b"".join(tag.encode() + b"\0" for tag in tags)
+    content = pixels(width, height, seed)
+    return _CIFF_HEADER.pack(b"CIFF", _CIFF_HEADER.size + len(meta), len(content), width, height) + meta + content
+
+
+def caff(frames: int = 2, width: int = 320, height: int = 240, seed: int = 0,
+         creator: str = "Test Creator", duration: int = 1000) -> tuple[bytes, list[str]]:
+    # Returns the file and the tags used in it
+    rng = Random(seed)
+    tags = rng.sample(TAGS, 3)
+    out = [block(1, _HEADER.pack(b"CAFF", _HEADER.size, frames)),
+           block(2, _CREDITS.pack(2020, 7, 2, 14, 50, len(creator.encode())) + creator.encode())]
+    for frame in range(frames):
+        caption = f"Synthetic scenery {seed}/{frame}"
+        out.append(block(3, _U64.pack(duration) + ciff(width, height, caption, tags, seed * 1000 + frame)))
+    return b"".join(out), tags
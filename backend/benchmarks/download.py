@@ -0,0 +1,111 @@
+"""Download throughput of the CAFF file serving path.
+
+Serves a generated file through downloads.file_response under uvicorn and
+measures full downloads, ranged resumes and 304 revalidations.
+
+    python benchmarks/download.py --size-mb 512 --runs 3
+"""
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+from json import dumps
+
+import requests
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.routing import Route
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import downloads  # noqa: E402
+
+
+def make_file(path: str, size_mb: int):
+    block = os.urandom(1024 * 1024)
+    with open(path, "wb") as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def serve(path: str, port: int) -> uvicorn.Server:
+    async def download(request: Request):
+        return downloads.file_response(request, path, filename="bench.caff")
+
+    app = Starlette(routes=[Route("/download", download)])
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def fetch(url: str, headers: dict | None = None) -> tuple[int, int, float]:
+    start = time.perf_counter()
+    received = 0
+    with requests.get(url, headers=headers, stream=True) as r:
+        for chunk in r.iter_content(chunk_size=1024 * 1024):
+            received += len(chunk)
+        status = r.status_code
+    return status, received, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=512)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.caff")
+        make_file(path, args.size_mb)
+        port = free_port()
+        server = serve(path, port)
+        url = f"http://127.0.0.1:{port}/download"
+        size = os.path.getsize(path)
+        results = {"size_bytes": size, "full": [], "resume_half": [], "revalidate": []}
+        try:
+            etag = requests.head(url).headers["etag"]
+            for _ in range(args.runs):
+                status, received, elapsed = fetch(url)
+                assert status == 200 and received == size
+                results["full"].append(received / elapsed / 1e6)
+
+                status, received, elapsed = fetch(url, {"Range": "bytes=%d-" % (size // 2), "If-Range": etag})
+                assert status == 206 and received == size - size // 2
+                results["resume_half"].append(received / elapsed / 1e6)
+
+                status, _, elapsed = fetch(url, {"If-None-Match": etag})
+                assert status == 304
+                results["revalidate"].append(elapsed * 1000)
+        finally:
+            server.should_exit = True
+
+    summary = {
+        "size_bytes": results["size_bytes"],
+        "full_mb_per_s": max(results["full"]),
+        "resume_half_mb_per_s": max(results["resume_half"]),
+        "revalidate_ms": min(results["revalidate"]),
+        "runs": results,
+    }
+    print(f"{args.size_mb} MiB file, best of {args.runs}: "
+          f"full {summary['full_mb_per_s']:.0f} MB/s, "
+          f"resume {summary['resume_half_mb_per_s']:.0f} MB/s, "
+          f"304 in {summary['revalidate_ms']:.2f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""End-to-end load benchmark of the API.
+
+Boots the app under uvicorn in a subprocess. It runs against a fresh SQLite
+database and a local HTTP server that stands in for Keycloak, serving the
+JWKS of a locally generated RSA key. The database is seeded with synthetic
+CAFFs and comments. Then mixed traffic is driven for a fixed time and
+throughput and latency percentiles are reported per route.
+
+    python benchmarks/load.py --duration 30 --concurrency 16 --output results/load.json
+
+Every run writes a JSON report. Reports of different runs can be diffed or
+plotted against each other.
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+
+import requests
+import rsa
+from jose import jwk, jwt
+
+import caffgen
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+REALM = "bench"
+KID = "bench-key"
+SEED_BATCH = 32
+
+# Relative weight of each route in the traffic mix
+DEFAULT_MIX = {
+    "upload": 1,
+    "list": 10,
+    "tag_search": 6,
+    "detail": 8,
+    "download": 3,
+}
+
+
+class KeycloakStandIn:
+    # Serves the realm JWKS for the tokens this benchmark signs
+    def __init__(self):
+        public, private = rsa.newkeys(2048)
+        self.private_pem = private.save_pkcs1().decode()
+        key = jwk.construct(public.save_pkcs1().decode(), "RS256").to_dict()
+        key.update(kid=KID, use="sig", alg="RS256")
+        body = json.dumps({"keys": [key]}).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200 if self.path.endswith("/certs") else 404)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.realm_url = f"http://127.0.0.1:{self.server.server_port}/realms/{REALM}"
+
+    def token(self, user_id: str, name: str, admin: bool = False) -> str:
+        now = int(time.time())
+        claims = {
+            "exp": now + 24 * 3600, "iat": now, "auth_time": now, "jti": user_id + str(now),
+            "iss": self.realm_url, "aud": "account", "sub": user_id, "typ": "Bearer", "azp": "caff",
+            "session_state": "bench", "acr": "1", "scope": "openid", "sid": "bench",
+            "email": user_id + "@bench.local", "email_verified": True, "name": name,
+            "preferred_username": user_id, "given_name": name, "family_name": "Bench",
+            "realm_access": {"roles": ["caff-admin"] if admin else []},
+            "resource_access": {"account": {"roles": []}},
+        }
+        return jwt.encode(claims, self.private_pem, algorithm="RS256", headers={"kid": KID})
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(workdir: str, realm_url: str, port: int, env_overrides: dict) -> subprocess.Popen:
+    data = os.path.join(workdir, "data")
+    for sub in ("out", "preview"):
+        os.makedirs(os.path.join(data, sub), exist_ok=True)
+    env = dict(os.environ)
+    env.update({
+        "KEYCLOAK_REALM_URL": realm_url,
+        "UI_URL": "http://localhost",
+        "DATABASE_URL": f"sqlite:///{workdir}/bench.db?check_same_thread=false",
+        "UPLOAD_PATH": os.path.join(data, "out") + "/",
+        "PREVIEW_PATH": os.path.join(data, "preview") + "/",
+    })
+    env.update(env_overrides)
+    process = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1",
+                                "--port", str(port), "--log-level", "warning"],
+                               cwd=BACKEND_DIR, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("The app exited during startup")
+        try:
+            requests.get(f"http://127.0.0.1:{port}/docs", timeout=1)
+            return process
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("The app did not start in time")
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+        self.errors: dict[str, int] = {}
+        self.statuses: dict[str, dict[int, int]] = {}
+        self.__lock = threading.Lock()
+
+    def record(self, route: str, seconds: float, status: int | None):
+        with self.__lock:
+            self.samples.setdefault(route, []).append(seconds)
+            statuses = self.statuses.setdefault(route, {})
+            statuses[status or 0] = statuses.get(status or 0, 0) + 1
+            if status is None or status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    # Nearest rank
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-p * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize(values: list[float], errors: int, elapsed: float) -> dict:
+    ordered = sorted(values)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput_rps": len(ordered) / elapsed if elapsed else 0.0,
+        "mean_ms": sum(ordered) / len(ordered) * 1000 if ordered else 0.0,
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+        "max_ms": ordered[-1] * 1000 if ordered else 0.0,
+    }
+
+
+class Traffic:
+    def __init__(self, base_url: str, tokens: list[str], args):
+        self.base_url = base_url
+        self.tokens = tokens
+        self.args = args
+        self.caff_ids: list[int] = []
+        self.tags: set[str] = set()
+        self.__lock = threading.Lock()
+        self.__seed = 1_000_000
+
+    def next_seed(self) -> int:
+        with self.__lock:
+            self.__seed += 1
+            return self.__seed
+
+    def upload(self, session: requests.Session, seed: int) -> requests.Response:
+        data, tags = caffgen.caff(frames=self.args.frames, width=self.args.width, height=self.args.height, seed=seed)
+        with self.__lock:
+            self.tags.update(tags)
+        return session.post(self.base_url + "/upload_file", files={"file": (f"bench-{seed}.caff", data)})
+
+    def wait_for_job(self, session: requests.Session, job_id: str, timeout: float = 120) -> int | None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            job = session.get(self.base_url + "/jobs/" + job_id).json()
+            if job["status"] == "done":
+                return job["caff_id"]
+            if job["status"] == "failed":
+                raise RuntimeError("Seed upload failed: " + str(job["error"]))
+            time.sleep(0.05)
+        raise RuntimeError("Seed upload timed out")
+
+    def seed(self, count: int, comments: int):
+        session = requests.Session()
+        session.headers["Authorization"] = "Bearer " + self.tokens[0]
+        # In batches, so the upload queue never rejects a seed
+        for first in range(0, count, SEED_BATCH):
+            jobs = []
+            for seed in range(first, min(first + SEED_BATCH, count)):
+                r = self.upload(session, seed)
+                r.raise_for_status()
+                jobs.append(r.json()["job_id"])
+            self.caff_ids.extend(self.wait_for_job(session, job_id) for job_id in jobs)
+        for caff_id in self.caff_ids:
+            for i in range(comments):
+                session.post(f"{self.base_url}/api/{caff_id}/comments",
+                             json={"text": f"Comment {i} on {caff_id}", "date": datetime.now().isoformat(),
+                                   "author_id": 0}).raise_for_status()
+
+    def run_one(self, route: str, session: requests.Session, rng: Random) -> requests.Response:
+        if route == "upload":
+            return self.upload(session, self.next_seed())
+        if route == "list":
+            return session.get(self.base_url + "/api", params={"limit": 50})
+        if route == "tag_search":
+            tag = rng.choice(sorted(self.tags))
+            return session.get(self.base_url + "/api", params={"tag": tag, "limit": 50})
+        caff_id = rng.choice(self.caff_ids)
+        if route == "detail":
+            return session.get(f"{self.base_url}/api/{caff_id}")
+        if route == "download":
+            r = session.get(f"{self.base_url}/download_caff/{caff_id}", stream=True)
+            for _ in r.iter_content(chunk_size=256 * 1024):
+                pass
+            return r
+        raise ValueError("Unknown route " + route)
+
+    def worker(self, index: int, mix: dict[str, int], stop_at: float, recorder: Recorder):
+        rng = Random(index)
+        session = requests.Session()
+        session.headers["Authorization"] = "Bearer " + self.tokens[index % len(self.tokens)]
+        routes, weights = zip(*mix.items())
+        while time.monotonic() < stop_at:
+            route = rng.choices(routes, weights)[0]
+            start = time.perf_counter()
+            status = None
+            try:
+                status = self.run_one(route, session, rng).status_code
+            except requests.RequestException:
+                pass
+            recorder.record(route, time.perf_counter() - start, status)
+
+
+def parse_mix(value: str | None) -> dict[str, int]:
+    if not value:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for item in value.split(","):
+        route, _, weight = item.partition("=")
+        if route not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError("Unknown route in mix: " + route)
+        mix[route] = int(weight)
+    return {route: weight for route, weight in mix.items() if weight > 0}
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of measured traffic")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed-caffs", type=int, default=20)
+    parser.add_argument("--seed-comments", type=int, default=5, help="comments per seeded CAFF")
+    parser.add_argument("--frames", type=int, default=2)
+    parser.add_argument("--width", type=int, default=320)
+    parser.add_argument("--height", type=int, default=240)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--mix", help="route weights, e.g. upload=1,list=10,tag_search=6,detail=8,download=3")
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE",
+                        help="extra settings for the app, e.g. DATABASE_ASYNC=true")
+    parser.add_argument("--output", help="JSON report path (default: benchmarks/results/load-<time>.json)")
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    env_overrides = dict(item.split("=", 1) for item in args.env)
+
+    keycloak = KeycloakStandIn()
+    tokens = [keycloak.token(f"bench-user-{i}", f"Bench User {i}") for i in range(args.users)]
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="caff-bench-") as workdir:
+        app = start_app(workdir, keycloak.realm_url, port, env_overrides)
+        try:
+            traffic = Traffic(f"http://127.0.0.1:{port}", tokens, args)
+            print(f"Seeding {args.seed_caffs} CAFFs with {args.seed_comments} comments each...")
+            traffic.seed(args.seed_caffs, args.seed_comments)
+
+            print(f"Driving {args.concurrency} clients for {args.duration:.0f}s, mix {mix}")
+            recorder = Recorder()
+            started = time.monotonic()
+            stop_at = started + args.duration
+            threads = [threading.Thread(target=traffic.worker, args=(i, mix, stop_at, recorder))
+                       for i in range(args.concurrency)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - started
+        finally:
+            app.terminate()
+            app.wait(timeout=30)
+            keycloak.stop()
+
+    routes = {route: summarize(values, recorder.errors.get(route, 0), elapsed)
+              for route, values in sorted(recorder.samples.items())}
+    for route, statuses in recorder.statuses.items():
+        routes[route]["statuses"] = {str(status): count for status, count in sorted(statuses.items())}
+    report = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "config": {**vars(args), "mix": mix},
+        "elapsed_s": elapsed,
+        "total": summarize([v for values in recorder.samples.values() for v in values],
+                           sum(recorder.errors.values()), elapsed),
+        "routes": routes,
+    }
+
+    output = args.output or os.path.join(BACKEND_DIR, "benchmarks", "results",
+                                         "load-" + datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"{'route':<12} {'req':>7} {'err':>5} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, stats in [*routes.items(), ("total", report["total"])]:
+        print(f"{route:<12} {stats['requests']:>7} {stats['errors']:>5} {stats['throughput_rps']:>8.1f} "
+              f"{stats['p50_ms']:>8.1f} {stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+    print("Report written to", output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+from hashlib import sha256
+from json import dumps
+from threading import Lock
+from time import monotonic
+from typing import Awaitable, Callable
+
+from starlette.concurrency import run_in_threadpool
+
+# Read-through cache of rendered JSON responses.
+# Entries are never deleted on writes. Every key embeds the generation of the
+# tags it depends on (e.g. "caffs", "caff:12"), and a write bumps those
+# generations, so stale entries simply stop being addressed and age out.
+
+KEY_PREFIX = "caffcache:"
+
+
+def caff_tag(caff_id: int) -> str:
+    return "caff:"+str(caff_id)
+
+
+class MemoryBackend:
+    # In-process LRU, also the first tier in front of a shared backend
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+        self.__generations: dict[str, int] = {}
+        self.__lock = Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < monotonic():
+                del self.__entries[key]
+                return None
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes):
+        with self.__lock:
+            self.__entries[key] = (monotonic() + self.ttl, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def generations(self, tags: list[str]) -> list[int]:
+        with self.__lock:
+            return [self.__generations.get(tag, 0) for tag in tags]
+
+    def bump(self, tags: list[str]):
+        with self.__lock:
+            for tag in tags:
+                self.__generations[tag] = self.__generations.get(tag, 0) + 1
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+
+class RedisBackend:
+    # Shared between API instances, so a write on one instance invalidates
+    # the others. redis is only needed when response_cache_url is set.
+    def __init__(self, url: str, ttl: int, timeout: float):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("response_cache_url is set, but the redis package is not installed")
+        # A hung server fails the call instead of holding up the request
+        self.client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.ttl = ttl
+
+    def get(self, key: str) -> bytes | None:
+        return self.client.get(KEY_PREFIX + key)
+
+    def set(self, key: str, value: bytes):
+        self.client.set(KEY_PREFIX + key, value, ex=self.ttl)
+
+    def generations(self, tags: list[str]) -> list[int]:
+        values = self.client.mget([KEY_PREFIX + "gen:" + tag for tag in tags])
+        return [int(value) if value is not None else 0 for value in values]
+
+    def bump(self, tags: list[str]):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.incr(KEY_PREFIX + "gen:" + tag)
+        pipe.execute()
+
+
+class ResponseCache:
+    def __init__(self, local: MemoryBackend, shared: RedisBackend | None = None):
+        self.local = local
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def __generations(self, tags: list[str]) -> list[int] | None:
+        # The shared backend owns the generations when there is one
+        if self.shared is not None:
+            try:
+                return self.shared.generations(tags)
+            except Exception as e:
+                self.errors += 1
+                print("Could not read cache generations:", e)
+                return None
+        return self.local.generations(tags)
+
+    def __lookup(self, key: str) -> bytes | None:
+        value = self.local.get(key)
+        if value is None and self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                self.errors += 1
+                print("Could not read response cache:", e)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def __store(self, key: str, value: bytes):
+        self.local.set(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.set(key, value)
+            except Exception as e:
+                self.errors += 1
+                print("Could not write response cache:", e)
+
+    @staticmethod
+    def key(route: str, params: dict, tags: list[str], generations: list[int]) -> str:
+        raw = dumps([route, params, tags, generations], sort_keys=True, default=str)
+        return route + ":" + sha256(raw.encode()).hexdigest()
+
+    async def get_or_render(self, route: str, params: dict, tags: list[str],
+                            render: Callable[[], Awaitable[bytes]]) -> bytes:
+        generations = await self.__run(self.__generations, tags)
+        if generations is None:
+            # Shared backend is down: serve uncached rather than risk stale data
+            return await render()
+        key = self.key(route, params, tags, generations)
+        value = await self.__run(self.__lookup, key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await render()
+        await self.__run(self.__store, key, value)
+        return value
+
+    async def invalidate(self, *tags: str):
+        await self.__run(self.bump, *tags)
+
+    def bump(self, *tags: str):
+        # invalidate, for callers outside the event loop: upload callbacks
+        # and scripts
+        tags = list(tags)
+        self.local.bump(tags)
+        if self.shared is not None:
+            try:
+                self.shared.bump(tags)
+            except Exception as e:
+                self.errors += 1
+                print("Could not invalidate response cache:", e)
+
+    async def __run(self, fn, *args):
+        # Only the shared backend does network I/O
+        if self.shared is None:
+            return fn(*args)
+        return await run_in_threadpool(fn, *args)
@@ -0,0 +1,354 @@
+from dataclasses import dataclass, field
+from mmap import mmap, ACCESS_READ
+from os import fstat, pread
+from struct import Struct
+from typing import Callable
+
+# In-process port of caff-parser/caff.cpp.
+# Every integer in the format is little-endian, the pixel payloads are never
+# copied: each animation gets a memoryview slice over the source buffer.
+
+CAFF_MAGIC = b"CAFF"
+CIFF_MAGIC = b"CIFF"
+
+BLOCK_HEADER = 1
+BLOCK_CREDITS = 2
+BLOCK_ANIMATION = 3
+
+_U64 = Struct("<Q")
+# block id (1 byte) + block length (8 bytes)
+_BLOCK = Struct("<BQ")
+# year, month, day, hour, minute, creator_len
+_CREDITS = Struct("<HBBBBQ")
+# magic, header_size, content_size, width, height
+_CIFF_HEADER = Struct("<4sQQQQ")
+
+
+class CaffParseError(Exception):
+    pass
+
+
+@dataclass
+class CaffCredits:
+    year: int
+    month: int
+    day: int
+    hour: int
+    minute: int
+    creator: str
+
+
+@dataclass
+class CaffAnimation:
+    duration: int
+    width: int
+    height: int
+    caption: str
+    tags: list[str]
+    # width * height * 3 bytes of RGB, row by row from the top. None when
+    # read with read_metadata.
+    pixels: memoryview | None
+
+
+@dataclass
+class ParsedCaff:
+    num_anim: int
+    credits: CaffCredits
+    animations: list[CaffAnimation] = field(default_factory=list)
+
+    def metadata(self) -> dict:
+        # Same shape as the metadata.json written by the native parser
+        return {
+            "credits": {
+                "year": self.credits.year,
+                "month": self.credits.month,
+                "day": self.credits.day,
+                "hour": self.credits.hour,
+                "minute": self.credits.minute,
+                "creator": self.credits.creator,
+            },
+            "animation": [{
+                "duration": a.duration,
+                "width": a.width,
+                "height": a.height,
+                "caption": a.caption,
+                "tags": a.tags,
+            } for a in self.animations],
+        }
+
+
+def _decode(raw: memoryview) -> str:
+    return bytes(raw).decode("utf-8", errors="replace")
+
+
+def parse_header(block: memoryview) -> int:
+    if len(block) < 4 + 8 + 8:
+        raise CaffParseError("Too short CAFF header block!")
+    if bytes(block[0:4]) != CAFF_MAGIC:
+        raise CaffParseError("Wrong CAFF Magic!")
+    header_size = _U64.unpack_from(block, 4)[0]
+    if header_size != len(block):
+        raise CaffParseError("Wrong CAFF header size!")
+    return _U64.unpack_from(block, 12)[0]
+
+
+def parse_credits(block: memoryview) -> CaffCredits:
+    if len(block) < _CREDITS.size:
+        raise CaffParseError("Too short CAFF credits block!")
+    year, month, day, hour, minute, creator_len = _CREDITS.unpack_from(block, 0)
+    if _CREDITS.size + creator_len > len(block):
+        raise CaffParseError("Creator does not fit into the credits block!")
+    creator = _decode(block[_CREDITS.size:_CREDITS.size + creator_len])
+    return CaffCredits(year=year, month=month, day=day, hour=hour, minute=minute, creator=creator)
+
+
+def parse_animation(block: memoryview) -> CaffAnimation:
+    animation, header_size = parse_animation_header(block, len(block))
+    ciff = block[8:]
+    animation.pixels = ciff[header_size:header_size + animation.width * animation.height * 3]
+    return animation
+
+
+def parse_animation_header(head: memoryview, length: int) -> tuple[CaffAnimation, int]:
+    # head starts at the duration and holds at least the whole CIFF header,
+    # length is the size of the animation block. Returns the animation
+    # without pixels and the CIFF header size.
+    if length < 8 + _CIFF_HEADER.size or len(head) < 8 + _CIFF_HEADER.size:
+        raise CaffParseError("Too short CAFF animation block!")
+    duration = _U64.unpack_from(head, 0)[0]
+    ciff = head[8:]
+
+    magic, header_size, content_size, width, height = _CIFF_HEADER.unpack_from(ciff, 0)
+    if magic != CIFF_MAGIC:
+        raise CaffParseError("Wrong CIFF magic")
+    if header_size < _CIFF_HEADER.size or header_size > length - 8 or header_size > len(ciff):
+        raise CaffParseError("Wrong CIFF header size!")
+    if content_size != width * height * 3:
+        raise CaffParseError("CIFF content size does not match width * height * 3!")
+    if header_size + content_size > length - 8:
+        raise CaffParseError("CIFF content does not fit into the animation block!")
+
+    # caption is terminated by '\n', tags are '\0' terminated strings
+    # filling the rest of the CIFF header
+    rest = bytes(ciff[_CIFF_HEADER.size:header_size])
+    newline = rest.find(b"\n")
+    if newline < 0:
+        raise CaffParseError("CIFF caption is not terminated!")
+    caption = rest[:newline].decode("utf-8", errors="replace")
+
+    raw_tags = rest[newline + 1:]
+    if raw_tags and not raw_tags.endswith(b"\0"):
+        raise CaffParseError("CIFF tag is not terminated!")
+    tags = [tag.decode("utf-8", errors="replace")
+            for tag in raw_tags.split(b"\0")[:-1]]
+
+    return CaffAnimation(duration=duration, width=width, height=height,
+                         caption=caption, tags=tags, pixels=None), header_size
+
+
+def read_animation_header(read: Callable[[int, int], memoryview], offset: int, length: int) -> CaffAnimation:
+    # Reads the duration and CIFF header of the block at offset, the pixels
+    # are never touched
+    if length < 8 + _CIFF_HEADER.size:
+        raise CaffParseError("Too short CAFF animation block!")
+    header_size = _CIFF_HEADER.unpack_from(read(offset, 8 + _CIFF_HEADER.size), 8)[1]
+    if header_size < _CIFF_HEADER.size or header_size > length - 8:
+        raise CaffParseError("Wrong CIFF header size!")
+    return parse_animation_header(read(offset, 8 + header_size), length)[0]
+
+
+def parse(buffer) -> ParsedCaff:
+    data = memoryview(buffer)
+    return parse_blocks(len(data), lambda offset, length: data[offset:offset + length], pixels=True)
+
+
+def parse_blocks(size: int, read: Callable[[int, int], memoryview], pixels: bool) -> ParsedCaff:
+    # read(offset, length) returns that many bytes of the file. Without
+    # pixels only the header, credits and CIFF headers are ever read.
+    offset = 0
+    num_anim = None
+    credits = None
+    animations = []
+
+    while offset < size:
+        if offset + _BLOCK.size > size:
+            raise CaffParseError("Truncated block header!")
+        block_id, length = _BLOCK.unpack_from(read(offset, _BLOCK.size), 0)
+        offset += _BLOCK.size
+        if offset + length > size:
+            raise CaffParseError("Block length is larger than the file!")
+
+        if num_anim is None:
+            if block_id != BLOCK_HEADER:
+                raise CaffParseError("Wrong CAFF:Header block id!")
+            num_anim = parse_header(read(offset, length))
+        elif block_id == BLOCK_CREDITS:
+            if credits is not None:
+                raise CaffParseError("CAFF::MultipleCreditsException")
+            credits = parse_credits(read(offset, length))
+        elif block_id == BLOCK_ANIMATION:
+            if pixels:
+                animations.append(parse_animation(read(offset, length)))
+            else:
+                animations.append(read_animation_header(read, offset, length))
+        else:
+            raise CaffParseError("Unknown block id in file!")
+        offset += length
+
+    if num_anim is None:
+        raise CaffParseError("Input file error!")
+    if credits is None:
+        raise CaffParseError("Missing CAFF credits block!")
+    if len(animations) != num_anim or num_anim == 0:
+        raise CaffParseError("Number of animations does not match the CAFF header!")
+
+    return ParsedCaff(num_anim=num_anim, credits=credits, animations=animations)
+
+
+def parse_file(path: str) -> ParsedCaff:
+    # The map stays alive as long as any returned pixel view references it
+    with open(path, "rb") as f:
+        try:
+            mapped = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            raise CaffParseError("Input file error!")
+    return parse(mapped)
+
+
+def read_metadata(path: str) -> ParsedCaff:
+    # Credits and animation headers only: a few positioned reads per frame,
+    # the pixel payloads are skipped, so the cost does not grow with the
+    # image size
+    with open(path, "rb") as f:
+        fd = f.fileno()
+
+        def read(offset: int, length: int) -> memoryview:
+            data = pread(fd, length, offset)
+            if len(data) != length:
+                raise CaffParseError("Input file error!")
+            return memoryview(data)
+
+        return parse_blocks(fstat(fd).st_size, read, pixels=False)
+
+
+class CaffTooLargeError(CaffParseError):
+    pass
+
+
+# Longest caption and tag list accepted in a CIFF header
+MAX_CIFF_HEADER = 64 * 1024
+
+
+class StreamValidator:
+    # Checks the block structure while an upload arrives, so garbage is
+    # rejected after the first block headers instead of after the whole file
+    # reached the disk. Only headers are buffered, pixel bytes are counted.
+    # Block lengths must match what their contents declare, so the size of
+    # the file is fixed by num_anim and each frame's width * height.
+    def __init__(self, max_frames: int, max_frame_pixels: int, max_bytes: int):
+        self.max_frames = max_frames
+        self.max_frame_pixels = max_frame_pixels
+        self.max_bytes = max_bytes
+        self.received = 0
+        self.num_anim: int | None = None
+        self.credits = False
+        self.animations = 0
+        self.__pending = bytearray()
+        self.__state = "block"
+        self.__need = _BLOCK.size
+        self.__skip = 0
+        self.__length = 0
+        self.__end = 0
+
+    def feed(self, chunk: bytes):
+        data = memoryview(chunk)
+        self.received += len(data)
+        if self.received > self.max_bytes:
+            raise CaffTooLargeError("Upload is larger than the size limit!")
+        offset = 0
+        while offset < len(data):
+            if self.__skip:
+                taken = min(self.__skip, len(data) - offset)
+                self.__skip -= taken
+                offset += taken
+                continue
+            taken = min(self.__need - len(self.__pending), len(data) - offset)
+            self.__pending += data[offset:offset + taken]
+            offset += taken
+            if len(self.__pending) == self.__need:
+                self.__check(memoryview(bytes(self.__pending)))
+                self.__pending.clear()
+
+    def __check(self, part: memoryview):
+        if self.__state == "block":
+            self.__check_block(*_BLOCK.unpack_from(part, 0))
+        elif self.__state == "header":
+            self.num_anim = parse_header(part)
+            if self.num_anim == 0:
+                raise CaffParseError("Number of animations does not match the CAFF header!")
+            if self.num_anim > self.max_frames:
+                raise CaffTooLargeError("Too many animations in the CAFF header!")
+            self.__next_block()
+        elif self.__state == "credits":
+            creator_len = _CREDITS.unpack_from(part, 0)[5]
+            if _CREDITS.size + creator_len != self.__length:
+                raise CaffParseError("Creator length does not match the credits block!")
+            self.credits = True
+            self.__next_block(skip=creator_len)
+        else:
+            self.__check_animation(part)
+
+    def __check_block(self, block_id: int, length: int):
+        start = self.__end + _BLOCK.size
+        self.__length = length
+        self.__end = start + length
+        if self.num_anim is None:
+            if block_id != BLOCK_HEADER:
+                raise CaffParseError("Wrong CAFF:Header block id!")
+            if length != 4 + 8 + 8:
+                raise CaffParseError("Wrong CAFF header size!")
+            self.__state, self.__need = "header", length
+        elif block_id == BLOCK_CREDITS:
+            if self.credits:
+                raise CaffParseError("CAFF::MultipleCreditsException")
+            if length < _CREDITS.size:
+                raise CaffParseError("Too short CAFF credits block!")
+            self.__state, self.__need = "credits", _CREDITS.size
+        elif block_id == BLOCK_ANIMATION:
+            if self.animations == self.num_anim:
+                raise CaffParseError("Number of animations does not match the CAFF header!")
+            if length < 8 + _CIFF_HEADER.size:
+                raise CaffParseError("Too short CAFF animation block!")
+            self.__state, self.__need = "animation", 8 + _CIFF_HEADER.size
+        else:
+            raise CaffParseError("Unknown block id in file!")
+        if self.__end > self.max_bytes:
+            raise CaffTooLargeError("Declared block length is larger than the size limit!")
+
+    def __check_animation(self, part: memoryview):
+        magic, header_size, content_size, width, height = _CIFF_HEADER.unpack_from(part, 8)
+        if magic != CIFF_MAGIC:
+            raise CaffParseError("Wrong CIFF magic")
+        if header_size < _CIFF_HEADER.size or header_size > MAX_CIFF_HEADER:
+            raise CaffParseError("Wrong CIFF header size!")
+        if width * height > self.max_frame_pixels:
+            raise CaffTooLargeError("CIFF is larger than the frame size limit!")
+        if content_size != width * height * 3:
+            raise CaffParseError("CIFF content size does not match width * height * 3!")
+        if 8 + header_size + content_size != self.__length:
+            raise CaffParseError("CIFF size does not match the animation block!")
+        self.animations += 1
+        self.__next_block(skip=self.__length - len(part))
+
+    def __next_block(self, skip: int = 0):
+        self.__state, self.__need, self.__skip = "block", _BLOCK.size, skip
+
+    def finish(self):
+        if self.__state != "block" or self.__pending or self.__skip:
+            raise CaffParseError("Truncated block!")
+        if self.num_anim is None:
+            raise CaffParseError("Input file error!")
+        if not self.credits:
+            raise CaffParseError("Missing CAFF credits block!")
+        if self.animations != self.num_anim:
+            raise CaffParseError("Number of animations does not match the CAFF header!")
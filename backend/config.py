@@ -3,5 +3,53 @@ from pydantic import BaseSettings
 
 class Settings(BaseSettings):
     keycloak_realm_url: str
+    keycloak_jwks_url: str | None = None
+    jwks_refresh_interval: int = 300
     ui_url: str
     database_url: str
+    database_async: bool = False
+    database_async_url: str | None = None
+    # Pool sizing is ignored for SQLite. pool_size + max_overflow per process
+    # (API and each upload worker) must stay below MySQL max_connections.
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_timeout: float = 30
+    # Below MySQL wait_timeout, so the server never closes a pooled connection first
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+    db_slow_query_ms: int = 500
+    db_slow_query_log: str | None = None
+    # Both end with a slash, file names are appended directly
+    upload_path: str = '/caff/data/out/'
+    preview_path: str = '/caff/data/preview/'
+    upload_workers: int = 2
+    # Checked while the upload streams in; a CAFF's size follows from its
+    # frame count and each frame's width * height
+    upload_max_frames: int = 1000
+    upload_max_frame_pixels: int = 4096 * 4096
+    upload_max_bytes: int = 512 * 1024 * 1024
+    # Batch uploads: files per request, the size of an uploaded archive and
+    # of everything the request unpacks, and how many files a worker parses
+    # and inserts together
+    upload_batch_max_files: int = 5000
+    upload_batch_max_bytes: int = 8 * 1024 * 1024 * 1024
+    upload_batch_group_size: int = 16
+    upload_queue_size: int = 64
+    preview_size: int = 512
+    preview_cache_dir: str | None = None
+    preview_cache_size_mb: int = 512
+    frame_cache_size_mb: int = 64
+    token_cache_size: int = 1024
+    response_cache_size: int = 1024
+    response_cache_ttl: int = 300
+    response_cache_url: str | None = None
+    # Seconds a request waits for the shared cache before serving uncached
+    response_cache_timeout: float = 0.5
+    token_cache_ttl: int = 300
+    audit_queue_size: int = 10000
+    audit_batch_size: int = 500
+    audit_flush_interval: float = 1.0
+    log_retention_days: int = 0
+    log_retention_interval: int = 3600
+    log_prune_batch_size: int = 5000
+    log_archive_dir: str | None = None
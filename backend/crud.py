@@ -1,7 +1,12 @@
-from sqlalchemy.orm import Session
+from datetime import datetime
+
+from sqlalchemy import and_, case, column, delete, distinct, func, insert, inspect, or_, select, table
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
 
 import models
 import schemas
+import search
 
 
 def get_caffs(db: Session):
@@ -11,7 +16,8 @@ def get_caffs(db: Session):
 
 def create_caff(db: Session, caff: schemas.CaffBase):
     db_caff = models.Caff(year=caff.year, month=caff.month, day=caff.day, hour=caff.hour,
-                          minute=caff.minute, creatorLen=caff.creatorlen, creator=caff.creator, rawfile=caff.rawfile)
+                          minute=caff.minute, creatorLen=caff.creatorlen, creator=caff.creator, rawfile=caff.rawfile,
+                          content_hash=caff.content_hash)
     db.add(db_caff)
     db.commit()
     db.refresh(db_caff)
@@ -28,32 +34,360 @@ def get_caff_by_id(id: int, db: Session):
     return db.query(models.Caff).filter(models.Caff.id == id).first()
 
 
-def get_caff_by_id_with_comments(id: int, db: Session, skip: int = 0):
-    return db.query(models.Caff).filter(models.Caff.id == id).offset(skip).all()
+def get_caff_by_content_hash(content_hash: str, db: Session):
+    return db.query(models.Caff).filter(models.Caff.content_hash == content_hash) \
+        .order_by(models.Caff.id).first()
+
+
+def get_caff_ids_by_content_hashes(content_hashes: list[str], db: Session) -> dict[str, int]:
+    # The oldest CAFF for each hash, like get_caff_by_content_hash
+    if not content_hashes:
+        return {}
+    return dict(db.query(models.Caff.content_hash, func.min(models.Caff.id))
+                .filter(models.Caff.content_hash.in_(content_hashes)).group_by(models.Caff.content_hash))
+
+
+def get_caffs_by_rawfiles(rawfiles: list[str], db: Session) -> dict[str, tuple[int, str | None]]:
+    # (id, content_hash) of the oldest CAFF stored at each rawfile
+    if not rawfiles:
+        return {}
+    return {rawfile: (caff_id, content_hash) for caff_id, rawfile, content_hash in
+            db.query(models.Caff.id, models.Caff.rawfile, models.Caff.content_hash)
+            .filter(models.Caff.rawfile.in_(rawfiles)).order_by(models.Caff.id.desc())}
+
+
+def set_missing_content_hashes(db: Session, content_hashes: dict[str, str]) -> list[int]:
+    # Records the hash of CAFFs stored before content addressing, by rawfile.
+    # Returns the ids that got one.
+    rawfiles = list(content_hashes)
+    caff_ids = [caff_id for caff_id, in db.query(models.Caff.id).filter(
+        models.Caff.rawfile.in_(rawfiles), models.Caff.content_hash.is_(None))]
+    try:
+        for rawfile, content_hash in content_hashes.items():
+            db.query(models.Caff).filter(models.Caff.rawfile == rawfile, models.Caff.content_hash.is_(None)) \
+                .update({"content_hash": content_hash}, synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return caff_ids
+
+
+def is_rawfile_referenced(rawfile: str, db: Session):
+    return db.query(models.Caff.id).filter(models.Caff.rawfile == rawfile).first() is not None
+
+
+def get_caffs_with_comments(db: Session):
+    return db.query(models.Caff).options(selectinload(models.Caff.comments)).all()
+
+
+def get_caff_by_id_with_comments(id: int, db: Session):
+    return db.query(models.Caff).options(selectinload(models.Caff.comments)).filter(models.Caff.id == id).first()
+
+
+def __tag_filter(tag: str, prefix: bool):
+    if prefix:
+        escaped = tag.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return models.Tag.name.like(escaped + "%", escape="\\")
+    return models.Tag.name == tag
+
+
+def __has_tag(condition):
+    return models.Caff.animations.any(models.Ciff.tags.any(condition))
+
+
+def tag_conditions(tags: list[str] | None = None, match_all: bool = True, prefix: bool = False) -> list:
+    # Every tag becomes an EXISTS over ciff_tags, so no dedup is needed
+    if not tags:
+        return []
+    conditions = [__tag_filter(tag, prefix) for tag in tags]
+    if match_all:
+        return [__has_tag(condition) for condition in conditions]
+    return [__has_tag(or_(*conditions))]
+
+
+def __caffs_query(db: Session, tags: list[str] | None = None, match_all: bool = True, prefix: bool = False):
+    return db.query(models.Caff).filter(*tag_conditions(tags, match_all, prefix))
 
 
-def get_caff_ids_by_tag(tag: str, db: Session):
-    return db.query(models.Ciff).filter(models.Ciff.tags.contains(tag)).all()
+def get_caffs_by_tags(tags: list[str], db: Session, match_all: bool = True, prefix: bool = False):
+    return __caffs_query(db, tags, match_all, prefix).order_by(models.Caff.id).all()
+
+
+def get_caffs_page(db: Session, limit: int, after_id: int | None = None, tags: list[str] | None = None,
+                   match_all: bool = True, prefix: bool = False, with_comments: bool = False):
+    query = __caffs_query(db, tags, match_all, prefix)
+    if with_comments:
+        query = query.options(selectinload(models.Caff.comments))
+    if after_id is not None:
+        query = query.filter(models.Caff.id > after_id)
+    return query.order_by(models.Caff.id).limit(limit).all()
+
+
+def stream_caffs(db: Session, batch_size: int, tags: list[str] | None = None,
+                 match_all: bool = True, prefix: bool = False):
+    return __caffs_query(db, tags, match_all, prefix).order_by(models.Caff.id) \
+        .execution_options(stream_results=True).yield_per(batch_size)
+
+
+def iter_caffs_with_comments(db: Session, batch_size: int):
+    # The comment loads need the connection, so walk keyset pages
+    # instead of holding a server-side cursor open
+    after_id = None
+    while True:
+        caffs = get_caffs_page(db, batch_size, after_id=after_id, with_comments=True)
+        yield from caffs
+        if len(caffs) < batch_size:
+            return
+        after_id = caffs[-1].id
+
+
+def document_frequencies(terms: list[str]):
+    return select(models.SearchTerm.term, func.count(distinct(models.SearchTerm.caff_id))) \
+        .where(models.SearchTerm.term.in_(terms)).group_by(models.SearchTerm.term)
+
+
+def ranked_caff_ids(idf: dict[str, float], match_all: bool, limit: int, offset: int):
+    # Score = sum of weight * idf over the matched rows of a CAFF
+    score = func.sum(models.SearchTerm.weight * case(idf, value=models.SearchTerm.term, else_=0)).label("score")
+    query = select(models.SearchTerm.caff_id, score).where(models.SearchTerm.term.in_(list(idf))) \
+        .group_by(models.SearchTerm.caff_id)
+    if match_all and len(idf) > 1:
+        query = query.having(func.count(distinct(models.SearchTerm.term)) == len(idf))
+    return query.order_by(score.desc(), models.SearchTerm.caff_id).limit(limit).offset(offset)
+
+
+def search_idf(terms: list[str], frequencies: dict[str, int], total: int, match_all: bool) -> dict[str, float] | None:
+    # None when nothing can match
+    if not frequencies or (match_all and len(frequencies) < len(terms)):
+        return None
+    return {term: search.idf(total, df) for term, df in frequencies.items()}
+
+
+def search_caffs(db: Session, terms: list[str], match_all: bool, limit: int, offset: int = 0):
+    # (caff, score) pairs, best first
+    if not terms:
+        return []
+    frequencies = dict(db.execute(document_frequencies(terms)).all())
+    idf = search_idf(terms, frequencies, db.query(func.count(models.Caff.id)).scalar(), match_all)
+    if idf is None:
+        return []
+    ranked = db.execute(ranked_caff_ids(idf, match_all, limit, offset)).all()
+    caffs = {caff.id: caff for caff in db.query(models.Caff).filter(models.Caff.id.in_([id for id, _ in ranked]))}
+    return [(caffs[id], score) for id, score in ranked if id in caffs]
+
+
+def build_search_index(db: Session, batch_size: int) -> int:
+    # Indexes every CAFF without terms, for databases created before the
+    # index existed. Commits once per batch of CAFFs, returns how many were indexed.
+    indexed = 0
+    after_id = 0
+    while True:
+        caffs = db.query(models.Caff).options(selectinload(models.Caff.animations), selectinload(models.Caff.comments)) \
+            .filter(models.Caff.id > after_id, ~models.Caff.id.in_(select(models.SearchTerm.caff_id))) \
+            .order_by(models.Caff.id).limit(batch_size).all()
+        if not caffs:
+            return indexed
+        terms = []
+        for caff in caffs:
+            terms += search.term_rows(caff.id, search.CREATOR, caff.id, caff.creator)
+            for ciff in caff.animations:
+                terms += search.term_rows(caff.id, search.CAPTION, ciff.id, ciff.caption)
+            for comment in caff.comments:
+                terms += search.term_rows(caff.id, search.COMMENT, comment.id, comment.text)
+        if terms:
+            db.execute(insert(models.SearchTerm), terms)
+        db.commit()
+        indexed += len(caffs)
+        after_id = caffs[-1].id
+        db.expunge_all()
+
+
+def get_or_create_tags(names: list[str], db: Session):
+    names = list(dict.fromkeys(names))
+    if not names:
+        return []
+    tags = {tag.name: tag for tag in db.query(models.Tag).filter(models.Tag.name.in_(names))}
+    for name in names:
+        if name in tags:
+            continue
+        # Another upload worker may insert the same tag concurrently
+        try:
+            with db.begin_nested():
+                tags[name] = models.Tag(name=name)
+                db.add(tags[name])
+        except IntegrityError:
+            tags[name] = db.query(models.Tag).filter(models.Tag.name == name).one()
+    return [tags[name] for name in names]
 
 
 def create_ciff(db: Session, ciff=schemas.CiffCreate):
     db_ciff = models.Ciff(width=ciff.width, height=ciff.height, collection_id=ciff.collection_id,
-                          tags=ciff.tags, duration=ciff.duration, caption=ciff.caption)
+                          tags=get_or_create_tags(ciff.tags, db), duration=ciff.duration, caption=ciff.caption)
     db.add(db_ciff)
     db.commit()
     db.refresh(db_ciff)
     return db_ciff
 
 
+def __ensure_tags(names: set[str], db: Session) -> dict[str, int]:
+    if not names:
+        return {}
+    tag_ids = dict(db.query(models.Tag.name, models.Tag.id).filter(models.Tag.name.in_(names)))
+    missing = [{"name": name} for name in names if name not in tag_ids]
+    if missing:
+        try:
+            with db.begin_nested():
+                db.execute(insert(models.Tag), missing)
+        except IntegrityError:
+            # A concurrent ingest created some of them, fall back to one by one
+            get_or_create_tags([tag["name"] for tag in missing], db)
+            db.flush()
+        tag_ids.update(db.query(models.Tag.name, models.Tag.id).filter(
+            models.Tag.name.in_([tag["name"] for tag in missing])))
+    return tag_ids
+
+
+def __add_caff(db: Session, caff: schemas.CaffBase, ciffs: list[schemas.CiffIngest],
+               tag_ids: dict[str, int]) -> models.Caff:
+    db_caff = models.Caff(year=caff.year, month=caff.month, day=caff.day, hour=caff.hour,
+                          minute=caff.minute, creatorLen=caff.creatorlen, creator=caff.creator, rawfile=caff.rawfile,
+                          content_hash=caff.content_hash)
+    db.add(db_caff)
+    db.flush()
+    __add_ciffs(db, db_caff.id, caff, ciffs, tag_ids)
+    return db_caff
+
+
+def __add_ciffs(db: Session, caff_id: int, caff: schemas.CaffBase, ciffs: list[schemas.CiffIngest],
+                tag_ids: dict[str, int]):
+    db.execute(insert(models.Ciff), [
+        {"width": ciff.width, "height": ciff.height, "duration": ciff.duration,
+         "caption": ciff.caption, "collection_id": caff_id} for ciff in ciffs])
+    # Nobody else writes this collection, so id order is insertion order
+    ciff_ids = [id for id, in db.query(models.Ciff.id).filter(
+        models.Ciff.collection_id == caff_id).order_by(models.Ciff.id)]
+
+    links = [{"ciff_id": ciff_id, "tag_id": tag_ids[tag]}
+             for ciff_id, ciff in zip(ciff_ids, ciffs) for tag in dict.fromkeys(ciff.tags)]
+    if links:
+        db.execute(insert(models.ciff_tags), links)
+
+    terms = search.term_rows(caff_id, search.CREATOR, caff_id, caff.creator)
+    for ciff_id, ciff in zip(ciff_ids, ciffs):
+        terms += search.term_rows(caff_id, search.CAPTION, ciff_id, ciff.caption)
+    if terms:
+        db.execute(insert(models.SearchTerm), terms)
+
+
+def ingest_caff(db: Session, caff: schemas.CaffBase, ciffs: list[schemas.CiffIngest]):
+    # The CAFF, its CIFFs and their tags in one transaction with a constant
+    # number of statements, however many frames the file has
+    try:
+        tag_ids = __ensure_tags({tag for ciff in ciffs for tag in ciff.tags}, db)
+        db_caff = __add_caff(db, caff, ciffs, tag_ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    db.refresh(db_caff)
+    return db_caff
+
+
+def ingest_caffs(db: Session, items: list[tuple[schemas.CaffBase, list[schemas.CiffIngest]]]) -> list[int]:
+    # A group of CAFFs in one transaction, the tags of the whole group are
+    # looked up and created together. Returns the new ids in item order.
+    try:
+        tag_ids = __ensure_tags({tag for _, ciffs in items for ciff in ciffs for tag in ciff.tags}, db)
+        caff_ids = [__add_caff(db, caff, ciffs, tag_ids).id for caff, ciffs in items]
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return caff_ids
+
+
+def refresh_caffs(db: Session, items: list[tuple[int, schemas.CaffBase, list[schemas.CiffIngest]]]):
+    # Rewrites the metadata of stored CAFFs in one transaction. Ids, comments
+    # and comment search terms are kept, the CIFFs are recreated.
+    caff_ids = [caff_id for caff_id, _, _ in items]
+    try:
+        ciff_ids = db.query(models.Ciff.id).filter(models.Ciff.collection_id.in_(caff_ids))
+        db.execute(models.ciff_tags.delete().where(models.ciff_tags.c.ciff_id.in_(ciff_ids.scalar_subquery())))
+        db.query(models.Ciff).filter(models.Ciff.collection_id.in_(caff_ids)).delete(synchronize_session=False)
+        db.query(models.SearchTerm).filter(models.SearchTerm.caff_id.in_(caff_ids),
+                                           models.SearchTerm.field != search.COMMENT).delete(synchronize_session=False)
+        tag_ids = __ensure_tags({tag for _, _, ciffs in items for ciff in ciffs for tag in ciff.tags}, db)
+        for caff_id, caff, ciffs in items:
+            db.query(models.Caff).filter(models.Caff.id == caff_id).update(
+                {"year": caff.year, "month": caff.month, "day": caff.day, "hour": caff.hour, "minute": caff.minute,
+                 "creatorLen": caff.creatorlen, "creator": caff.creator, "rawfile": caff.rawfile,
+                 "content_hash": caff.content_hash},
+                synchronize_session=False)
+            __add_ciffs(db, caff_id, caff, ciffs, tag_ids)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+# The ';'-joined ciffs.tags column of databases created before the tags table
+legacy_ciffs = table("ciffs", column("id"), column("tags"))
+
+
+def migrate_legacy_tags(db: Session, batch_size: int) -> int:
+    # Links the CIFFs of an older database to their tags. Every migrated row
+    # gets its old column cleared in the same transaction, so an interrupted
+    # run resumes and later startups find nothing to do. Returns how many
+    # CIFFs were migrated.
+    if "tags" not in {c["name"] for c in inspect(db.get_bind()).get_columns("ciffs")}:
+        return 0
+    migrated = 0
+    while True:
+        rows = db.execute(select(legacy_ciffs.c.id, legacy_ciffs.c.tags)
+                          .where(legacy_ciffs.c.tags.isnot(None))
+                          .order_by(legacy_ciffs.c.id).limit(batch_size)).all()
+        if not rows:
+            return migrated
+        names = {ciff_id: list(dict.fromkeys(t for t in tags.split(';') if t)) for ciff_id, tags in rows}
+        try:
+            tag_ids = __ensure_tags({name for tags in names.values() for name in tags}, db)
+            links = [{"ciff_id": ciff_id, "tag_id": tag_ids[name]}
+                     for ciff_id, tags in names.items() for name in tags]
+            if links:
+                db.execute(models.ciff_tags.insert(), links)
+            db.execute(legacy_ciffs.update().where(legacy_ciffs.c.id.in_(list(names))).values(tags=None))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        migrated += len(rows)
+
+
 def create_comment(db: Session, comment: schemas.CommentBase, collection_id: int):
     db_comment = models.Comment(text=comment.text, author_id=comment.author_id, date=comment.date,
                                 collection_id=collection_id)
     db.add(db_comment)
+    db.flush()
+    index_comment(db_comment.id, collection_id, comment.text, db)
     db.commit()
     db.refresh(db_comment)
     return db_comment
 
 
+def index_comment(comment_id: int, collection_id: int, text: str | None, db: Session):
+    # Replaces the comment's terms, part of the caller's transaction
+    db.execute(unindex_comment(comment_id))
+    terms = search.term_rows(collection_id, search.COMMENT, comment_id, text)
+    if terms:
+        db.execute(insert(models.SearchTerm), terms)
+
+
+def unindex_comment(comment_id: int):
+    return delete(models.SearchTerm).where(models.SearchTerm.field == search.COMMENT,
+                                           models.SearchTerm.source_id == comment_id)
+
+
 def get_users(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.User).offset(skip).limit(limit).all()
 
@@ -65,6 +399,9 @@ def get_comment_by_id(comment_id: int, db: Session):
 def update_comment_by_id(comment_id: int, comment: schemas.CommentBase, db: Session):
     db.query(models.Comment).filter(models.Comment.id == comment_id).update(
         {'text': comment.text, 'date': comment.date})
+    collection_id = db.query(models.Comment.collection_id).filter(models.Comment.id == comment_id).scalar()
+    if collection_id is not None:
+        index_comment(comment_id, collection_id, comment.text, db)
 
     db.commit()
     return 1
@@ -73,22 +410,24 @@ def update_comment_by_id(comment_id: int, comment: schemas.CommentBase, db: Sess
 def delete_comment_by_id(comment_id: int, db: Session):
     comment = get_comment_by_id(comment_id=comment_id, db=db)
     result = db.delete(comment)
+    db.execute(unindex_comment(comment_id))
     db.commit()
     return result
 
 
 def delete_caff_by_id(caff_id: int, db: Session):
+    # Set-based deletes, nothing is loaded into the session. The foreign keys
+    # cascade as well, the explicit child deletes keep tables created before
+    # ON DELETE CASCADE consistent.
     try:
-        caff = get_caff_by_id(caff_id, db)
-        ciffs = __get_ciffs_by_caff_id(caff_id, db)
-        comments = __get_comments_by_caff_id(caff_id, db)
-        for comment in comments:
-            db.delete(comment)
-        for ciff in ciffs:
-            db.delete(ciff)
-        db.delete(caff)
+        ciff_ids = db.query(models.Ciff.id).filter(models.Ciff.collection_id == caff_id)
+        db.execute(models.ciff_tags.delete().where(models.ciff_tags.c.ciff_id.in_(ciff_ids.scalar_subquery())))
+        db.query(models.Ciff).filter(models.Ciff.collection_id == caff_id).delete(synchronize_session=False)
+        db.query(models.Comment).filter(models.Comment.collection_id == caff_id).delete(synchronize_session=False)
+        db.query(models.SearchTerm).filter(models.SearchTerm.caff_id == caff_id).delete(synchronize_session=False)
+        deleted = db.query(models.Caff).filter(models.Caff.id == caff_id).delete(synchronize_session=False)
         db.commit()
-        return True
+        return deleted == 1
     except Exception as _:
         db.rollback()
         db.flush()
@@ -100,6 +439,64 @@ def get_logs(db: Session):
     return db_caff
 
 
+def filter_logs(query, filters: schemas.LogFilter | None):
+    # level + date range is served by ix_logs_level_date, date range alone by ix_logs_date
+    if filters is None:
+        return query
+    if filters.level is not None:
+        query = query.filter(models.Log.level == filters.level)
+    if filters.author_id is not None:
+        query = query.filter(models.Log.author_id == filters.author_id)
+    if filters.since is not None:
+        query = query.filter(models.Log.date >= filters.since)
+    if filters.until is not None:
+        query = query.filter(models.Log.date < filters.until)
+    return query
+
+
+def __logs_query(db: Session, filters: schemas.LogFilter | None = None):
+    query = filter_logs(db.query(models.Log), filters)
+    return query.order_by(models.Log.date.desc(), models.Log.id.desc())
+
+
+def get_logs_page(db: Session, limit: int, before: tuple[datetime, int] | None = None,
+                  filters: schemas.LogFilter | None = None):
+    # Newest first, keyed on (date, id) so rows with the same date are not skipped
+    query = __logs_query(db, filters)
+    if before is not None:
+        date, id = before
+        query = query.filter(or_(models.Log.date < date,
+                                 and_(models.Log.date == date, models.Log.id < id)))
+    return query.limit(limit).all()
+
+
+def stream_logs(db: Session, batch_size: int, filters: schemas.LogFilter | None = None):
+    return __logs_query(db, filters).execution_options(stream_results=True).yield_per(batch_size)
+
+
+def hour_bucket(dialect_name: str):
+    if dialect_name == "sqlite":
+        return func.strftime("%Y-%m-%d %H:00:00", models.Log.date)
+    return func.date_format(models.Log.date, "%Y-%m-%d %H:00:00")
+
+
+def count_logs_by_level_and_hour(db: Session, filters: schemas.LogFilter | None = None):
+    hour = hour_bucket(db.bind.dialect.name).label("hour")
+    query = db.query(hour, models.Log.level, func.count(models.Log.id).label("count"))
+    query = filter_logs(query, filters)
+    return query.group_by(hour, models.Log.level).order_by(hour, models.Log.level).all()
+
+
+def get_logs_before(cutoff: datetime, limit: int, db: Session):
+    return db.query(models.Log).filter(models.Log.date < cutoff) \
+        .order_by(models.Log.date, models.Log.id).limit(limit).all()
+
+
+def delete_logs_by_ids(ids: list[int], db: Session):
+    db.query(models.Log).filter(models.Log.id.in_(ids)).delete(synchronize_session=False)
+    db.commit()
+
+
 def create_log(log: schemas.Log, db: Session):
     model_log = models.Log(text=log.text, level=log.level,
                            date=log.date, author_id=log.author_id)
@@ -109,6 +506,13 @@ def create_log(log: schemas.Log, db: Session):
     return model_log
 
 
+def create_logs(logs: list[dict], db: Session):
+    # One executemany INSERT for the whole batch
+    if logs:
+        db.execute(insert(models.Log), logs)
+        db.commit()
+
+
 def get_users(db: Session):
     db_caff = db.query(models.User).all()
     return db_caff
@@ -122,17 +526,18 @@ def get_user_by_userid(user_id: str, db: Session):
     return db.query(models.User).filter(models.User.user_id == user_id).first()
 
 
+def get_users_by_userids(user_ids: list[str], db: Session):
+    # One IN query for all authors of a page, keyed by user_id
+    user_ids = set(user_ids)
+    if not user_ids:
+        return {}
+    users = db.query(models.User).filter(models.User.user_id.in_(user_ids)).all()
+    return {user.user_id: user for user in users}
+
+
 def create_user(user: schemas.User, db: Session):
     model_user = models.User(user_id=user.user_id, username=user.username)
     db.add(model_user)
     db.commit()
     db.refresh(model_user)
     return model_user
-
-
-def __get_ciffs_by_caff_id(caff_id, db: Session):
-    return db.query(models.Ciff).filter(models.Ciff.collection_id == caff_id)
-
-
-def __get_comments_by_caff_id(caff_id, db: Session):
-    return db.query(models.Comment).filter(models.Comment.collection_id == caff_id)
@@ -1,14 +1,71 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 from config import Settings
+from dbmonitor import DatabaseMonitor, configure_slow_query_log
 
 settings = Settings()
 
+
+def engine_options(url: str, monitor: DatabaseMonitor) -> dict:
+    options = {"pool_pre_ping": settings.db_pool_pre_ping, "poolclass": monitor.pool_class(url)}
+    # SQLite gets NullPool / SingletonThreadPool, which take no sizing
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(pool_size=settings.db_pool_size, max_overflow=settings.db_max_overflow,
+                       pool_timeout=settings.db_pool_timeout, pool_recycle=settings.db_pool_recycle)
+    return options
+
+
+configure_slow_query_log(settings.db_slow_query_log)
+
+monitor = DatabaseMonitor("sync", settings.db_slow_query_ms / 1000)
 engine = create_engine(
-    settings.database_url
+    settings.database_url, **engine_options(settings.database_url, monitor)
 )
+monitor.attach(engine)
+
+# Drivers used for the async engine when database_async_url is not given
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "mysql": "aiomysql"}
+
+
+def async_url(url: str) -> str:
+    parsed = make_url(url)
+    driver = ASYNC_DRIVERS.get(parsed.get_backend_name())
+    if driver is None:
+        raise ValueError("No async driver known for " + parsed.get_backend_name())
+    return str(parsed.set(drivername=parsed.get_backend_name() + "+" + driver))
+
+
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    # SQLite only enforces foreign keys (and ON DELETE CASCADE) when asked to
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", enable_sqlite_foreign_keys)
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# The async engine serves the request path when database_async is set. Upload
+# workers and the audit log writer keep using the blocking engine above.
+async_engine = None
+async_monitor = None
+AsyncSessionLocal = None
+if settings.database_async:
+    async_database_url = settings.database_async_url or async_url(settings.database_url)
+    async_monitor = DatabaseMonitor("async", settings.db_slow_query_ms / 1000)
+    async_engine = create_async_engine(async_database_url, **engine_options(async_database_url, async_monitor))
+    async_monitor.attach(async_engine.sync_engine)
+    if async_engine.dialect.name == "sqlite":
+        event.listen(async_engine.sync_engine, "connect", enable_sqlite_foreign_keys)
+    # Not expiring on commit keeps attribute access after a commit from
+    # triggering an implicit (and in async, forbidden) refresh
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, autoflush=False,
+                                     expire_on_commit=False)
+
 Base = declarative_base()
@@ -0,0 +1,118 @@
+import logging
+from time import perf_counter
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import Pool, QueuePool
+
+from metrics import Histogram
+
+slow_query_log = logging.getLogger("caff.slow_query")
+
+
+class DatabaseMonitor:
+    # Checkout wait, pool saturation and statement latency of one engine
+    def __init__(self, name: str, slow_query_seconds: float):
+        self.name = name
+        self.slow_query_seconds = slow_query_seconds
+        self.pool: Pool | None = None
+        self.checkout_wait = Histogram()
+        self.statements = Histogram()
+        self.checkout_timeouts = 0
+        self.saturated_checkouts = 0
+        self.peak_checked_out = 0
+        self.disconnects = 0
+        self.slow_queries = 0
+
+    def pool_class(self, url: str, base: type[Pool] | None = None) -> type[Pool]:
+        # The dialect's own pool class, with Pool.connect timed. connect()
+        # covers the wait for a free slot, opening a connection and pre-ping.
+        # Recreated pools (engine.dispose) keep the subclass and the monitor.
+        if base is None:
+            parsed = make_url(url)
+            base = parsed.get_dialect().get_pool_class(parsed)
+        monitor = self
+
+        def connect(pool):
+            start = perf_counter()
+            try:
+                return base.connect(pool)
+            except exc.TimeoutError:
+                monitor.checkout_timeouts += 1
+                raise
+            finally:
+                monitor.checkout_wait.observe(perf_counter() - start)
+
+        return type("Monitored" + base.__name__, (base,), {"connect": connect})
+
+    def capacity(self) -> int | None:
+        if isinstance(self.pool, QueuePool):
+            return self.pool.size() + max(self.pool._max_overflow, 0)
+        return None
+
+    def attach(self, engine: Engine):
+        event.listen(engine, "checkout", self.__on_checkout)
+        event.listen(engine, "before_cursor_execute", self.__before_execute)
+        event.listen(engine, "after_cursor_execute", self.__after_execute)
+        event.listen(engine, "handle_error", self.__on_error)
+        self.pool = engine.pool
+        event.listen(engine, "engine_disposed", self.__on_disposed)
+
+    def __on_disposed(self, engine: Engine):
+        self.pool = engine.pool
+
+    def __on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        pool = self.pool
+        if not isinstance(pool, QueuePool):
+            return
+        checked_out = pool.checkedout()
+        if checked_out > self.peak_checked_out:
+            self.peak_checked_out = checked_out
+        capacity = self.capacity()
+        if capacity is not None and checked_out >= capacity:
+            self.saturated_checkouts += 1
+
+    def __before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(perf_counter())
+
+    def __after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - conn.info["query_start"].pop()
+        self.statements.observe(elapsed)
+        if elapsed >= self.slow_query_seconds:
+            self.slow_queries += 1
+            # Parameters are left out, they may hold user data
+            slow_query_log.warning("%s slow query %.1f ms%s: %s", self.name, elapsed * 1000,
+                                   " (executemany)" if executemany else "", " ".join(statement.split())[:2000])
+
+    def __on_error(self, context):
+        if context.is_disconnect:
+            self.disconnects += 1
+        # A failed statement never reaches after_cursor_execute
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
+
+    def snapshot(self) -> dict:
+        pool = self.pool
+        stats = {
+            "checkout_wait": self.checkout_wait.snapshot(),
+            "statements": self.statements.snapshot(),
+            "checkout_timeouts": self.checkout_timeouts,
+            "saturated_checkouts": self.saturated_checkouts,
+            "peak_checked_out": self.peak_checked_out,
+            "disconnects": self.disconnects,
+            "slow_queries": self.slow_queries,
+            "pool": type(pool).__name__ if pool is not None else None,
+        }
+        if isinstance(pool, QueuePool):
+            stats.update(size=pool.size(), checked_out=pool.checkedout(),
+                         overflow=pool.overflow(), capacity=self.capacity())
+        return stats
+
+
+def configure_slow_query_log(path: str | None):
+    # Without a file the records go to stderr through logging's last resort
+    if path is not None and not slow_query_log.handlers:
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_query_log.addHandler(handler)
+        slow_query_log.propagate = False
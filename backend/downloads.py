@@ -0,0 +1,161 @@
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import quote
+
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+# Conditional and partial downloads of stored files.
+# Only single byte ranges are served; a multi-range request gets the whole
+# file, which RFC 9110 allows.
+
+CHUNK_SIZE = 256 * 1024
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+
+
+def file_etag(stat: os.stat_result, content_hash: str | None = None) -> str:
+    # Content-addressed files have a natural strong validator; anything else
+    # falls back to mtime and size, which change whenever the file is rewritten
+    if content_hash:
+        return '"' + content_hash + '"'
+    return '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+
+
+def __etags(header: str) -> list[str]:
+    return [tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()]
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # For generated responses that have no modification time
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = __etags(if_none_match)
+    return "*" in tags or etag in tags
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if request.headers.get("if-none-match") is not None:
+        return etag_matches(request, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    # Returns the inclusive (start, end) of a single byte range, or None if
+    # the whole file should be sent
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    if not dash:
+        return None
+    try:
+        if first == "":
+            # suffix range: the last N bytes
+            length = int(last)
+            if length <= 0:
+                raise RangeNotSatisfiable()
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if start < 0 or (last and end < start):
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(end, size - 1)
+
+
+def __range_applies(request: Request, etag: str, mtime: float) -> bool:
+    # If-Range turns the range request into a full download when the
+    # client's copy is stale
+    if_range = request.headers.get("if-range")
+    if if_range is None:
+        return True
+    if if_range.startswith('"'):
+        return if_range == etag
+    try:
+        return int(mtime) == parsedate_to_datetime(if_range).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+class FileRangeResponse(Response):
+    # Sends [start, end] of a file. Servers implementing the ASGI zero-copy
+    # extension get the descriptor and use sendfile(2); otherwise the range is
+    # read with pread in the thread pool, one chunk at a time.
+    def __init__(self, path: str, start: int, end: int, status_code: int = 200,
+                 headers: dict | None = None, media_type: str = "application/octet-stream"):
+        super().__init__(content=None, status_code=status_code, headers=headers, media_type=media_type)
+        self.path = path
+        self.start = start
+        self.count = end - start + 1
+        self.headers["content-length"] = str(self.count)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope.get("method") == "HEAD" or self.count == 0:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        fd = await run_in_threadpool(os.open, self.path, os.O_RDONLY)
+        try:
+            if ZEROCOPY_EXTENSION in scope.get("extensions", {}):
+                await send({"type": ZEROCOPY_EXTENSION, "file": fd, "offset": self.start,
+                            "count": self.count, "more_body": False})
+                return
+            offset = self.start
+            remaining = self.count
+            while remaining > 0:
+                chunk = await run_in_threadpool(os.pread, fd, min(CHUNK_SIZE, remaining), offset)
+                if not chunk:
+                    break
+                offset += len(chunk)
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            if remaining > 0:
+                # the file shrank under us, end the body instead of hanging
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            os.close(fd)
+
+
+def file_response(request: Request, path: str, filename: str, content_hash: str | None = None,
+                  media_type: str = "application/octet-stream") -> Response:
+    stat = os.stat(path)
+    etag = file_etag(stat, content_hash)
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat.st_mtime, usegmt=True),
+        "accept-ranges": "bytes",
+        "content-disposition": "attachment; filename*=utf-8''" + quote(filename),
+    }
+    if is_not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers={k: headers[k] for k in ("etag", "last-modified")})
+
+    size = stat.st_size
+    range_header = request.headers.get("range")
+    if range_header is not None and __range_applies(request, etag, stat.st_mtime):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={"content-range": "bytes */%d" % size,
+                                                      "accept-ranges": "bytes"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["content-range"] = "bytes %d-%d/%d" % (start, end, size)
+            return FileRangeResponse(path, start, end, status_code=206, headers=headers, media_type=media_type)
+    return FileRangeResponse(path, 0, size - 1, headers=headers, media_type=media_type)
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Event, Lock
+from typing import Callable
+
+import caff
+import preview
+
+# Single frames of a CAFF, decoded on request and kept encoded in memory.
+# Scrubbing through a viewer asks for the same few frames again and again,
+# so a small LRU bounded by bytes covers it without touching the disk.
+
+FORMATS = ("png", "webp")
+
+
+class FrameCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.__entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self.__size = 0
+        self.__lock = Lock()
+        self.__inflight: dict[tuple, Event] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def get_or_create(self, key: tuple, create: Callable[[], bytes]) -> bytes:
+        # key starts with the caff id, see discard. Concurrent misses for
+        # the same frame wait for one decode.
+        while True:
+            with self.__lock:
+                data = self.__entries.get(key)
+                if data is not None:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return data
+                event = self.__inflight.get(key)
+                if event is None:
+                    self.__inflight[key] = Event()
+                    self.misses += 1
+                    break
+            event.wait()
+
+        try:
+            data = create()
+            with self.__lock:
+                self.__entries[key] = data
+                self.__size += len(data)
+                # The newest entry is never evicted, even if it alone exceeds the limit
+                while self.__size > self.max_bytes and len(self.__entries) > 1:
+                    _, evicted = self.__entries.popitem(last=False)
+                    self.__size -= len(evicted)
+                    self.evicted += 1
+            return data
+        finally:
+            with self.__lock:
+                self.__inflight.pop(key).set()
+
+    def discard(self, caff_id: int):
+        with self.__lock:
+            for key in [key for key in self.__entries if key[0] == caff_id]:
+                self.__size -= len(self.__entries.pop(key))
+
+
+def render(source: str, index: int, max_size: int, format: str) -> bytes:
+    # Only the requested frame's pixels are read from the mapped file,
+    # the other frames are header parses
+    animations = caff.parse_file(source).animations
+    if index >= len(animations):
+        raise IndexError(index)
+    return preview.encode_still(animations[index], max_size, format.upper())
@@ -0,0 +1,198 @@
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from enum import Enum
+from threading import Lock
+from time import monotonic
+from typing import Callable
+from uuid import uuid4
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    PARSING = "parsing"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, user_id: str, future: Future):
+        self.id = str(uuid4())
+        self.user_id = user_id
+        self.future = future
+        self.created = monotonic()
+        self.finished = None
+
+    @property
+    def status(self) -> JobStatus:
+        if not self.future.done():
+            # The executor marks a call running once it is handed to a worker
+            return JobStatus.PARSING if self.future.running() else JobStatus.QUEUED
+        if self.future.cancelled() or self.future.exception() is not None:
+            return JobStatus.FAILED
+        return JobStatus.DONE
+
+    @property
+    def result(self):
+        if self.status == JobStatus.DONE:
+            return self.future.result()
+        return None
+
+    @property
+    def error(self) -> str | None:
+        if self.status != JobStatus.FAILED:
+            return None
+        if self.future.cancelled():
+            return "Job was cancelled"
+        return str(self.future.exception())
+
+
+class BatchFile:
+    # One file of a batch upload. Files that needed no parsing (rejected,
+    # already stored) carry their outcome, the rest point at their result in
+    # a group job.
+    def __init__(self, filename: str, job: Job | None = None, index: int = 0,
+                 caff_id: int | None = None, error: str | None = None):
+        self.filename = filename
+        self.job = job
+        self.index = index
+        self.__caff_id = caff_id
+        self.__error = error
+
+    @property
+    def status(self) -> JobStatus:
+        if self.job is None:
+            return JobStatus.FAILED if self.__error is not None else JobStatus.DONE
+        if self.job.status != JobStatus.DONE:
+            return self.job.status
+        result = self.job.result[self.index]
+        return JobStatus.FAILED if result.caff_id is None else JobStatus.DONE
+
+    @property
+    def caff_id(self) -> int | None:
+        if self.job is None:
+            return self.__caff_id
+        return self.job.result[self.index].caff_id if self.job.status == JobStatus.DONE else None
+
+    @property
+    def error(self) -> str | None:
+        if self.job is None:
+            return self.__error
+        if self.job.status == JobStatus.DONE:
+            return self.job.result[self.index].error
+        return self.job.error
+
+
+class Batch:
+    def __init__(self, user_id: str, files: list[BatchFile]):
+        self.id = str(uuid4())
+        self.user_id = user_id
+        self.files = files
+        self.created = monotonic()
+
+    @property
+    def finished(self) -> float | None:
+        jobs = [file.job for file in self.files if file.job is not None]
+        if any(job.finished is None for job in jobs):
+            return None
+        return max((job.finished for job in jobs), default=self.created)
+
+
+class JobQueue:
+    def __init__(self, max_workers: int, max_pending: int, keep_seconds: float = 3600,
+                 initializer: Callable | None = None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.keep_seconds = keep_seconds
+        self.initializer = initializer
+        self.__executor = None
+        self.__jobs: dict[str, Job] = {}
+        self.__batches: dict[str, Batch] = {}
+        self.__lock = Lock()
+
+    def __get_executor(self) -> ProcessPoolExecutor:
+        # Started lazily, so importing the app does not fork any workers
+        if self.__executor is None:
+            self.__executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=self.initializer)
+        return self.__executor
+
+    def __prune(self):
+        now = monotonic()
+        expired = [job_id for job_id, job in self.__jobs.items()
+                   if job.finished is not None and now - job.finished > self.keep_seconds]
+        for job_id in expired:
+            del self.__jobs[job_id]
+        expired = [batch_id for batch_id, batch in self.__batches.items()
+                   if batch.finished is not None and now - batch.finished > self.keep_seconds]
+        for batch_id in expired:
+            del self.__batches[batch_id]
+
+    def __count_pending(self) -> int:
+        return sum(1 for job in self.__jobs.values() if not job.future.done())
+
+    def pending(self) -> int:
+        with self.__lock:
+            return self.__count_pending()
+
+    def submit(self, user_id: str, fn: Callable, *args,
+               on_done: Callable[[Job], None] | None = None) -> Job:
+        with self.__lock:
+            self.__prune()
+            if self.__count_pending() >= self.max_pending:
+                raise QueueFullError()
+            job = Job(user_id, self.__submit(fn, *args))
+            self.__jobs[job.id] = job
+
+        def finish(_: Future):
+            job.finished = monotonic()
+            if on_done is not None:
+                on_done(job)
+
+        job.future.add_done_callback(finish)
+        return job
+
+    def __submit(self, fn: Callable, *args) -> Future:
+        # A worker that died (e.g. OOM killed) breaks the whole pool: its
+        # jobs fail, and the pool is replaced for the ones that follow
+        try:
+            return self.__get_executor().submit(fn, *args)
+        except BrokenProcessPool:
+            self.__executor.shutdown(wait=False)
+            self.__executor = None
+        try:
+            return self.__get_executor().submit(fn, *args)
+        except BrokenProcessPool as e:
+            raise QueueFullError("Upload workers are not available") from e
+
+    def completed(self, user_id: str, result) -> Job:
+        # A job that needed no work, e.g. an upload whose content is already stored
+        future = Future()
+        future.set_result(result)
+        job = Job(user_id, future)
+        job.finished = monotonic()
+        with self.__lock:
+            self.__prune()
+            self.__jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        with self.__lock:
+            return self.__jobs.get(job_id)
+
+    def add_batch(self, batch: Batch):
+        with self.__lock:
+            self.__prune()
+            self.__batches[batch.id] = batch
+
+    def get_batch(self, batch_id: str) -> Batch | None:
+        with self.__lock:
+            return self.__batches.get(batch_id)
+
+    def shutdown(self):
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+            self.__executor = None
@@ -0,0 +1,101 @@
+import asyncio
+from time import monotonic
+
+import requests
+from jose import jwk
+from jose.backends.base import Key
+from jose.constants import ALGORITHMS
+
+
+def jwks_url_for_realm(keycloak_realm_url: str) -> str:
+    return keycloak_realm_url.rstrip("/") + "/protocol/openid-connect/certs"
+
+
+class JWKS:
+    # Signing keys of the realm indexed by kid. Keys are fetched in the
+    # background, an unknown kid triggers one shared re-fetch.
+    def __init__(self, jwks_url: str, refresh_interval: int = 300, min_refetch_interval: int = 10,
+                 timeout: int = 3):
+        self.jwks_url = jwks_url
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.__keys: dict[str | None, Key] = {}
+        self.__last_fetch = None
+        self.__inflight: asyncio.Future | None = None
+        self.__refresher: asyncio.Task | None = None
+
+    def __download(self) -> dict:
+        r = requests.get(self.jwks_url, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    async def __fetch(self):
+        try:
+            response_json = await asyncio.to_thread(self.__download)
+        finally:
+            # Counted from when the download finished, so tokens that arrive
+            # while it runs wait for it instead of being refused by the interval
+            self.__last_fetch = monotonic()
+        keys = {}
+        for key in response_json.get("keys", []):
+            if key.get("use", "sig") != "sig" or key.get("alg", ALGORITHMS.RS256) != ALGORITHMS.RS256:
+                continue
+            keys[key.get("kid")] = jwk.construct(key, ALGORITHMS.RS256)
+        if not keys:
+            raise ValueError("No RS256 signing key in " + self.jwks_url)
+        self.__keys = keys
+
+    async def refresh(self):
+        # Single flight: concurrent callers wait on the same download
+        if self.__inflight is None or self.__inflight.done():
+            self.__inflight = asyncio.ensure_future(self.__fetch())
+        await asyncio.shield(self.__inflight)
+
+    async def get_key(self, kid: str | None) -> Key | None:
+        key = self.__lookup(kid)
+        if key is not None:
+            return key
+        # A fetch is already running, e.g. the one started on startup
+        if self.__inflight is not None and not self.__inflight.done():
+            try:
+                await asyncio.shield(self.__inflight)
+            except Exception as e:
+                print("Could not fetch JWKS:", e)
+            key = self.__lookup(kid)
+            if key is not None:
+                return key
+        # Unknown kid: the realm may have rotated its keys. The interval check
+        # keeps forged kids from turning every request into a download.
+        if self.__last_fetch is None or monotonic() - self.__last_fetch >= self.min_refetch_interval:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print("Could not fetch JWKS:", e)
+        return self.__lookup(kid)
+
+    def __lookup(self, kid: str | None) -> Key | None:
+        if kid is None and len(self.__keys) == 1:
+            return next(iter(self.__keys.values()))
+        return self.__keys.get(kid)
+
+    async def __refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                print("Could not refresh JWKS:", e)
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        if self.__refresher is None:
+            self.__refresher = asyncio.get_running_loop().create_task(self.__refresh_periodically())
+
+    async def stop(self):
+        if self.__refresher is not None:
+            self.__refresher.cancel()
+            try:
+                await self.__refresher
+            except asyncio.CancelledError:
+                pass
+            self.__refresher = None
@@ -1,32 +1,52 @@
-from datetime import datetime
+import asyncio
+from datetime import datetime, timedelta
 from enum import Enum
-from functools import lru_cache
-import subprocess
+from functools import lru_cache, partial
+from math import ceil
+from time import perf_counter
+from json import dumps
 
-from fastapi import Depends, FastAPI, HTTPException, File, UploadFile
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordBearer
+from audit import AuditLogWriter, prune_logs
+from cache import MemoryBackend, RedisBackend, ResponseCache, caff_tag
 from auth import Auth, Role, User
 
 from config import Settings
 
 from sqlalchemy.orm import Session
+import async_crud
 import crud
 import models
 import schemas
-from database import SessionLocal, engine
-
-from os import makedirs, listdir, remove
-from uuid import uuid4
-from json import load
-from re import match
-from PIL import Image
-from starlette.responses import FileResponse
-import shutil
+import database
+from database import AsyncSessionLocal, SessionLocal, engine
+import migrations
+import downloads
+import frames
+from frames import FrameCache
+from caff import CaffParseError, StreamValidator
+from jobs import Batch, BatchFile, Job, JobQueue, JobStatus, QueueFullError
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, STREAM_BATCH_SIZE, decode_cursor, page, stream_json
+import pipeline
+from reclaim import FileReclaimer
+import renditions
+import search
+from renditions import RenditionCache
+import store
+import telemetry
+import uploads
+
+from os import path
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 
 
 models.Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 
 
 def get_db():
@@ -42,18 +62,42 @@ def get_settings():
     return Settings()
 
 
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# Endpoints await db_crud the same way whichever engine serves them
+if get_settings().database_async:
+    get_request_db = get_async_db
+    db_crud = async_crud
+else:
+    get_request_db = get_db
+    db_crud = async_crud.blocking
+
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-auth = Auth(get_settings().keycloak_realm_url)
+auth = Auth(get_settings().keycloak_realm_url,
+            token_cache_size=get_settings().token_cache_size,
+            token_cache_ttl=get_settings().token_cache_ttl,
+            jwks_url=get_settings().keycloak_jwks_url,
+            jwks_refresh_interval=get_settings().jwks_refresh_interval)
+
+# Ids of users already known to be in the users table
+known_user_ids: set[str] = set()
 
 
 async def save_user(user: User, db: Session):
-    db_user = crud.get_user_by_userid(user.id, db)
+    if user.id in known_user_ids:
+        return
+    db_user = await db_crud.get_user_by_userid(user.id, db)
     if db_user is None:
-        db_user = crud.create_user(db=db, user=user)
-    return db_user
+        await db_crud.create_user(db=db, user=schemas.User(
+            user_id=user.id, username=user.name))
+    known_user_ids.add(user.id)
 
 
-async def get_session_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_session_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_request_db)):
     user = await auth.get_user(token)
     if user is None:
         raise HTTPException(
@@ -62,8 +106,59 @@ async def get_session_user(token: str = Depends(oauth2_scheme), db: Session = De
     return user
 
 app = FastAPI()
+app.add_middleware(telemetry.MetricsMiddleware)
+
+response_cache = ResponseCache(
+    MemoryBackend(get_settings().response_cache_size, get_settings().response_cache_ttl),
+    RedisBackend(get_settings().response_cache_url, get_settings().response_cache_ttl,
+                 get_settings().response_cache_timeout)
+    if get_settings().response_cache_url else None)
+
+upload_queue = JobQueue(max_workers=get_settings().upload_workers,
+                        max_pending=get_settings().upload_queue_size,
+                        initializer=pipeline.init_worker)
+
+
+@app.on_event("startup")
+async def start_key_refresh():
+    auth.keys.start()
+
+
+@app.on_event("shutdown")
+async def stop_key_refresh():
+    await auth.keys.stop()
+
+
+@app.on_event("shutdown")
+def shutdown_upload_queue():
+    upload_queue.shutdown()
+
+
+preview_cache = RenditionCache(get_settings().preview_cache_dir or pipeline.PREVIEW_PATH+'renditions',
+                               max_bytes=get_settings().preview_cache_size_mb * 1024 * 1024)
+
+frame_cache = FrameCache(max_bytes=get_settings().frame_cache_size_mb * 1024 * 1024)
+
+store_leases = store.Leases(pipeline.UPLOAD_PATH)
+
+
+def is_source_referenced(folder: str) -> bool:
+    db = SessionLocal()
+    try:
+        return crud.is_rawfile_referenced(folder+'/'+store.SOURCE_FILENAME, db)
+    finally:
+        db.close()
+
+
+reclaimer = FileReclaimer([pipeline.UPLOAD_PATH, pipeline.PREVIEW_PATH, preview_cache.root],
+                          store_leases, is_source_referenced)
+
+
+@app.on_event("shutdown")
+def stop_reclaimer():
+    reclaimer.stop()
 
-app.mount("/preview", StaticFiles(directory="../data/preview"), name="preview")
+app.mount("/preview", StaticFiles(directory=pipeline.PREVIEW_PATH), name="preview")
 
 origins = [
     get_settings().ui_url,
@@ -92,83 +187,329 @@ class Action(Enum):
     DELETE = "DELTED"
 
 
+audit_log = AuditLogWriter(SessionLocal, max_queue=get_settings().audit_queue_size,
+                           batch_size=get_settings().audit_batch_size,
+                           flush_interval=get_settings().audit_flush_interval)
+
+
+@app.on_event("shutdown")
+def flush_audit_log():
+    audit_log.stop()
+
+
+upload_queue_depth = telemetry.registry.gauge(
+    "caff_upload_queue_depth", "Upload jobs queued or parsing")
+audit_queue_depth = telemetry.registry.gauge(
+    "audit_log_queue_depth", "Audit records waiting to be written")
+audit_records = telemetry.registry.counter(
+    "audit_log_records_total", "Audit records by outcome", ("result",))
+reclaim_queue_depth = telemetry.registry.gauge(
+    "file_reclaim_queue_depth", "Deleted CAFF files waiting to be removed")
+cache_lookups = telemetry.registry.counter(
+    "cache_lookups_total", "Cache lookups by cache and outcome", ("cache", "result"))
+preview_cache_bytes = telemetry.registry.gauge(
+    "preview_cache_bytes", "Size of the preview rendition cache on disk")
+frame_cache_bytes = telemetry.registry.gauge(
+    "frame_cache_bytes", "Size of the encoded frames kept in memory")
+db_pool_checked_out = telemetry.registry.gauge(
+    "db_pool_checked_out", "Connections currently checked out", ("engine",))
+db_pool_events = telemetry.registry.counter(
+    "db_pool_events_total", "Checkout timeouts, saturated checkouts and disconnects", ("engine", "event"))
+db_checkout_duration = telemetry.registry.histogram(
+    "db_checkout_duration_seconds", "Time to get a usable connection from the pool", ("engine",))
+db_statement_duration = telemetry.registry.histogram(
+    "db_statement_duration_seconds", "Statement execution time", ("engine",))
+
+db_monitors = {"sync": database.monitor, "async": database.async_monitor}
+for name, monitor in db_monitors.items():
+    if monitor is not None:
+        db_checkout_duration.bind(monitor.checkout_wait, name)
+        db_statement_duration.bind(monitor.statements, name)
+
+
+@telemetry.registry.collector
+def collect_service_state():
+    upload_queue_depth.set(upload_queue.pending())
+    audit_queue_depth.set(audit_log.depth)
+    audit_records.labels("written").value = audit_log.written
+    audit_records.labels("dropped").value = audit_log.dropped
+    audit_records.labels("failed").value = audit_log.failed
+    reclaim_queue_depth.set(reclaimer.depth)
+    for cache, source in (("response", response_cache), ("preview", preview_cache), ("frame", frame_cache)):
+        cache_lookups.labels(cache, "hit").value = source.hits
+        cache_lookups.labels(cache, "miss").value = source.misses
+    preview_cache_bytes.set(preview_cache.size)
+    frame_cache_bytes.set(frame_cache.size)
+    for name, monitor in db_monitors.items():
+        if monitor is None:
+            continue
+        stats = monitor.snapshot()
+        db_pool_checked_out.labels(name).set(stats.get("checked_out", 0))
+        db_pool_events.labels(name, "checkout_timeout").value = monitor.checkout_timeouts
+        db_pool_events.labels(name, "saturated_checkout").value = monitor.saturated_checkouts
+        db_pool_events.labels(name, "disconnect").value = monitor.disconnects
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    # Unauthenticated like most exporters, keep it off the public ingress
+    return PlainTextResponse(telemetry.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+async def prune_logs_periodically():
+    settings = get_settings()
+    while True:
+        cutoff = datetime.now() - timedelta(days=settings.log_retention_days)
+        try:
+            pruned = await run_in_threadpool(prune_logs, SessionLocal, cutoff,
+                                             settings.log_prune_batch_size, settings.log_archive_dir)
+            if pruned:
+                print("Pruned", pruned, "logs older than", cutoff)
+        except Exception as e:
+            print("Could not prune logs:", e)
+        await asyncio.sleep(settings.log_retention_interval)
+
+
+@app.on_event("startup")
+async def start_log_retention():
+    # Retention is off unless LOG_RETENTION_DAYS is set
+    if get_settings().log_retention_days > 0:
+        asyncio.get_running_loop().create_task(prune_logs_periodically())
+
+
+@app.on_event("startup")
+async def start_search_backfill():
+    # CAFFs stored before the search index existed are indexed in the background
+    asyncio.get_running_loop().create_task(backfill_search_index())
+
+
+async def backfill_search_index():
+    try:
+        indexed = await run_in_threadpool(index_missing_search_terms)
+        if indexed:
+            print("Indexed", indexed, "caffs for search")
+            await response_cache.invalidate("caffs")
+    except Exception as e:
+        print("Could not build the search index:", e)
+
+
+def index_missing_search_terms() -> int:
+    db = SessionLocal()
+    try:
+        return crud.build_search_index(db, STREAM_BATCH_SIZE)
+    finally:
+        db.close()
+
+
+@app.on_event("startup")
+async def start_tag_migration():
+    # Databases from before the tags table still hold ';'-joined ciffs.tags
+    asyncio.get_running_loop().create_task(migrate_legacy_tags())
+
+
+async def migrate_legacy_tags():
+    try:
+        migrated = await run_in_threadpool(link_legacy_tags)
+        if migrated:
+            print("Migrated the tags of", migrated, "ciffs")
+            await response_cache.invalidate("caffs")
+    except Exception as e:
+        print("Could not migrate ciff tags:", e)
+
+
+def link_legacy_tags() -> int:
+    db = SessionLocal()
+    try:
+        return crud.migrate_legacy_tags(db, STREAM_BATCH_SIZE)
+    finally:
+        db.close()
+
+
 class Logger:
     template_msg = "User with ID %s %s %s %s."
 
-    def log(self, level: str, user_id: str, text: str = "", db: Session = Depends(get_db)):
-        crud.create_log(schemas.Log(level=level, text=text,
-                        date=datetime.now(), author_id=user_id), db=db)
+    def log(self, level: str, user_id: str, text: str = ""):
+        audit_log.submit(level, user_id, text, date=datetime.now())
 
 
-@app.get("/api/logs")
-async def get_logs(db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+def require_admin(user: User):
     if user == None:
         Logger.log(Logger, level="WARNING", user_id=user.id,
-                   text="User doesn't exist. with id"+user.id+".", db=db)
+                   text="User doesn't exist. with id"+user.id+".")
         raise HTTPException(status_code=401, detail="Invalid token")
 
     if user.role != Role.ADMIN:
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="User is not an ADMIN id:"+user.id+".", db=db)
+                   text="User is not an ADMIN id:"+user.id+".")
         raise HTTPException(status_code=403, detail="Forbidden")
 
-    logs = crud.get_logs(db)
-    ret_logs = []
-    for log in logs:
-        tmp_log = {"text": log.text, "level": log.level, "date": log.date}
-        ret_logs.append(tmp_log)
+
+def log_filter(level: str | None = None, author_id: str | None = None,
+               since: datetime | None = None, until: datetime | None = None):
+    return schemas.LogFilter(level=level, author_id=author_id, since=since, until=until)
+
+
+@app.get("/api/logs")
+async def get_logs(cursor: str | None = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), stream: bool = False, filters: schemas.LogFilter = Depends(log_filter), db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    require_admin(user)
+
+    if stream:
+        return StreamingResponse(stream_json(await db_crud.stream_logs(db, STREAM_BATCH_SIZE, filters), log_to_dict),
+                                 media_type="application/json")
+
+    before = None
+    if cursor is not None:
+        date, id = decode_cursor(cursor, 2)
+        try:
+            before = (datetime.fromisoformat(date), int(id))
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    logs = await db_crud.get_logs_page(db, limit + 1, before=before, filters=filters)
+    ret_logs = page(logs, limit, key=lambda log: (log.date, log.id))
+    ret_logs["items"] = [log_to_dict(log) for log in ret_logs["items"]]
     return ret_logs
 
 
+@app.get("/api/logs/stats")
+async def get_log_stats(filters: schemas.LogFilter = Depends(log_filter), db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    require_admin(user)
+    counts = await db_crud.count_logs_by_level_and_hour(db, filters)
+    return [{"hour": hour, "level": level, "count": count} for hour, level, count in counts]
+
+
+@app.get("/api/db/stats")
+async def get_database_stats(user: User = Depends(get_session_user)):
+    require_admin(user)
+    stats = {"sync": database.monitor.snapshot()}
+    if database.async_monitor is not None:
+        stats["async"] = database.async_monitor.snapshot()
+    return stats
+
+
+def log_to_dict(log: models.Log):
+    return {"text": log.text, "level": log.level, "date": log.date}
+
+
 @app.get("/api/users/me")
-async def get_user_id_by_username(user: User = Depends(get_session_user), db: Session = Depends(get_db)):
-    tmp_user = crud.get_user_by_userid(user_id=user.id, db=db)
+async def get_user_id_by_username(user: User = Depends(get_session_user), db: Session = Depends(get_request_db)):
+    tmp_user = await db_crud.get_user_by_userid(user_id=user.id, db=db)
     if (tmp_user == None):
         Logger.log(Logger, level="WARNING", user_id=user.id,
-                   text="User doesn't exist. with id"+user.id+".", db=db)
-        crud.create_user(schemas.User(user_id=str(user.id),
+                   text="User doesn't exist. with id"+user.id+".")
+        await db_crud.create_user(schemas.User(user_id=str(user.id),
                          username=str(user.name)), db=db)
     return user
 
 
+def json_bytes(content) -> bytes:
+    return dumps(jsonable_encoder(content)).encode()
+
+
+def json_response(body: bytes) -> Response:
+    return Response(content=body, media_type="application/json")
+
+
+class TagMatch(str, Enum):
+    ALL = "all"
+    ANY = "any"
+
+
+def caff_after_id(cursor: str | None):
+    if cursor is None:
+        return None
+    id, = decode_cursor(cursor, 1)
+    if not isinstance(id, int):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return id
+
+
 @app.get("/api")
-async def read_caffs(tag: str | None = None, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
-    if tag is None:
-        caffs = crud.get_caffs(db)
-        return caffs
-    caff_ids = crud.get_caff_ids_by_tag(tag, db)
-    ret: list = []
-    for x in caff_ids:
-        caff_id = vars(x)
-        caff = crud.get_caff_by_id(caff_id["collection_id"], db)
-        if caff not in ret:
-            ret.append(caff)
-    return ret
+async def read_caffs(tag: str | None = None, match: TagMatch = TagMatch.ALL, prefix: bool = False, cursor: str | None = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), stream: bool = False, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    # tag holds one or more ';' separated tags
+    tags = [t for t in tag.split(';') if t] if tag is not None else []
+    match_all = match == TagMatch.ALL
+    if stream:
+        return StreamingResponse(stream_json(await db_crud.stream_caffs(db, STREAM_BATCH_SIZE, tags, match_all, prefix)),
+                                 media_type="application/json")
+    after_id = caff_after_id(cursor)
+
+    async def render():
+        caffs = await db_crud.get_caffs_page(db, limit + 1, after_id=after_id,
+                                    tags=tags, match_all=match_all, prefix=prefix)
+        return json_bytes(page(caffs, limit, key=lambda caff: (caff.id,)))
+
+    params = {"tags": tags, "match_all": match_all, "prefix": prefix, "after_id": after_id, "limit": limit}
+    return json_response(await response_cache.get_or_render("caffs", params, ["caffs"], render))
+
+
+def caff_with_comments(caff: models.Caff):
+    element = dict(vars(caff))
+    element["comments"] = list(caff.comments)
+    return element
 
 
 @app.get("/api/")
-async def read_caffs_with_comments(db: Session = Depends(get_db), user: User = Depends(get_session_user)):
-    caffs = crud.get_caffs(db)
-    ret: list = []
-    for x in caffs:
-        comments: list = crud.get_comments_by_collection_id(x.id, db=db)
-        element = vars(x)
-        element["comments"] = []
-        element["comments"] += comments
-        ret.append(element)
-    return ret
+async def read_caffs_with_comments(cursor: str | None = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), stream: bool = False, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    if stream:
+        return StreamingResponse(stream_json(await db_crud.iter_caffs_with_comments(db, STREAM_BATCH_SIZE), caff_with_comments),
+                                 media_type="application/json")
+    after_id = caff_after_id(cursor)
+
+    async def render():
+        caffs = await db_crud.get_caffs_page(db, limit + 1, after_id=after_id, with_comments=True)
+        ret = page(caffs, limit, key=lambda caff: (caff.id,))
+        ret["items"] = [caff_with_comments(x) for x in ret["items"]]
+        return json_bytes(ret)
+
+    params = {"after_id": after_id, "limit": limit}
+    return json_response(await response_cache.get_or_render("caffs_with_comments", params, ["caffs", "comments"],
+                                                            render))
+
+
+def search_offset(cursor: str | None) -> int:
+    if cursor is None:
+        return 0
+    offset, = decode_cursor(cursor, 1)
+    if not isinstance(offset, int) or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return offset
+
+
+@app.get("/api/search")
+async def search_catalog(q: str = Query(..., min_length=1, max_length=256), match: TagMatch = TagMatch.ALL, cursor: str | None = None, limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE), db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    # Words of creators, captions and comments, best match first. Ranked
+    # pages are addressed by offset, the cursor holds the next one.
+    terms = search.query_terms(q)
+    match_all = match == TagMatch.ALL
+    offset = search_offset(cursor)
+
+    async def render():
+        results = await db_crud.search_caffs(db, terms, match_all, limit + 1, offset)
+        ret = page(results, limit, key=lambda _: (offset + limit,))
+        ret["items"] = [dict(vars(caff), score=score) for caff, score in ret["items"]]
+        return json_bytes(ret)
+
+    params = {"terms": terms, "match_all": match_all, "offset": offset, "limit": limit}
+    return json_response(await response_cache.get_or_render("search", params, ["caffs", "comments"], render))
 
 
 @app.get("/api/{caff_id}")
-async def read_caff_by_id_with_comments(caff_id: int, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
-    caff = crud.get_caff_by_id(caff_id, db=db)
+async def read_caff_by_id_with_comments(caff_id: int, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    return json_response(await response_cache.get_or_render("caff", {"id": caff_id}, [caff_tag(caff_id)],
+                                                            lambda: render_caff_with_comments(caff_id, db)))
+
+
+async def render_caff_with_comments(caff_id: int, db: Session):
+    caff = await db_crud.get_caff_by_id_with_comments(caff_id, db=db)
     if (caff == None):
         raise HTTPException(
             status_code=400, detail="There is not a Caff with id: "+str(caff_id))
-    comments = crud.get_comments_by_collection_id(collection_id=caff_id, db=db)
+    comments = caff.comments
+    authors = await db_crud.get_users_by_userids(
+        [comment.author_id for comment in comments], db=db)
     comment_dict = []
     for comment in comments:
-        author = crud.get_user_by_userid(db=db, user_id=comment.author_id)
+        author = authors.get(comment.author_id)
         if (author == None):
             username = "Anonymus"
         else:
@@ -176,195 +517,428 @@ async def read_caff_by_id_with_comments(caff_id: int, db: Session = Depends(get_
         comment_element = {"text": comment.text, "username": username,
                            "date": comment.date, "id": comment.id}
         comment_dict.append(comment_element)
-    caff_dict = vars(caff)
-    caff_dict["comments"] = []
-    caff_dict["comments"] += comment_dict
-    return caff_dict
+    caff_dict = dict(vars(caff))
+    caff_dict["comments"] = comment_dict
+    return json_bytes(caff_dict)
 
 
 @app.post("/api/{caff_id}/comments")
-async def create_comment_to_caff(caff_id: int, comment: schemas.CommentBase, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+async def create_comment_to_caff(caff_id: int, comment: schemas.CommentBase, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
     Logger.log(Logger, level="INFO", user_id=user.id,
-               text="User added comment with the text of: "+comment.text+".", db=db)
-    caff = crud.get_caff_by_id(caff_id, db=db)
+               text="User added comment with the text of: "+comment.text+".")
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
     comment.author_id = user.id
     if (caff == None):
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="User added comment, but CAFF doesnt exists with id: "+caff_id+".", db=db)
+                   text="User added comment, but CAFF doesnt exists with id: "+caff_id+".")
         raise HTTPException(
             status_code=400, detail="There is not a Caff with id: "+str(caff_id))
-    return crud.create_comment(db=db, comment=comment, collection_id=caff_id)
+    created = await db_crud.create_comment(db=db, comment=comment, collection_id=caff_id)
+    await response_cache.invalidate("comments", caff_tag(caff_id))
+    return created
 
 
 @app.get("/download_caff/{caff_id}", response_class=FileResponse)
-async def download_caff(caff_id: int, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+async def download_caff(caff_id: int, request: Request, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
     Logger.log(Logger, level="INFO", user_id=user.id,
-               text="User downloads CAFF with id:"+str(caff_id)+".", db=db)
-    caff = crud.get_caff_by_id(caff_id, db=db)
+               text="User downloads CAFF with id:"+str(caff_id)+".")
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
     if (caff == None):
         Logger.log(Logger, level="ERROR", user_id=user.id, text="User downloads CAFF with id:" +
-                   str(caff_id)+", but CAFF not exists with the ID listed.", db=db)
+                   str(caff_id)+", but CAFF not exists with the ID listed.")
         raise HTTPException(
             status_code=400, detail="There is not a Caff with id: "+str(caff_id))
     filename = caff.rawfile.split('/')[-1]
-    return FileResponse(caff.rawfile, filename=filename)
+    return downloads.file_response(request, caff.rawfile, filename=filename, content_hash=caff.content_hash)
+
+
+@app.get("/previews/{caff_id}/{content_hash}/{rendition}")
+async def get_preview(caff_id: int, content_hash: str, rendition: str, request: Request, db: Session = Depends(get_request_db)):
+    # Public like the /preview mount: gallery tiles are plain <img> requests.
+    # The URL names the content, so it can be cached for good.
+    caff = await preview_caff(caff_id, rendition, db)
+    if caff.content_hash != content_hash:
+        raise HTTPException(
+            status_code=404, detail="There is not a Caff with id: "+str(caff_id)+" and hash: "+content_hash)
+    return await render_preview(caff, rendition, request, "public, max-age=31536000, immutable")
+
+
+@app.get("/previews/{caff_id}/{rendition}")
+async def get_preview_by_id(caff_id: int, rendition: str, request: Request, db: Session = Depends(get_request_db)):
+    # For CAFFs stored before content hashes. An id can be reused by another
+    # CAFF, so caches must revalidate.
+    caff = await preview_caff(caff_id, rendition, db)
+    return await render_preview(caff, rendition, request, "public, max-age=60, must-revalidate")
+
+
+async def preview_caff(caff_id: int, rendition: str, db: Session) -> models.Caff:
+    if rendition not in renditions.RENDITIONS:
+        raise HTTPException(status_code=404, detail="Unknown preview rendition: "+rendition)
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
+    if caff is None:
+        raise HTTPException(
+            status_code=404, detail="There is not a Caff with id: "+str(caff_id))
+    return caff
+
+
+async def render_preview(caff: models.Caff, rendition: str, request: Request, cache_control: str) -> Response:
+    kind = renditions.RENDITIONS[rendition]
+    format = renditions.negotiate(kind, request.headers.get("accept"))
+    max_size = kind.max_size or get_settings().preview_size
+    etag = renditions.etag(caff.id, caff.content_hash, kind, max_size, format)
+    headers = {"etag": etag, "cache-control": cache_control, "vary": "Accept"}
+    # Renditions have no modification time, only the ETag validates them
+    if downloads.etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    name = renditions.file_name(caff.id, caff.content_hash, kind, max_size, format)
+    source = caff.rawfile
+    try:
+        data = await run_in_threadpool(preview_cache.get_or_create, name,
+                                       lambda target: renditions.render(source, kind, format, target, max_size))
+    except (OSError, CaffParseError) as e:
+        print("Could not render preview", name, e)
+        raise HTTPException(status_code=500, detail="Preview is not available")
+    return Response(content=data, media_type=renditions.MEDIA_TYPES[format], headers=headers)
+
+
+@app.get("/api/{caff_id}/frames/{n}")
+async def get_frame(caff_id: int, n: int, request: Request, size: int | None = Query(None, ge=16, le=4096), format: str | None = None, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    # Frame n (from 0) decoded from the stored source, scaled to fit size.
+    # format is png or webp, by default negotiated from Accept.
+    if format is not None and format not in frames.FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported frame format: "+format)
+    if n < 0:
+        raise HTTPException(status_code=404, detail="There is not a frame: "+str(n))
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
+    if caff is None:
+        raise HTTPException(
+            status_code=400, detail="There is not a Caff with id: "+str(caff_id))
+    format = format or renditions.negotiate(renditions.STILL, request.headers.get("accept"))
+    max_size = size or get_settings().preview_size
+    etag = f'"{caff.content_hash or caff.id}-frame-{n}-{max_size}-{format}"'
+    # The URL names the id, which can be reused by another CAFF: caches
+    # revalidate, and get a 304 while the content is the same
+    headers = {"etag": etag, "cache-control": "private, max-age=60, must-revalidate", "vary": "Accept"}
+    if downloads.etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    source = caff.rawfile
+    try:
+        data = await run_in_threadpool(frame_cache.get_or_create, (caff.id, caff.content_hash, n, max_size, format),
+                                       lambda: frames.render(source, n, max_size, format))
+    except IndexError:
+        raise HTTPException(status_code=404, detail="There is not a frame: "+str(n))
+    except (OSError, CaffParseError) as e:
+        print("Could not render frame", caff_id, n, e)
+        raise HTTPException(status_code=500, detail="Frame is not available")
+    return Response(content=data, media_type=renditions.MEDIA_TYPES[format], headers=headers)
 
 
 @app.put("/api/{caff_id}/comments/{comment_id}")
-async def update_comment_by_id(caff_id: int, comment_id: int, comment: schemas.CommentUpdate, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+async def update_comment_by_id(caff_id: int, comment_id: int, comment: schemas.CommentUpdate, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
     if (user.role != Role.ADMIN):
         Logger.log(Logger, level="WARNING", user_id=user.id,
-                   text="User tries to edit comment, but is not an ADMIN. user_id:"+user.id+".", db=db)
+                   text="User tries to edit comment, but is not an ADMIN. user_id:"+user.id+".")
         raise HTTPException(
             status_code=403, detail="ADMIN only functionality")
-    caff = crud.get_caff_by_id(caff_id, db=db)
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
     if (caff == None):
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="User downloads CAFF with id:"+str(caff_id)+", but CAFF doesnt exists.", db=db)
+                   text="User downloads CAFF with id:"+str(caff_id)+", but CAFF doesnt exists.")
         raise HTTPException(
             status_code=400, detail="There is not a Caff with id: "+str(caff_id))
-    comment_ret = crud.get_comment_by_id(comment_id, db)
+    comment_ret = await db_crud.get_comment_by_id(comment_id, db)
     if (comment_ret == None):
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="User tries to edit comment, but does not exists. Given Comment.id:"+comment_id+".", db=db)
+                   text="User tries to edit comment, but does not exists. Given Comment.id:"+comment_id+".")
         raise HTTPException(
             status_code=400, detail="There is not a comment with id: "+str(comment_id))
     edited_comment = comment_ret
     edited_comment.text = comment.text
-    comment_updated = crud.update_comment_by_id(
+    comment_updated = await db_crud.update_comment_by_id(
         comment_id=comment_id, comment=edited_comment, db=db)
+    await response_cache.invalidate("comments", caff_tag(caff_id))
     return comment_updated
 
 
 @app.delete("/api/{caff_id}")
-async def delete_caff_by_id(caff_id: int, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+async def delete_caff_by_id(caff_id: int, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
     if (user.role != Role.ADMIN):
         Logger.log(Logger, level="WARNING", user_id=user.id,
-                   text="User tries to delete CAFF, but is not an ADMIN. user_id:"+user.id+".", db=db)
+                   text="User tries to delete CAFF, but is not an ADMIN. user_id:"+user.id+".")
         raise HTTPException(
             status_code=403, detail="ADMIN only functionality")
-    caff = crud.get_caff_by_id(caff_id, db=db)
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
     if (caff == None):
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="User tries to delete CAFF with id:"+str(caff_id)+", but CAFF doesnt exists.", db=db)
+                   text="User tries to delete CAFF with id:"+str(caff_id)+", but CAFF doesnt exists.")
         raise HTTPException(
             status_code=400, detail="There is not a Caff with id: "+str(caff_id))
-    is_successful = crud.delete_caff_by_id(caff_id, db)
+    rawfile = caff.rawfile
+    is_successful = await db_crud.delete_caff_by_id(caff_id, db)
     if not is_successful:
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="Could not delete Caff with id: "+str(caff_id), db=db)
+                   text="Could not delete Caff with id: "+str(caff_id))
         raise HTTPException(
             status_code=400, detail="Could not delete Caff with id: "+str(caff_id))
+    await response_cache.invalidate("caffs", "comments", caff_tag(caff_id))
+    reclaimer.submit(pipeline.PREVIEW_PATH+str(caff_id)+'.gif', *preview_cache.discard(caff_id))
+    frame_cache.discard(caff_id)
+    # Kept by the reclaimer while other CAFFs or uploads of the same content use it
+    reclaimer.submit(path.dirname(rawfile))
 
 
 @app.delete("/api/{caff_id}/comments/{comment_id}")
-async def delete_comment_by_id(caff_id: int, comment_id: int, db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+async def delete_comment_by_id(caff_id: int, comment_id: int, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
     if (user.role != Role.ADMIN):
         Logger.log(Logger, "WARNING", user.id,
-                   "User tries to delete comment, but is not an ADMIN. User.id:"+user.id, db=db)
+                   "User tries to delete comment, but is not an ADMIN. User.id:"+user.id)
         raise HTTPException(
             status_code=403, detail="ADMIN only functionality")
-    caff = crud.get_caff_by_id(caff_id, db=db)
+    caff = await db_crud.get_caff_by_id(caff_id, db=db)
     if (caff == None):
         Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="User tries to delete comment for Caff.id:"+str(caff_id)+", but CAFF doesnt exists.", db=db)
+                   text="User tries to delete comment for Caff.id:"+str(caff_id)+", but CAFF doesnt exists.")
         raise HTTPException(
             status_code=400, detail="There is not a Caff with id: "+str(caff_id))
-    comment = crud.get_comment_by_id(comment_id, db)
+    comment = await db_crud.get_comment_by_id(comment_id, db)
     if (comment == None):
         Logger.log(Logger, level="ERROR", user_id=user.id, text="User tries to delete comment for Caff.id:" +
-                   str(caff_id)+", but comment doesnt exists.", db=db)
+                   str(caff_id)+", but comment doesnt exists.")
         raise HTTPException(
             status_code=400, detail="There is not a comment with id: "+str(comment_id))
-    return crud.delete_comment_by_id(comment_id, db)
+    deleted = await db_crud.delete_comment_by_id(comment_id, db)
+    await response_cache.invalidate("comments", caff_tag(caff_id))
+    return deleted
 
 
 @app.post("/upload_file")
-async def create_upload_file(file: UploadFile = File(...), db: Session = Depends(get_db), user: User = Depends(get_session_user)):
+async def create_upload_file(request: Request, response: Response, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
     Logger.log(Logger, "INFO", user_id=user.id,
-               text="User tries to upload file", db=db)
-    if not file:
-        Logger.log(Logger, level="ERROR", user_id=user.id,
-                   text="Given data is not a file", db=db)
-        return {"message": "No upload file sent"}
-    else:
-        if allowed_file(file.filename) == True:
-            folder_id = str(uuid4())
-            folder = "/caff/data/out/"+folder_id
-            filename_with_extension = "source.caff"
-            makedirs(folder)
-            with open(f'{folder}/{filename_with_extension}', 'wb')as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            parse_caff(db=db, filename=filename_with_extension,
-                       dir=folder, user_id=user.id)
-            return {"message": "Uploaded successfully"}
-        else:
+               text="User tries to upload file")
+    start = perf_counter()
+    try:
+        received = await uploads.receive_file(request, "file", pipeline.UPLOAD_PATH, allowed_file, upload_validator)
+    except uploads.UploadRejected as e:
+        telemetry.uploads.labels(e.reason).inc()
+        if e.reason == "extension":
             Logger.log(Logger, level="ERROR", user_id=user.id,
-                       text="Incorrect file extension: not .caff.", db=db)
+                       text="Incorrect file extension: not .caff.")
             return {"message": "Illegal file extension"}
+        Logger.log(Logger, level="ERROR", user_id=user.id,
+                   text="Upload rejected while streaming: "+e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    if received is None:
+        Logger.log(Logger, level="ERROR", user_id=user.id,
+                   text="Given data is not a file")
+        return {"message": "No upload file sent"}
+    telemetry.upload_stage_duration.labels("disk_write").observe(perf_counter() - start)
+    telemetry.upload_bytes.inc(received.size)
+    digest, tmp_path = received.digest, received.tmp_path
+    existing = await db_crud.get_caff_by_content_hash(digest, db)
+    if existing is not None:
+        # Same content as an earlier upload: reuse its metadata and preview
+        store.discard(tmp_path)
+        telemetry.uploads.labels("deduplicated").inc()
+        job = upload_queue.completed(user.id, pipeline.UploadResult(existing.id, {}))
+        response.status_code = 202
+        return {"message": "Upload accepted", "job_id": job.id}
+    folder = await run_in_threadpool(store_leases.place, tmp_path, digest)
+    try:
+        job = upload_queue.submit(user.id, pipeline.process_upload, store.SOURCE_FILENAME, folder, digest,
+                                  on_done=partial(finish_upload, folder))
+    except QueueFullError:
+        telemetry.uploads.labels("rejected").inc()
+        release_uploads([folder], failed=[folder])
+        Logger.log(Logger, level="WARNING", user_id=user.id,
+                   text="Upload rejected, the upload queue is full.")
+        raise HTTPException(
+            status_code=503, detail="Too many uploads in progress, try again later")
+    response.status_code = 202
+    return {"message": "Upload accepted", "job_id": job.id}
 
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
+def release_uploads(folders: list[str], failed: list[str]):
+    # Placed uploads whose job has finished or never got queued. The folders
+    # of the failed ones are removed unless a CAFF or upload still uses them.
+    for folder in folders:
+        store_leases.release(folder)
+    if failed:
+        reclaimer.submit(*failed)
 
-def parse_caff(db: Session, filename: str, dir: str, user_id: str):
-    preview_path = '/caff/data/preview/'
 
-    args = ["/caff/parser/caff_parser", dir+'/'+filename,
-            dir]
+def upload_validator(filename: str) -> StreamValidator:
+    return StreamValidator(get_settings().upload_max_frames, get_settings().upload_max_frame_pixels,
+                           get_settings().upload_max_bytes)
 
-    cmd = " ".join(args)
 
-    output = subprocess.run(cmd, shell=True)
+@app.post("/upload_batch", response_model=schemas.Batch, status_code=202)
+async def create_upload_batch(request: Request, db: Session = Depends(get_request_db), user: User = Depends(get_session_user)):
+    # Many .caff files, or zip/tar archives of them, in the "files" field.
+    # Each file is validated on its own and reported in the batch status.
+    Logger.log(Logger, "INFO", user_id=user.id,
+               text="User tries to upload a batch")
+    max_files = get_settings().upload_batch_max_files
+    try:
+        received = await uploads.receive_files(request, "files", pipeline.UPLOAD_PATH, allowed_batch_file,
+                                               batch_validator, max_files)
+    except uploads.UploadRejected as e:
+        telemetry.uploads.labels(e.reason).inc()
+        Logger.log(Logger, level="ERROR", user_id=user.id,
+                   text="Batch upload rejected: "+e.detail)
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+
+    files = []
+    # What archives may unpack to: upload_batch_max_files and
+    # upload_batch_max_bytes, less the other files of the request, wherever
+    # they come in it
+    unpack_files = max_files - sum(1 for item in received if not uploads.is_archive(item.filename))
+    unpack_budget = get_settings().upload_batch_max_bytes - sum(
+        item.size for item in received if isinstance(item, uploads.ReceivedFile) and not uploads.is_archive(item.filename))
+    for item in received:
+        if isinstance(item, uploads.ReceivedFile) and uploads.is_archive(item.filename):
+            try:
+                extracted = await run_in_threadpool(uploads.extract_archive, item.tmp_path, pipeline.UPLOAD_PATH,
+                                                    upload_validator, unpack_files, unpack_budget)
+                unpack_files -= len(extracted)
+                unpack_budget -= sum(file.size for file in extracted if isinstance(file, uploads.ReceivedFile))
+                files.extend(extracted)
+            except uploads.UploadRejected as e:
+                files.append(uploads.RejectedFile(item.filename, e))
+            finally:
+                store.discard(item.tmp_path)
+        else:
+            files.append(item)
 
-    if output.returncode != 0:
-        remove("/caff/backend/data/"+filename)
-        Logger.log(Logger, "ERROR", user_id,
-                   "Couldn't parse caff file.", db=db)
+    batch = Batch(user.id, await submit_batch(user.id, files, db))
+    upload_queue.add_batch(batch)
+    Logger.log(Logger, "INFO", user_id=user.id,
+               text="Batch "+batch.id+" accepted with "+str(len(files))+" files")
+    return batch_schema(batch)
+
+
+async def submit_batch(user_id: str, files: list, db) -> list[BatchFile]:
+    batch_files: list[BatchFile | None] = [None] * len(files)
+    received = [(i, file) for i, file in enumerate(files) if isinstance(file, uploads.ReceivedFile)]
+    existing = await db_crud.get_caff_ids_by_content_hashes(list({file.digest for _, file in received}), db)
+    first: dict[str, int] = {}
+    new = []
+    for i, file in enumerate(files):
+        if isinstance(file, uploads.RejectedFile):
+            telemetry.uploads.labels(file.error.reason).inc()
+            batch_files[i] = BatchFile(file.filename, error=file.error.detail)
+        elif file.digest in existing:
+            store.discard(file.tmp_path)
+            telemetry.uploads.labels("deduplicated").inc()
+            batch_files[i] = BatchFile(file.filename, caff_id=existing[file.digest])
+        elif file.digest in first:
+            # Repeated within the batch, filled in from the first copy below
+            store.discard(file.tmp_path)
+            telemetry.uploads.labels("deduplicated").inc()
+        else:
+            first[file.digest] = i
+            new.append((i, file))
+
+    # Small batches are still spread over every worker
+    group_size = max(1, min(get_settings().upload_batch_group_size, ceil(len(new) / upload_queue.max_workers)))
+    for start in range(0, len(new), group_size):
+        group = new[start:start + group_size]
+        entries = []
+        for _, file in group:
+            folder = await run_in_threadpool(store_leases.place, file.tmp_path, file.digest)
+            entries.append(pipeline.BatchEntry(store.SOURCE_FILENAME, folder, file.digest))
+        try:
+            job = upload_queue.submit(user_id, pipeline.process_batch, entries,
+                                      on_done=partial(finish_batch_group, entries))
+        except QueueFullError:
+            telemetry.uploads.labels("rejected").inc(len(new) - start)
+            folders = [entry.dir for entry in entries]
+            release_uploads(folders, failed=folders)
+            for _, file in new[start + len(group):]:
+                store.discard(file.tmp_path)
+            for i, file in new[start:]:
+                batch_files[i] = BatchFile(file.filename, error="Too many uploads in progress, try again later")
+            break
+        for index, (i, file) in enumerate(group):
+            batch_files[i] = BatchFile(file.filename, job, index)
+
+    for i, file in received:
+        if batch_files[i] is None:
+            copy = batch_files[first[file.digest]]
+            batch_files[i] = BatchFile(file.filename, copy.job, copy.index, copy.caff_id, copy.error)
+    return batch_files
+
+
+def batch_schema(batch: Batch) -> schemas.Batch:
+    return schemas.Batch(id=batch.id, files=[
+        schemas.BatchFile(filename=file.filename, status=file.status.value,
+                          job_id=file.job.id if file.job is not None else None,
+                          caff_id=file.caff_id, error=file.error) for file in batch.files])
+
+
+@app.get("/batches/{batch_id}", response_model=schemas.Batch)
+async def get_batch(batch_id: str, user: User = Depends(get_session_user)):
+    batch = upload_queue.get_batch(batch_id)
+    if batch is None or (batch.user_id != user.id and user.role != Role.ADMIN):
         raise HTTPException(
-            status_code=422, detail="The content of the uploaded file did not fit the CAFF file format. Upload did not complete.")
-
-    f = open(dir+"/metadata.json", "r")
-    metadata = load(f)
-    f.close()
-
-    year = metadata["credits"]["year"]
-    day = metadata["credits"]["day"]
-    hour = metadata["credits"]["hour"]
-    month = metadata["credits"]["month"]
-    creator = metadata["credits"]["creator"]
-    creator_len = len(creator)
-
-    animations = metadata["animation"]
+            status_code=404, detail="There is not a batch with id: "+batch_id)
+    return batch_schema(batch)
 
-    caff = crud.create_caff(db=db, caff=schemas.CaffBase(year=year, month=month, day=day,
-                            hour=hour, minute=-1, creatorlen=creator_len, creator=creator, rawfile=dir+'/'+filename))
 
-    for i in animations:
-        duration = i["duration"]
-        width = i["width"]
-        height = i["height"]
-        caption = i["caption"]
-        tags = ';'.join(i["tags"])
-        crud.create_ciff(db=db, ciff=schemas.CiffCreate(width=width, height=height,
-                         collection_id=caff.id, duration=duration, caption=caption, tags=tags))
-
-    create_preview_gif(caff.id, preview_path, dir+'/')
-
-
-def create_preview_gif(caff_id, preview_path, gen_path):
-    files = listdir(gen_path)
+@app.get("/jobs/{job_id}", response_model=schemas.Job)
+async def get_job(job_id: str, user: User = Depends(get_session_user)):
+    job = upload_queue.get(job_id)
+    if job is None or (job.user_id != user.id and user.role != Role.ADMIN):
+        raise HTTPException(
+            status_code=404, detail="There is not a job with id: "+job_id)
+    return schemas.Job(id=job.id, status=job.status.value, caff_id=job.result.caff_id if job.result is not None else None, error=job.error)
 
-    tgas = []
 
-    preview_names = "preview\d\d*.tga"
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-    for filename in files:
-        if match(preview_names, filename):
-            tga = Image.open(gen_path + filename)
-            tgas.append(tga)
 
-    preview_filepath = preview_path + str(caff_id) + '.gif'
-    tgas[0].save(preview_filepath, save_all=True,
-                 append_images=tgas[1:], optimize=False, duration=1000, loop=0)
+def allowed_batch_file(filename):
+    return allowed_file(filename) or uploads.is_archive(filename)
+
+
+def batch_validator(filename: str):
+    # Archives are only capped here, their members are validated once extracted
+    if uploads.is_archive(filename):
+        return uploads.SizeLimit(get_settings().upload_batch_max_bytes)
+    return upload_validator(filename)
+
+
+def finish_batch_group(entries: list[pipeline.BatchEntry], job: Job):
+    folders = [entry.dir for entry in entries]
+    if job.status == JobStatus.FAILED:
+        release_uploads(folders, failed=folders)
+        telemetry.uploads.labels("failed").inc(len(entries))
+        Logger.log(Logger, "ERROR", job.user_id,
+                   "Couldn't parse batch of "+str(len(entries))+" caff files: "+job.error)
+        return
+    release_uploads(folders, failed=[entry.dir for entry, result in zip(entries, job.result) if result.caff_id is None])
+    for result in job.result:
+        if result.caff_id is None:
+            telemetry.uploads.labels("failed").inc()
+            Logger.log(Logger, "ERROR", job.user_id,
+                       "Couldn't parse caff file: "+result.error)
+            continue
+        telemetry.uploads.labels("parsed").inc()
+        for stage, seconds in result.stages.items():
+            telemetry.upload_stage_duration.labels(stage).observe(seconds)
+    response_cache.bump("caffs")
+
+
+def finish_upload(folder: str, job: Job):
+    release_uploads([folder], failed=[folder] if job.status == JobStatus.FAILED else [])
+    if job.status == JobStatus.FAILED:
+        telemetry.uploads.labels("failed").inc()
+        Logger.log(Logger, "ERROR", job.user_id,
+                   "Couldn't parse caff file: "+job.error)
+    else:
+        telemetry.uploads.labels("parsed").inc()
+        for stage, seconds in job.result.stages.items():
+            telemetry.upload_stage_duration.labels(stage).observe(seconds)
+        response_cache.bump("caffs")
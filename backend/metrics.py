@@ -0,0 +1,167 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Iterable
+
+# In-process counters, gauges and histograms rendered in the Prometheus
+# text format. Every update is a lock plus an integer or float add, cheap
+# enough to stay on in production.
+
+# Latency buckets in seconds, upper bounds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0.0
+        self.__lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self.__lock:
+            self.value += amount
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        yield f"{name}{labels} {format_value(self.value)}"
+
+
+class Gauge:
+    def __init__(self):
+        self.value = 0.0
+        self.__lock = Lock()
+
+    def inc(self, amount: float = 1):
+        with self.__lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        with self.__lock:
+            self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        yield f"{name}{labels} {format_value(self.value)}"
+
+
+class Histogram:
+    # Per-bucket counts plus sum and max, cheap enough to observe on every
+    # statement
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.__counts = [0] * (len(buckets) + 1)
+        self.__sum = 0.0
+        self.__max = 0.0
+        self.__lock = Lock()
+
+    def observe(self, value: float):
+        with self.__lock:
+            self.__counts[bisect_left(self.buckets, value)] += 1
+            self.__sum += value
+            if value > self.__max:
+                self.__max = value
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            counts = list(self.__counts)
+            total, maximum = self.__sum, self.__max
+        return {"buckets": dict(zip([*map(str, self.buckets), "+Inf"], counts)),
+                "count": sum(counts), "sum": total, "max": maximum}
+
+    def samples(self, name: str, labels: str) -> Iterable[str]:
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum
+        inner = labels[1:-1] + "," if labels else ""
+        cumulative = 0
+        for bound, count in zip([*map(format_value, self.buckets), "+Inf"], counts):
+            cumulative += count
+            yield f'{name}_bucket{{{inner}le="{bound}"}} {cumulative}'
+        yield f"{name}_sum{labels} {format_value(total)}"
+        yield f"{name}_count{labels} {cumulative}"
+
+
+def format_value(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metric:
+    # A named family of children, one per label value combination
+    def __init__(self, name: str, help: str, kind: type, labelnames: tuple[str, ...] = (), **kwargs):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = labelnames
+        self.kwargs = kwargs
+        self.__children: dict[tuple, object] = {}
+        self.__lock = Lock()
+        if not labelnames:
+            self.__children[()] = kind(**kwargs)
+
+    def labels(self, *values) -> Counter | Gauge | Histogram:
+        child = self.__children.get(values)
+        if child is None:
+            with self.__lock:
+                child = self.__children.setdefault(values, self.kind(**self.kwargs))
+        return child
+
+    def bind(self, child: Counter | Gauge | Histogram, *values) -> Counter | Gauge | Histogram:
+        # Exports an instance kept elsewhere, e.g. the database monitor histograms
+        with self.__lock:
+            self.__children[values] = child
+        return child
+
+    def __getattr__(self, name: str):
+        # An unlabelled metric is used like its only child: metric.inc()
+        return getattr(self.__children[()], name)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind.__name__.lower()}"
+        for values, child in list(self.__children.items()):
+            labels = ""
+            if values:
+                labels = "{" + ",".join(f'{label}="{escape(value)}"'
+                                        for label, value in zip(self.labelnames, values)) + "}"
+            yield from child.samples(self.name, labels)
+
+
+class Registry:
+    def __init__(self):
+        self.__metrics: list[Metric] = []
+        self.__collectors: list[Callable[[], None]] = []
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Metric:
+        return self.__add(Metric(name, help, Counter, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Metric:
+        return self.__add(Metric(name, help, Gauge, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Metric:
+        return self.__add(Metric(name, help, Histogram, labelnames, buckets=buckets))
+
+    def __add(self, metric: Metric) -> Metric:
+        self.__metrics.append(metric)
+        return metric
+
+    def collector(self, fn: Callable[[], None]):
+        # Runs before every scrape, for gauges that mirror state kept elsewhere
+        self.__collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for collect in self.__collectors:
+            try:
+                collect()
+            except Exception as e:
+                print("Metrics collector failed:", e)
+        lines = []
+        for metric in self.__metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
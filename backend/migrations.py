@@ -0,0 +1,124 @@
+from sqlalchemy import Column, MetaData, Table, inspect, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.schema import CreateColumn
+
+from database import Base
+
+# create_all only creates missing tables. These bring the tables of an
+# existing database up to the models; every step checks the live schema
+# first, so running them on an up to date database does nothing.
+
+
+def add_missing_columns(engine: Engine):
+    # New columns are nullable (e.g. caffs.content_hash), existing rows get NULL
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    quote = engine.dialect.identifier_preparer.quote
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                print("Adding column", column.name, "to", table.name)
+                with engine.begin() as conn:
+                    conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} ADD COLUMN "
+                                         f"{CreateColumn(column).compile(dialect=engine.dialect)}")
+
+
+def create_missing_indexes(engine: Engine):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for index in table.indexes:
+            if index.name not in existing and all(column.name in columns for column in index.columns):
+                # Can take a while on a large table, e.g. the audit log
+                print("Creating index", index.name, "on", table.name)
+                index.create(engine)
+
+
+def __missing_cascades(inspector, table: Table) -> list[tuple[dict, object]]:
+    # (live foreign key, model constraint) pairs whose ON DELETE differs
+    live = {tuple(fk["constrained_columns"]): fk for fk in inspector.get_foreign_keys(table.name)}
+    missing = []
+    for constraint in table.foreign_key_constraints:
+        fk = live.get(tuple(constraint.column_keys))
+        if constraint.ondelete and fk is not None and \
+                (fk["options"].get("ondelete") or "").upper() != constraint.ondelete.upper():
+            missing.append((fk, constraint))
+    return missing
+
+
+def __alter_foreign_keys(engine: Engine, table: Table, missing: list[tuple[dict, object]]):
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as conn:
+        for fk, constraint in missing:
+            columns = ", ".join(quote(c) for c in fk["constrained_columns"])
+            referred = ", ".join(quote(c) for c in fk["referred_columns"])
+            conn.exec_driver_sql(f"ALTER TABLE {quote(table.name)} DROP FOREIGN KEY {quote(fk['name'])}")
+            conn.exec_driver_sql(
+                f"ALTER TABLE {quote(table.name)} ADD CONSTRAINT {quote(fk['name'])} FOREIGN KEY ({columns}) "
+                f"REFERENCES {quote(fk['referred_table'])} ({referred}) ON DELETE {constraint.ondelete}")
+
+
+def __rebuild_sqlite_table(engine: Engine, inspector, table: Table):
+    # SQLite cannot alter a constraint: the table is copied into one created
+    # from the model, then swapped in. Columns the model no longer maps
+    # (ciffs.tags) are carried over for their own migrations.
+    live = inspector.get_columns(table.name)
+    temporary = table.name + "_migrating"
+    # The foreign keys of the copy resolve against copies of the other tables
+    metadata = MetaData()
+    for other in Base.metadata.sorted_tables:
+        if other is not table:
+            other.to_metadata(metadata)
+    rebuilt = table.to_metadata(metadata, name=temporary)
+    rebuilt.indexes.clear()
+    for column in live:
+        if column["name"] not in table.c:
+            rebuilt.append_column(Column(column["name"], column["type"]))
+    names = [column["name"] for column in live]
+    source = Table(table.name, MetaData(), *(Column(name) for name in names))
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.connect() as conn:
+        # Only takes effect outside a transaction
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        try:
+            with conn.begin():
+                # Left over by an interrupted rebuild
+                conn.exec_driver_sql(f"DROP TABLE IF EXISTS {quote(temporary)}")
+                rebuilt.create(conn)
+                conn.execute(rebuilt.insert().from_select(names, select(*source.c)))
+                conn.exec_driver_sql(f"DROP TABLE {quote(table.name)}")
+                conn.exec_driver_sql(f"ALTER TABLE {quote(temporary)} RENAME TO {quote(table.name)}")
+                for index in table.indexes:
+                    index.create(conn)
+        finally:
+            conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+
+def add_missing_cascades(engine: Engine):
+    # The ON DELETE CASCADE of ciffs and comments, on tables created before it
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        missing = __missing_cascades(inspector, table)
+        if not missing:
+            continue
+        print("Adding ON DELETE cascades to", table.name)
+        if engine.dialect.name == "sqlite":
+            __rebuild_sqlite_table(engine, inspector, table)
+        else:
+            __alter_foreign_keys(engine, table, missing)
+
+
+def upgrade(engine: Engine):
+    add_missing_columns(engine)
+    add_missing_cascades(engine)
+    create_missing_indexes(engine)
@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Text, Date, DateTime
+from sqlalchemy import Boolean, Column, Float, ForeignKey, Index, Integer, String, Table, Text, Date, DateTime
 from sqlalchemy.orm import relationship
 
 from database import Base
@@ -16,9 +16,10 @@ class Caff(Base):
     creatorLen = Column(Integer)
     creator = Column(String(256))
     rawfile = Column(Text, nullable=False)
+    content_hash = Column(String(64), index=True)
 
-    animations = relationship("Ciff", back_populates="collection")
-    comments = relationship("Comment", back_populates="collection")
+    animations = relationship("Ciff", back_populates="collection", passive_deletes=True)
+    comments = relationship("Comment", back_populates="collection", passive_deletes=True)
 
 
 class Ciff(Base):
@@ -29,10 +30,27 @@ class Ciff(Base):
     width = Column(Integer, nullable=False)
     height = Column(Integer, nullable=False)
     caption = Column(Text)
-    collection_id = Column(Integer, ForeignKey("caffs.id"), nullable=False)
-    tags = Column(String(256))
+    collection_id = Column(Integer, ForeignKey("caffs.id", ondelete="CASCADE"), nullable=False)
 
     collection = relationship("Caff", back_populates="animations")
+    tags = relationship("Tag", secondary="ciff_tags", back_populates="ciffs")
+
+
+ciff_tags = Table(
+    "ciff_tags",
+    Base.metadata,
+    Column("ciff_id", Integer, ForeignKey("ciffs.id", ondelete="CASCADE"), primary_key=True),
+    Column("tag_id", Integer, ForeignKey("tags.id", ondelete="CASCADE"), primary_key=True, index=True),
+)
+
+
+class Tag(Base):
+    __tablename__ = "tags"
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String(256), unique=True, index=True, nullable=False)
+
+    ciffs = relationship("Ciff", secondary="ciff_tags", back_populates="tags")
 
 
 class Comment(Base):
@@ -42,11 +60,31 @@ class Comment(Base):
     text = Column(Text)
     author_id = Column(String(256))
     date = Column(Date)
-    collection_id = Column(Integer, ForeignKey("caffs.id"), nullable=False)
+    collection_id = Column(Integer, ForeignKey("caffs.id", ondelete="CASCADE"), nullable=False)
 
     collection = relationship("Caff", back_populates="comments")
 
 
+class SearchTerm(Base):
+    # Inverted index for /api/search: one row per term of a creator, caption
+    # or comment. source_id is the id of the CAFF, CIFF or comment the text
+    # belongs to, so a single comment can be reindexed.
+    __tablename__ = "search_terms"
+
+    id = Column(Integer, primary_key=True)
+    term = Column(String(64), nullable=False)
+    field = Column(String(16), nullable=False)
+    source_id = Column(Integer, nullable=False)
+    weight = Column(Float, nullable=False)
+    caff_id = Column(Integer, ForeignKey("caffs.id", ondelete="CASCADE"), nullable=False)
+
+    __table_args__ = (
+        Index("ix_search_terms_term_caff", "term", "caff_id"),
+        Index("ix_search_terms_source", "field", "source_id"),
+        Index("ix_search_terms_caff", "caff_id"),
+    )
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -62,3 +100,8 @@ class Log(Base):
     text = Column(Text, nullable=False)
     date = Column(DateTime)
     author_id = Column(String(256), index=True, nullable=False)
+
+    __table_args__ = (
+        Index("ix_logs_date", "date"),
+        Index("ix_logs_level_date", "level", "date"),
+    )
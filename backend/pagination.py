@@ -0,0 +1,63 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from json import dumps, loads
+from typing import AsyncIterable, Callable, Iterable
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+# Rows fetched per round-trip when streaming
+STREAM_BATCH_SIZE = 500
+
+
+def encode_cursor(*values) -> str:
+    raw = dumps(jsonable_encoder(list(values)), separators=(",", ":"))
+    return urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, length: int) -> list:
+    try:
+        values = loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != length:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def page(rows: list, limit: int, key: Callable) -> dict:
+    # The query asks for limit + 1 rows, the extra one only signals a next page
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(*key(rows[-1]))
+    return {"items": rows, "next_cursor": next_cursor}
+
+
+def stream_json(rows: Iterable | AsyncIterable, encode: Callable | None = None):
+    if isinstance(rows, AsyncIterable):
+        return __stream_json_async(rows, encode)
+    return __stream_json(rows, encode)
+
+
+def __stream_json(rows: Iterable, encode: Callable | None):
+    yield "["
+    first = True
+    for row in rows:
+        if encode is not None:
+            row = encode(row)
+        yield ("" if first else ",") + dumps(jsonable_encoder(row))
+        first = False
+    yield "]"
+
+
+async def __stream_json_async(rows: AsyncIterable, encode: Callable | None):
+    yield "["
+    first = True
+    async for row in rows:
+        if encode is not None:
+            row = encode(row)
+        yield ("" if first else ",") + dumps(jsonable_encoder(row))
+        first = False
+    yield "]"
@@ -0,0 +1,164 @@
+from time import perf_counter
+from typing import NamedTuple
+
+import caff as caff_parser
+import crud
+import preview
+import schemas
+from config import Settings
+from database import SessionLocal, engine
+
+# Everything in here runs inside the upload worker processes (see jobs.py),
+# so it must not import main: that would build the app and fetch the realm keys
+# again in every worker.
+
+settings = Settings()
+
+UPLOAD_PATH = settings.upload_path
+PREVIEW_PATH = settings.preview_path
+
+
+def init_worker():
+    # Pooled connections inherited from the parent process must not be reused
+    engine.dispose(close=False)
+
+
+class UploadResult(NamedTuple):
+    caff_id: int
+    # Seconds spent in each stage, measured in the worker and reported back
+    # to the API process with the result
+    stages: dict[str, float]
+
+
+def process_upload(filename: str, dir: str, content_hash: str | None = None) -> UploadResult:
+    db = SessionLocal()
+    try:
+        if content_hash is not None:
+            # An identical upload may have been parsed while this one was queued
+            existing = crud.get_caff_by_content_hash(content_hash, db)
+            if existing is not None:
+                return UploadResult(existing.id, {})
+        stages = {}
+        caff_id = parse_caff(db=db, filename=filename, dir=dir, content_hash=content_hash, stages=stages)
+        return UploadResult(caff_id, stages)
+    finally:
+        db.close()
+
+
+def parse_caff(db, filename: str, dir: str, content_hash: str | None = None,
+               stages: dict[str, float] | None = None) -> int:
+    stages = stages if stages is not None else {}
+    caff_row, ciff_rows, animations = read_caff(filename, dir, content_hash, stages)
+
+    start = perf_counter()
+    caff = crud.ingest_caff(db=db, caff=caff_row, ciffs=ciff_rows)
+    stages["db_insert"] = perf_counter() - start
+
+    start = perf_counter()
+    create_preview_gif(caff.id, PREVIEW_PATH, animations)
+    stages["preview"] = perf_counter() - start
+    return caff.id
+
+
+def read_caff(filename: str, dir: str, content_hash: str | None, stages: dict[str, float]):
+    start = perf_counter()
+    # A file that does not parse is left in place: the folder may be shared
+    # with an identical upload, the app reclaims it once the job has failed
+    parsed = caff_parser.parse_file(dir+'/'+filename)
+    stages["parse"] = perf_counter() - start
+
+    start = perf_counter()
+    caff_row, ciff_rows = caff_rows(parsed, dir+'/'+filename, content_hash)
+    stages["metadata"] = perf_counter() - start
+    return caff_row, ciff_rows, parsed.animations
+
+
+def caff_rows(parsed: caff_parser.ParsedCaff, rawfile: str, content_hash: str | None):
+    # What the native parser wrote to metadata.json, read off the parse result
+    credits = parsed.credits
+    creator_len = len(credits.creator)
+    caff_row = schemas.CaffBase(year=credits.year, month=credits.month, day=credits.day,
+                                hour=credits.hour, minute=credits.minute, creatorlen=creator_len, creator=credits.creator,
+                                rawfile=rawfile, content_hash=content_hash)
+    ciff_rows = [schemas.CiffIngest(width=i.width, height=i.height, duration=i.duration,
+                                    caption=i.caption, tags=i.tags) for i in parsed.animations]
+    return caff_row, ciff_rows
+
+
+class BatchEntry(NamedTuple):
+    filename: str
+    dir: str
+    content_hash: str
+
+
+class BatchFileResult(NamedTuple):
+    caff_id: int | None
+    error: str | None
+    stages: dict[str, float]
+
+
+def process_batch(entries: list[BatchEntry]) -> list[BatchFileResult]:
+    # One group of a batch upload. The files are parsed one after the other in
+    # this worker, the groups run in parallel on the pool. All CAFFs of the
+    # group are inserted in one transaction, then previewed.
+    db = SessionLocal()
+    try:
+        existing = crud.get_caff_ids_by_content_hashes([entry.content_hash for entry in entries], db)
+        results: list[BatchFileResult | None] = [None] * len(entries)
+        parsed = []
+        for i, entry in enumerate(entries):
+            if entry.content_hash in existing:
+                results[i] = BatchFileResult(existing[entry.content_hash], None, {})
+                continue
+            stages = {}
+            try:
+                caff_row, ciff_rows, animations = read_caff(entry.filename, entry.dir, entry.content_hash, stages)
+            except caff_parser.CaffParseError as e:
+                results[i] = BatchFileResult(None, str(e), {})
+                continue
+            parsed.append((i, caff_row, ciff_rows, animations, stages))
+
+        start = perf_counter()
+        caff_ids = ingest_group(db, [(caff_row, ciff_rows) for _, caff_row, ciff_rows, _, _ in parsed])
+        # The transaction is shared, each file is charged an equal part of it
+        db_insert = (perf_counter() - start) / max(len(parsed), 1)
+
+        for (i, _, _, animations, stages), caff_id in zip(parsed, caff_ids):
+            if isinstance(caff_id, str):
+                results[i] = BatchFileResult(None, caff_id, {})
+                continue
+            stages["db_insert"] = db_insert
+            start = perf_counter()
+            try:
+                create_preview_gif(caff_id, PREVIEW_PATH, animations)
+            except Exception as e:
+                results[i] = BatchFileResult(caff_id, "Preview failed: "+str(e), stages)
+                continue
+            stages["preview"] = perf_counter() - start
+            results[i] = BatchFileResult(caff_id, None, stages)
+        return results
+    finally:
+        db.close()
+
+
+def ingest_group(db, items: list) -> list[int | str]:
+    # The new id, or the error message, for every item
+    if not items:
+        return []
+    try:
+        return crud.ingest_caffs(db, items)
+    except Exception as e:
+        print("Grouped insert failed, inserting one by one:", e)
+    # One bad file must not fail the rest of its group
+    caff_ids = []
+    for caff_row, ciff_rows in items:
+        try:
+            caff_ids.append(crud.ingest_caff(db=db, caff=caff_row, ciffs=ciff_rows).id)
+        except Exception as e:
+            caff_ids.append(str(e))
+    return caff_ids
+
+
+def create_preview_gif(caff_id, preview_path, animations):
+    preview_filepath = preview_path + str(caff_id) + '.gif'
+    preview.render_gif(animations, preview_filepath, settings.preview_size)
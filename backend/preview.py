@@ -0,0 +1,96 @@
+from io import BytesIO
+from os import replace
+
+import numpy as np
+from PIL import GifImagePlugin, Image
+
+from caff import CaffAnimation
+
+# Frames sampled to build the palette every preview frame is quantized to
+PALETTE_SAMPLES = 4
+# Output rows averaged per step, keeps the float buffer small for huge frames
+BAND_ROWS = 32
+
+
+def thumbnail_size(width: int, height: int, max_size: int) -> tuple[int, int, int]:
+    # Integer box filter factor, so every output pixel averages factor*factor pixels
+    factor = max(1, -(-max(width, height) // max_size))
+    return max(1, width // factor), max(1, height // factor), factor
+
+
+def downscale(animation: CaffAnimation, max_size: int) -> np.ndarray:
+    width, height = animation.width, animation.height
+    # Zero-copy view over the (memory mapped) CIFF pixels
+    pixels = np.frombuffer(animation.pixels, dtype=np.uint8).reshape(height, width, 3)
+    out_width, out_height, factor = thumbnail_size(width, height, max_size)
+    if factor == 1:
+        return pixels.copy()
+
+    out = np.empty((out_height, out_width, 3), dtype=np.uint8)
+    for top in range(0, out_height, BAND_ROWS):
+        bottom = min(top + BAND_ROWS, out_height)
+        band = pixels[top * factor:bottom * factor, :out_width * factor]
+        band = band.reshape(bottom - top, factor, out_width, factor, 3)
+        out[top:bottom] = band.mean(axis=(1, 3), dtype=np.float32).round().astype(np.uint8)
+    return out
+
+
+def shared_palette(animations: list[CaffAnimation], max_size: int) -> Image.Image:
+    count = min(PALETTE_SAMPLES, len(animations))
+    step = len(animations) / count
+    samples = [downscale(animations[int(i * step)], max_size) for i in range(count)]
+    width = min(sample.shape[1] for sample in samples)
+    sheet = np.concatenate([sample[:, :width] for sample in samples])
+    return Image.fromarray(sheet, "RGB").quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+
+
+def render_gif(animations: list[CaffAnimation], path: str, max_size: int):
+    palette = shared_palette(animations, max_size)
+    canvas = None
+    tmp_path = path + ".tmp"
+
+    with open(tmp_path, "wb") as out:
+        for animation in animations:
+            frame = Image.fromarray(downscale(animation, max_size), "RGB")
+            if canvas is None:
+                canvas = frame.size
+            elif frame.size != canvas:
+                frame = frame.resize(canvas, Image.Resampling.BOX)
+            frame = frame.quantize(palette=palette, dither=Image.Dither.NONE)
+
+            if out.tell() == 0:
+                header, _ = GifImagePlugin.getheader(frame, info={"loop": 0})
+                for chunk in header:
+                    out.write(chunk)
+            for chunk in GifImagePlugin.getdata(frame, duration=animation.duration):
+                out.write(chunk)
+        out.write(b";")
+
+    replace(tmp_path, path)
+
+
+def render_still(animation: CaffAnimation, path: str, max_size: int, format: str):
+    tmp_path = path + ".tmp"
+    Image.fromarray(downscale(animation, max_size), "RGB").save(tmp_path, format=format)
+    replace(tmp_path, path)
+
+
+def encode_still(animation: CaffAnimation, max_size: int, format: str) -> bytes:
+    out = BytesIO()
+    Image.fromarray(downscale(animation, max_size), "RGB").save(out, format=format)
+    return out.getvalue()
+
+
+def render_webp(animations: list[CaffAnimation], path: str, max_size: int):
+    # WebP frames are true colour, so no shared palette is needed
+    frames = []
+    for animation in animations:
+        frame = Image.fromarray(downscale(animation, max_size), "RGB")
+        if frames and frame.size != frames[0].size:
+            frame = frame.resize(frames[0].size, Image.Resampling.BOX)
+        frames.append(frame)
+
+    tmp_path = path + ".tmp"
+    frames[0].save(tmp_path, format="WEBP", save_all=True, append_images=frames[1:],
+                   duration=[animation.duration for animation in animations], loop=0, quality=80)
+    replace(tmp_path, path)
@@ -0,0 +1,90 @@
+from os import path, remove
+from queue import Queue
+from shutil import rmtree
+from threading import Lock, Thread
+from typing import Callable
+
+from store import Leases
+
+
+class FileReclaimer:
+    # Removes on-disk artifacts of deleted CAFFs in a background thread,
+    # so the delete request only pays for the SQL.
+    def __init__(self, roots: list[str], leases: Leases | None = None,
+                 is_referenced: Callable[[str], bool] | None = None):
+        # Nothing outside these directories is ever removed
+        self.roots = [path.realpath(root) for root in roots]
+        # Folders of the store are shared by identical uploads, they are
+        # checked again right before they are removed
+        self.leases = leases
+        self.is_referenced = is_referenced
+        self.__queue: Queue = Queue()
+        self.__thread: Thread | None = None
+        self.__lock = Lock()
+        self.reclaimed = 0
+        self.failed = 0
+
+    @property
+    def depth(self) -> int:
+        return self.__queue.qsize()
+
+    def submit(self, *paths: str):
+        self.start()
+        for p in paths:
+            self.__queue.put(p)
+
+    def start(self):
+        if self.__thread is not None:
+            return
+        with self.__lock:
+            if self.__thread is None:
+                self.__thread = Thread(target=self.__run, name="file-reclaimer", daemon=True)
+                self.__thread.start()
+
+    def stop(self, timeout: float | None = 10):
+        thread = self.__thread
+        if thread is None:
+            return
+        self.__queue.put(None)
+        thread.join(timeout)
+        self.__thread = None
+
+    def __is_allowed(self, p: str) -> bool:
+        real = path.realpath(p)
+        return any(real != root and path.commonpath([real, root]) == root for root in self.roots)
+
+    def __reclaim(self, p: str):
+        if not self.__is_allowed(p):
+            print("Refusing to reclaim path outside the data store:", p)
+            self.failed += 1
+            return
+        if self.leases is None or not self.leases.covers(p):
+            self.__remove(p)
+            return
+        with self.leases.lock(p):
+            try:
+                in_use = self.leases.is_leased(p) or (self.is_referenced is not None and self.is_referenced(p))
+            except Exception as e:
+                print("Could not check if", p, "is in use", e)
+                self.failed += 1
+                return
+            if not in_use:
+                self.__remove(p)
+
+    def __remove(self, p: str):
+        try:
+            if path.isdir(p):
+                rmtree(p)
+            elif path.exists(p):
+                remove(p)
+            self.reclaimed += 1
+        except OSError as e:
+            print("Could not reclaim", p, e)
+            self.failed += 1
+
+    def __run(self):
+        while True:
+            p = self.__queue.get()
+            if p is None:
+                return
+            self.__reclaim(p)
@@ -0,0 +1,204 @@
+"""Rebuilds the caffs/ciffs rows from the upload store.
+
+Walks <store>/*/source.caff in name order and reads only the credits and
+animation headers of every file (caff.read_metadata). The pixels are never
+decoded and no previews are written, /previews renders them on demand.
+Folders named by their SHA-256 are matched to their rows by that hash.
+Uploads from before content addressing, in <uuid4> folders, are hashed;
+they are matched by rawfile and get their hash recorded.
+Worker processes read groups of files in parallel, and each group is
+inserted in one transaction. After every group the last finished directory
+is written to the checkpoint file, so an interrupted run continues where it
+stopped.
+
+Rows change behind the running API's back. After every group the response
+cache tags are bumped through Redis (RESPONSE_CACHE_URL); API instances
+with only the in-memory cache keep serving the old /api and /api/search
+pages until they are restarted or RESPONSE_CACHE_TTL passes. The legacy
+<id>.gif previews of newly assigned ids are removed, as they may belong to
+another CAFF of an earlier database.
+
+    python reindex.py --workers 8 --checkpoint reindex.json
+    python reindex.py --refresh    # also rewrite rows that already exist
+"""
+import argparse
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from json import dump, load
+from string import hexdigits
+
+import caff as caff_parser
+import crud
+import migrations
+import models
+import pipeline
+import store
+from cache import MemoryBackend, RedisBackend, ResponseCache, caff_tag
+from database import SessionLocal, engine, settings
+
+GROUP_SIZE = 256
+REPORT_INTERVAL = 5.0
+
+
+def is_content_hash(name: str) -> bool:
+    return len(name) == 64 and all(c in hexdigits for c in name)
+
+
+def list_store(root: str, after: str | None) -> list[str]:
+    # Every folder holding a source, the .incoming temporaries are skipped
+    names = sorted(entry.name for entry in os.scandir(root)
+                   if entry.is_dir() and not entry.name.startswith(".")
+                   and os.path.isfile(os.path.join(entry.path, store.SOURCE_FILENAME)))
+    if after is not None:
+        names = [name for name in names if name > after]
+    return names
+
+
+def read_group(root: str, names: list[str]) -> list[tuple]:
+    # Runs in the workers: (name, caff row, ciff rows) or (name, error)
+    rows = []
+    for name in names:
+        rawfile = os.path.join(root, name)+'/'+store.SOURCE_FILENAME
+        try:
+            parsed = caff_parser.read_metadata(rawfile)
+            content_hash = name if is_content_hash(name) else store.file_digest(rawfile)
+        except (caff_parser.CaffParseError, OSError) as e:
+            rows.append((name, str(e)))
+            continue
+        rows.append((name, *pipeline.caff_rows(parsed, rawfile, content_hash)))
+    return rows
+
+
+def read_in_order(executor: Executor, root: str, groups: list[list[str]], window: int):
+    # Keeps `window` groups in flight and yields them in store order, so the
+    # checkpoint only ever moves past groups that are fully written and
+    # results never pile up faster than the database takes them
+    pending = deque()
+    for group in groups:
+        pending.append((group, executor.submit(read_group, root, group)))
+        if len(pending) >= window:
+            group, future = pending.popleft()
+            yield group, future.result()
+    while pending:
+        group, future = pending.popleft()
+        yield group, future.result()
+
+
+def write_group(rows: list[tuple], refresh: bool) -> tuple[list[int], list[int], int]:
+    # Returns the ids inserted and refreshed (or given their missing hash),
+    # and how many rows were left alone. A file's own row is found by its
+    # rawfile. A file whose content is stored elsewhere is left alone.
+    db = SessionLocal()
+    try:
+        by_rawfile = crud.get_caffs_by_rawfiles([caff_row.rawfile for _, caff_row, _ in rows], db)
+        by_hash = crud.get_caff_ids_by_content_hashes([caff_row.content_hash for _, caff_row, _ in rows], db)
+        new, stored, duplicates = [], [], 0
+        for _, caff_row, ciff_rows in rows:
+            if caff_row.rawfile in by_rawfile:
+                stored.append((by_rawfile[caff_row.rawfile][0], caff_row, ciff_rows))
+            elif caff_row.content_hash in by_hash:
+                duplicates += 1
+            else:
+                new.append((caff_row, ciff_rows))
+                # Another folder of the group may hold the same content
+                by_hash[caff_row.content_hash] = None
+        inserted = crud.ingest_caffs(db, new) if new else []
+        missing = {caff_row.rawfile: caff_row.content_hash for _, caff_row, _ in rows
+                   if caff_row.rawfile in by_rawfile and by_rawfile[caff_row.rawfile][1] is None}
+        hashed = crud.set_missing_content_hashes(db, missing) if missing else []
+        if refresh and stored:
+            crud.refresh_caffs(db, stored)
+            return inserted, sorted(set(hashed) | {caff_id for caff_id, _, _ in stored}), duplicates
+        return inserted, hashed, len(stored) + duplicates - len(missing)
+    finally:
+        db.close()
+
+
+def response_cache() -> ResponseCache:
+    # Only a shared backend reaches the running API instances
+    shared = RedisBackend(settings.response_cache_url, settings.response_cache_ttl, settings.response_cache_timeout) \
+        if settings.response_cache_url else None
+    return ResponseCache(MemoryBackend(1, settings.response_cache_ttl), shared)
+
+
+def invalidate(cache: ResponseCache, inserted: list[int], refreshed: list[int]):
+    if inserted or refreshed:
+        cache.bump("caffs", "comments", *(caff_tag(caff_id) for caff_id in inserted + refreshed))
+    for caff_id in inserted:
+        store.discard(pipeline.PREVIEW_PATH + str(caff_id) + '.gif')
+
+
+def load_checkpoint(path: str | None) -> dict:
+    if path is None or not os.path.exists(path):
+        return {"after": None, "files": 0, "inserted": 0, "refreshed": 0, "skipped": 0, "errors": 0}
+    with open(path) as f:
+        return load(f)
+
+
+def save_checkpoint(path: str | None, state: dict):
+    if path is None:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        dump(state, f)
+    os.replace(tmp, path)
+
+
+def report(state: dict, files: int, elapsed: float, final: bool = False):
+    rate = files / elapsed if elapsed > 0 else 0.0
+    print(f"{'done' if final else 'progress'}: {state['files']} files, {rate:.1f} files/s, "
+          f"{state['inserted']} inserted, {state['refreshed']} refreshed, {state['skipped']} skipped, "
+          f"{state['errors']} errors", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--store", default=pipeline.UPLOAD_PATH)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--group-size", type=int, default=GROUP_SIZE)
+    parser.add_argument("--checkpoint", default=None, help="JSON file to resume from and update")
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and walk the whole store")
+    parser.add_argument("--refresh", action="store_true", help="rewrite the rows of CAFFs already in the database")
+    args = parser.parse_args()
+
+    # The same schema upgrade as the API's startup, for databases it has not run on yet
+    models.Base.metadata.create_all(bind=engine)
+    migrations.upgrade(engine)
+    state = load_checkpoint(None if args.restart else args.checkpoint)
+    names = list_store(args.store, state["after"])
+    groups = [names[i:i + args.group_size] for i in range(0, len(names), args.group_size)]
+    print(f"{len(names)} files to read", "after " + state["after"] if state["after"] else "", file=sys.stderr)
+
+    cache = response_cache()
+    if cache.shared is None:
+        print("RESPONSE_CACHE_URL is not set: restart the API, or its cached pages stay stale for up to "
+              f"{settings.response_cache_ttl}s", file=sys.stderr)
+    start = last_report = time.perf_counter()
+    files = 0
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=pipeline.init_worker) as executor:
+        for group, rows in read_in_order(executor, args.store, groups, window=args.workers * 2):
+            for name, error in (row for row in rows if len(row) == 2):
+                print(f"{name}: {error}", file=sys.stderr)
+            parsed = [row for row in rows if len(row) == 3]
+            inserted, refreshed, skipped = write_group(parsed, args.refresh)
+            invalidate(cache, inserted, refreshed)
+            state["after"] = group[-1]
+            state["files"] += len(group)
+            state["inserted"] += len(inserted)
+            state["refreshed"] += len(refreshed)
+            state["skipped"] += skipped
+            state["errors"] += len(rows) - len(parsed)
+            save_checkpoint(args.checkpoint, state)
+            files += len(group)
+            now = time.perf_counter()
+            if now - last_report >= REPORT_INTERVAL:
+                report(state, files, now - start)
+                last_report = now
+    report(state, files, time.perf_counter() - start, final=True)
+
+
+if __name__ == "__main__":
+    main()
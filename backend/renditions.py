@@ -0,0 +1,188 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from os import listdir, makedirs, path, remove, stat
+from threading import Event, Lock
+from typing import Callable
+
+import caff
+import preview
+
+# Preview renditions of a CAFF, rendered on first request and kept in a
+# size-bounded disk cache. Ids are not stable (SQLite reuses them after a
+# delete, a reindex into a new database assigns new ones), so a rendition
+# is only immutable under its content hash.
+
+
+@dataclass(frozen=True)
+class Rendition:
+    name: str
+    animated: bool
+    # max_size None means the configured preview size
+    max_size: int | None = None
+
+
+# Sized for the gallery tiles
+THUMB = Rendition("thumb", animated=False, max_size=256)
+STILL = Rendition("still", animated=False)
+ANIMATED = Rendition("animated", animated=True)
+
+RENDITIONS = {r.name: r for r in (THUMB, STILL, ANIMATED)}
+
+MEDIA_TYPES = {"webp": "image/webp", "png": "image/png", "gif": "image/gif"}
+
+
+def __accepted(accept: str) -> dict[str, float]:
+    qualities = {}
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            qualities[media_type.lower()] = q
+    return qualities
+
+
+def negotiate(rendition: Rendition, accept: str | None) -> str:
+    # WebP when the client says it takes it, otherwise the universally
+    # supported format of the rendition
+    fallback = "gif" if rendition.animated else "png"
+    if accept and __accepted(accept).get("image/webp", 0) > 0:
+        return "webp"
+    return fallback
+
+
+def render(source: str, rendition: Rendition, format: str, target: str, max_size: int):
+    parsed = caff.parse_file(source)
+    if rendition.animated:
+        if format == "webp":
+            preview.render_webp(parsed.animations, target, max_size)
+        else:
+            preview.render_gif(parsed.animations, target, max_size)
+    else:
+        preview.render_still(parsed.animations[0], target, max_size, format.upper())
+
+
+class RenditionCache:
+    # Files are named <caff id>-<hash>-<rendition>-<size>.<format>; the in-memory
+    # index keeps them in least recently used order.
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.__entries: OrderedDict[str, int] = OrderedDict()
+        self.__size = 0
+        self.__lock = Lock()
+        self.__inflight: dict[str, Event] = {}
+        self.__loaded = False
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    def __load(self):
+        # Files left by a previous run, oldest access first
+        makedirs(self.root, exist_ok=True)
+        files = []
+        for name in listdir(self.root):
+            if name.endswith(".tmp"):
+                continue
+            st = stat(path.join(self.root, name))
+            files.append((st.st_atime, name, st.st_size))
+        for _, name, size in sorted(files):
+            self.__entries[name] = size
+            self.__size += size
+        self.__loaded = True
+
+    def __lookup(self, name: str) -> bool:
+        with self.__lock:
+            if not self.__loaded:
+                self.__load()
+            if name in self.__entries:
+                self.__entries.move_to_end(name)
+                return True
+            return False
+
+    def get_or_create(self, name: str, create: Callable[[str], None]) -> bytes:
+        # Single flight per file: concurrent misses wait for one render
+        while True:
+            if self.__lookup(name):
+                try:
+                    with open(path.join(self.root, name), "rb") as f:
+                        data = f.read()
+                    self.hits += 1
+                    return data
+                except FileNotFoundError:
+                    self.__forget(name)
+            with self.__lock:
+                event = self.__inflight.get(name)
+                if event is None:
+                    self.__inflight[name] = Event()
+                    break
+            event.wait()
+
+        try:
+            self.misses += 1
+            target = path.join(self.root, name)
+            create(target)
+            with open(target, "rb") as f:
+                data = f.read()
+            with self.__lock:
+                self.__size += len(data) - self.__entries.pop(name, 0)
+                self.__entries[name] = len(data)
+                evict = self.__evict()
+            self.__remove(evict)
+            return data
+        finally:
+            with self.__lock:
+                self.__inflight.pop(name).set()
+
+    def __evict(self) -> list[str]:
+        # The newest entry is never evicted, even if it alone exceeds the limit
+        evict = []
+        while self.__size > self.max_bytes and len(self.__entries) > 1:
+            name, size = self.__entries.popitem(last=False)
+            self.__size -= size
+            self.evicted += 1
+            evict.append(name)
+        return evict
+
+    def __remove(self, names: list[str]):
+        for name in names:
+            try:
+                remove(path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+
+    def __forget(self, name: str):
+        with self.__lock:
+            self.__size -= self.__entries.pop(name, 0)
+
+    def discard(self, caff_id: int) -> list[str]:
+        # Drops every rendition of a CAFF from the index and returns the
+        # paths, so the caller can remove them in the background
+        prefix = str(caff_id) + "-"
+        with self.__lock:
+            if not self.__loaded:
+                self.__load()
+            names = [name for name in self.__entries if name.startswith(prefix)]
+            for name in names:
+                self.__size -= self.__entries.pop(name)
+        return [path.join(self.root, name) for name in names]
+
+
+def file_name(caff_id: int, content_hash: str | None, rendition: Rendition, max_size: int, format: str) -> str:
+    # The id prefix is what discard() matches, the hash keeps a reused id
+    # from being served the renditions of the CAFF that had it before
+    return f"{caff_id}-{content_hash or 'none'}-{rendition.name}-{max_size}.{format}"
+
+
+def etag(caff_id: int, content_hash: str | None, rendition: Rendition, max_size: int, format: str) -> str:
+    return f'"{content_hash or caff_id}-{rendition.name}-{max_size}-{format}"'
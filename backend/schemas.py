@@ -6,7 +6,7 @@ class CiffBase(BaseModel):
     width: int
     height: int
     collection_id: int
-    tags: str
+    tags: list[str]
 
 
 class CiffCreate(CiffBase):
@@ -14,6 +14,14 @@ class CiffCreate(CiffBase):
     caption: str
 
 
+class CiffIngest(BaseModel):
+    width: int
+    height: int
+    duration: int
+    caption: str
+    tags: list[str]
+
+
 class CommentBase(BaseModel):
     text: str
     date: datetime
@@ -38,6 +46,7 @@ class CaffBase(BaseModel):
     creatorlen: int
     creator: str
     rawfile: str
+    content_hash: str | None = None
 
 
 class Caff(CaffBase):
@@ -51,6 +60,33 @@ class Log(BaseModel):
     author_id: str
 
 
+class LogFilter(BaseModel):
+    level: str | None = None
+    author_id: str | None = None
+    since: datetime | None = None
+    until: datetime | None = None
+
+
 class User(BaseModel):
     user_id: str
     username: str
+
+
+class Job(BaseModel):
+    id: str
+    status: str
+    caff_id: int | None = None
+    error: str | None = None
+
+
+class BatchFile(BaseModel):
+    filename: str
+    status: str
+    job_id: str | None = None
+    caff_id: int | None = None
+    error: str | None = None
+
+
+class Batch(BaseModel):
+    id: str
+    files: list[BatchFile]
@@ -0,0 +1,42 @@
+import re
+from collections import Counter
+from math import log
+
+# Tokenizer and scoring for the inverted index in models.SearchTerm. The
+# index is plain rows, so the same queries run on SQLite and MySQL, sync
+# and async.
+
+CREATOR = "creator"
+CAPTION = "caption"
+COMMENT = "comment"
+
+# A creator match ranks above a caption match, comments count the least
+FIELD_WEIGHTS = {CREATOR: 2.0, CAPTION: 1.0, COMMENT: 0.5}
+
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 8
+
+_WORD = re.compile(r"\w+")
+
+
+def tokenize(text: str | None) -> list[str]:
+    if not text:
+        return []
+    return [word[:MAX_TERM_LENGTH] for word in _WORD.findall(text.casefold())]
+
+
+def term_rows(caff_id: int, field: str, source_id: int, text: str | None) -> list[dict]:
+    # The term frequency is damped with 1 + ln(tf), repeating a word
+    # does not buy a top rank
+    return [{"term": term, "field": field, "source_id": source_id, "caff_id": caff_id,
+             "weight": FIELD_WEIGHTS[field] * (1 + log(count))}
+            for term, count in Counter(tokenize(text)).items()]
+
+
+def query_terms(q: str) -> list[str]:
+    return list(dict.fromkeys(tokenize(q)))[:MAX_QUERY_TERMS]
+
+
+def idf(total: int, df: int) -> float:
+    # BM25 idf, positive even for terms that appear in most CAFFs
+    return log(1 + (total - df + 0.5) / (df + 0.5))
@@ -0,0 +1,125 @@
+from hashlib import sha256
+from os import makedirs, path, remove, replace
+from threading import Lock
+from typing import BinaryIO
+from uuid import uuid4
+
+# Uploads are stored under their SHA-256: <root>/<digest>/source.caff.
+# Identical content always lands in the same folder.
+
+SOURCE_FILENAME = "source.caff"
+CHUNK_SIZE = 1024 * 1024
+
+
+class IncomingFile:
+    # A temporary file next to the store, hashed while it is written, so
+    # placing it later is a rename on the same file system
+    def __init__(self, root: str):
+        incoming = path.join(root, ".incoming")
+        makedirs(incoming, exist_ok=True)
+        self.path = path.join(incoming, str(uuid4()))
+        self.size = 0
+        self.__digest = sha256()
+        self.__out = open(self.path, "wb")
+
+    def write(self, chunk: bytes):
+        self.__digest.update(chunk)
+        self.__out.write(chunk)
+        self.size += len(chunk)
+
+    def close(self) -> str:
+        self.__out.close()
+        return self.__digest.hexdigest()
+
+    def discard(self):
+        self.__out.close()
+        discard(self.path)
+
+
+def write_incoming(src: BinaryIO, root: str, validator=None) -> tuple[str, str]:
+    # The validator (caff.StreamValidator) sees every chunk before it is
+    # written and raises to stop the copy
+    incoming = IncomingFile(root)
+    try:
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if validator is not None:
+                validator.feed(chunk)
+            incoming.write(chunk)
+        if validator is not None:
+            validator.finish()
+        return incoming.close(), incoming.path
+    except BaseException:
+        incoming.discard()
+        raise
+
+
+def file_digest(p: str) -> str:
+    digest = sha256()
+    with open(p, "rb") as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return digest.hexdigest()
+            digest.update(chunk)
+
+
+def place(tmp_path: str, root: str, digest: str) -> str:
+    folder = path.join(root, digest)
+    makedirs(folder, exist_ok=True)
+    target = path.join(folder, SOURCE_FILENAME)
+    if path.exists(target):
+        remove(tmp_path)
+    else:
+        replace(tmp_path, target)
+    return folder
+
+
+class Leases:
+    # Folders of the store in use by uploads whose CAFF is not in the
+    # database yet. Identical uploads share a folder, so it is only removed
+    # under its lock, once nothing leases it (see reclaim.FileReclaimer).
+    def __init__(self, root: str, stripes: int = 64):
+        self.root = root
+        self.__real_root = path.realpath(root)
+        self.__stripes = [Lock() for _ in range(stripes)]
+        self.__counts: dict[str, int] = {}
+        self.__lock = Lock()
+
+    def covers(self, p: str) -> bool:
+        return path.dirname(path.realpath(p)) == self.__real_root
+
+    def lock(self, folder: str) -> Lock:
+        return self.__stripes[hash(self.__key(folder)) % len(self.__stripes)]
+
+    def place(self, tmp_path: str, digest: str) -> str:
+        # A removal of the folder cannot come between placing and leasing
+        with self.lock(digest):
+            folder = place(tmp_path, self.root, digest)
+            with self.__lock:
+                self.__counts[digest] = self.__counts.get(digest, 0) + 1
+        return folder
+
+    def release(self, folder: str):
+        key = self.__key(folder)
+        with self.__lock:
+            count = self.__counts.pop(key, 0) - 1
+            if count > 0:
+                self.__counts[key] = count
+
+    def is_leased(self, folder: str) -> bool:
+        with self.__lock:
+            return self.__key(folder) in self.__counts
+
+    @staticmethod
+    def __key(folder: str) -> str:
+        return path.basename(path.normpath(folder))
+
+
+def discard(tmp_path: str):
+    try:
+        remove(tmp_path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,83 @@
+from time import perf_counter
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from metrics import Registry
+
+registry = Registry()
+
+requests_in_flight = registry.gauge(
+    "http_requests_in_flight", "Requests currently being served")
+request_duration = registry.histogram(
+    "http_request_duration_seconds", "Time until the last byte of the response was sent",
+    ("route", "method", "status"))
+request_bytes = registry.counter(
+    "http_request_body_bytes_total", "Request body bytes received", ("route",))
+response_bytes = registry.counter(
+    "http_response_body_bytes_total", "Response body bytes sent", ("route",))
+
+upload_stage_duration = registry.histogram(
+    "caff_upload_stage_duration_seconds", "Time spent in each upload pipeline stage", ("stage",))
+upload_bytes = registry.counter(
+    "caff_upload_bytes_total", "Bytes of CAFF files written to the upload store")
+uploads = registry.counter(
+    "caff_uploads_total", "Uploads by outcome", ("result",))
+
+UNMATCHED = "unmatched"
+
+
+class MetricsMiddleware:
+    # Labels requests with the route template (/api/{caff_id}), never the raw
+    # path, so the number of series stays bounded
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.__routes: dict | None = None
+
+    def __route(self, scope: Scope) -> str:
+        if self.__routes is None:
+            self.__routes = {route.endpoint: route.path
+                             for route in scope["app"].routes if hasattr(route, "endpoint")}
+        endpoint = scope.get("endpoint")
+        if endpoint is not None:
+            return self.__routes.get(endpoint, UNMATCHED)
+        root_path = scope.get("root_path")
+        # Mounted apps (the /preview static files) are labelled by their mount point
+        return root_path or UNMATCHED
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = perf_counter()
+        status = 500
+        received = 0
+        sent = 0
+
+        async def counting_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message: Message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            elif message["type"] == "http.response.zerocopysend":
+                sent += message.get("count") or 0
+            await send(message)
+
+        requests_in_flight.inc()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            requests_in_flight.dec()
+            route = self.__route(scope)
+            request_duration.labels(route, scope["method"], str(status)).observe(perf_counter() - start)
+            if received:
+                request_bytes.labels(route).inc(received)
+            if sent:
+                response_bytes.labels(route).inc(sent)
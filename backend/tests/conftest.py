@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+
+# Settings are read when main is imported. The tests that import the app
+# in-process get a throwaway database and store; Keycloak is never contacted
+# because they replace the session user.
+WORKDIR = tempfile.mkdtemp(prefix="caff-tests-")
+for sub in ("out", "preview"):
+    os.makedirs(os.path.join(WORKDIR, sub))
+os.environ.update({
+    "KEYCLOAK_REALM_URL": "http://127.0.0.1:9/realms/tests",
+    "UI_URL": "http://localhost",
+    "DATABASE_URL": f"sqlite:///{WORKDIR}/tests.db?check_same_thread=false",
+    "DATABASE_ASYNC": "false",
+    "UPLOAD_PATH": os.path.join(WORKDIR, "out") + "/",
+    "PREVIEW_PATH": os.path.join(WORKDIR, "preview") + "/",
+})
@@ -0,0 +1,85 @@
+import json
+import time
+
+import pytest
+import requests
+
+import caffgen
+from load import KeycloakStandIn, free_port, start_app
+
+# The same requests against the app on the blocking engine and on the async
+# engine (sqlite+aiosqlite) must give the same responses.
+
+
+@pytest.fixture(scope="module")
+def keycloak():
+    server = KeycloakStandIn()
+    yield server
+    server.stop()
+
+
+def run_app(workdir: str, keycloak: KeycloakStandIn, database_async: bool):
+    port = free_port()
+    process = start_app(str(workdir), keycloak.realm_url, port,
+                        {"DATABASE_ASYNC": str(database_async).lower(), "UPLOAD_WORKERS": "1"})
+    return process, f"http://127.0.0.1:{port}"
+
+
+def scenario(base: str, workdir: str, keycloak: KeycloakStandIn) -> list:
+    user = {"Authorization": "Bearer " + keycloak.token("u1", "User One")}
+    admin = {"Authorization": "Bearer " + keycloak.token("a1", "Admin", admin=True)}
+    results = []
+
+    def record(response: requests.Response):
+        # rawfile paths differ only by the workdir of the run
+        body = json.loads(response.text.replace(workdir, "<workdir>"))
+        results.append((response.request.method, response.request.path_url, response.status_code, body))
+        return body
+
+    # Uploaded one at a time, so ids are assigned in the same order
+    caff_ids = []
+    for seed, creator in enumerate(["Alice Sunset", "Bob River", "Carol Sunset"]):
+        data, _ = caffgen.caff(frames=2, width=8, height=6, seed=seed, creator=creator)
+        job_id = requests.post(base + "/upload_file", files={"file": (f"{seed}.caff", data)},
+                               headers=user).json()["job_id"]
+        for _ in range(200):
+            job = requests.get(base + "/jobs/" + job_id, headers=user).json()
+            if job["status"] in ("done", "failed"):
+                break
+            time.sleep(0.05)
+        assert job["status"] == "done"
+        caff_ids.append(job["caff_id"])
+
+    first, second, third = caff_ids
+    tag = caffgen.caff(seed=0)[1][0]
+    # author_id is replaced by the session user, the frontend sends 0
+    comment = record(requests.post(f"{base}/api/{first}/comments", headers=user,
+                                   json={"text": "Lovely waterfall", "date": "2020-01-01T10:00:00", "author_id": 0}))
+    other = record(requests.post(f"{base}/api/{second}/comments", headers=admin,
+                                 json={"text": "Nice river", "date": "2020-01-02T10:00:00", "author_id": 0}))
+    record(requests.put(f"{base}/api/{first}/comments/{comment['id']}", headers=admin, json={"text": "Lovely lake"}))
+    for url in ["/api", f"/api?tag={tag}", "/api?limit=2", "/api/", "/api/?limit=1", f"/api/{first}",
+                "/api/search?q=sunset", "/api/search?q=lake", "/api/search?q=alice%20river&match=any",
+                "/api/users/me"]:
+        record(requests.get(base + url, headers=user))
+    record(requests.delete(f"{base}/api/{second}/comments/{other['id']}", headers=admin))
+    requests.delete(f"{base}/api/{third}", headers=admin).raise_for_status()
+    for url in ["/api/", f"/api/{second}", f"/api/{third}", "/api/search?q=sunset"]:
+        record(requests.get(base + url, headers=user))
+    return results
+
+
+def test_async_engine_matches_blocking_engine(tmp_path, keycloak):
+    results = {}
+    for database_async in (False, True):
+        workdir = tmp_path / ("async" if database_async else "sync")
+        workdir.mkdir()
+        process, base = run_app(workdir, keycloak, database_async)
+        try:
+            results[database_async] = scenario(base, str(workdir), keycloak)
+        finally:
+            process.terminate()
+            process.wait(30)
+    for blocking, awaited in zip(results[False], results[True]):
+        assert blocking == awaited
+    assert len(results[False]) == len(results[True])
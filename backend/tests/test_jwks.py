@@ -0,0 +1,109 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import rsa
+from jose import jwk
+
+from jwks import JWKS
+
+
+class KeyServer:
+    # Stands in for the realm's certs endpoint. Keys can be rotated and every
+    # response delayed, to have a fetch in flight while tokens arrive.
+    def __init__(self):
+        self.keys = {}
+        self.delay = 0.0
+        self.fetches = 0
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.fetches += 1
+                time.sleep(server.delay)
+                body = json.dumps({"keys": list(server.keys.values())}).encode()
+                self.send_response(200 if self.path.endswith("/certs") else 404)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/realms/tests/protocol/openid-connect/certs"
+
+    def add_key(self, kid: str):
+        public, _ = rsa.newkeys(1024)
+        key = jwk.construct(public.save_pkcs1().decode(), "RS256").to_dict()
+        key.update(kid=kid, use="sig", alg="RS256")
+        self.keys[kid] = key
+
+    def stop(self):
+        self.server.shutdown()
+
+
+@pytest.fixture
+def key_server():
+    server = KeyServer()
+    server.add_key("k1")
+    yield server
+    server.stop()
+
+
+def test_token_during_startup_fetch_waits_for_it(key_server):
+    key_server.delay = 0.3
+
+    async def run():
+        keys = JWKS(key_server.url, min_refetch_interval=10)
+        keys.start()
+        await asyncio.sleep(0.05)
+        try:
+            return await keys.get_key("k1")
+        finally:
+            await keys.stop()
+
+    assert asyncio.run(run()) is not None
+    assert key_server.fetches == 1
+
+
+def test_rotated_key_during_refresh_is_found(key_server):
+    async def run():
+        keys = JWKS(key_server.url, min_refetch_interval=10)
+        await keys.refresh()
+        key_server.add_key("k2")
+        key_server.delay = 0.3
+        # A periodic refresh is running when the first token of the new key arrives
+        refresh = asyncio.ensure_future(keys.refresh())
+        await asyncio.sleep(0.05)
+        key = await keys.get_key("k2")
+        await refresh
+        return key
+
+    assert asyncio.run(run()) is not None
+    assert key_server.fetches == 2
+
+
+def test_unknown_kid_refetches_once_per_interval(key_server):
+    async def run():
+        keys = JWKS(key_server.url, min_refetch_interval=10)
+        await keys.refresh()
+        return [await keys.get_key("forged") for _ in range(5)]
+
+    assert asyncio.run(run()) == [None] * 5
+    assert key_server.fetches == 1
+
+
+def test_failed_fetch_is_retried_after_the_interval(key_server):
+    async def run():
+        keys = JWKS(key_server.url.replace("/certs", "/missing"), min_refetch_interval=0)
+        assert await keys.get_key("k1") is None
+        keys.jwks_url = key_server.url
+        return await keys.get_key("k1")
+
+    assert asyncio.run(run()) is not None
@@ -0,0 +1,76 @@
+from datetime import date
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import main
+import models
+from auth import Role, User
+
+
+def seed(db, caffs: int):
+    # Every CAFF gets comments from several authors, one of them unknown
+    db.add_all([models.User(user_id=f"u{i}", username=f"User {i}") for i in range(4)])
+    for i in range(caffs):
+        caff = models.Caff(year=2020, month=1, day=1, hour=0, minute=0, creatorLen=7, creator="Creator",
+                           rawfile=f"{i}/source.caff", content_hash=f"{i:064x}")
+        db.add(caff)
+        db.flush()
+        db.add_all([models.Comment(text=f"Comment {j}", author_id=f"u{j}", date=date(2020, 1, 1),
+                                   collection_id=caff.id) for j in range(5)])
+    db.commit()
+
+
+@pytest.fixture(params=[2, 12])
+def client(request):
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    models.Base.metadata.create_all(engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = Session()
+    seed(db, request.param)
+    db.close()
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    def get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    main.app.dependency_overrides[main.get_db] = get_db
+    main.app.dependency_overrides[main.get_session_user] = lambda: User(id="u0", name="User 0", role=Role.USER)
+    try:
+        yield TestClient(main.app), statements
+    finally:
+        main.app.dependency_overrides.clear()
+        engine.dispose()
+
+
+def count_queries(client, statements, url: str):
+    # Cached responses would hide the queries
+    main.response_cache.bump("caffs", "comments", *(main.caff_tag(i) for i in range(1, 20)))
+    statements.clear()
+    response = client.get(url)
+    assert response.status_code == 200
+    return len(statements), response.json()
+
+
+def test_caffs_with_comments_page_is_two_queries(client):
+    client, statements = client
+    count, body = count_queries(client, statements, "/api/")
+    assert count == 2
+    assert all(len(caff["comments"]) == 5 for caff in body["items"])
+
+
+def test_caff_with_comments_and_authors_is_three_queries(client):
+    client, statements = client
+    count, body = count_queries(client, statements, "/api/1")
+    assert count == 3
+    assert [comment["username"] for comment in body["comments"]] == \
+        ["User 0", "User 1", "User 2", "User 3", "Anonymus"]
@@ -0,0 +1,43 @@
+import os
+
+import store
+from reclaim import FileReclaimer
+
+
+def place(leases: store.Leases, digest: str) -> str:
+    tmp_path = os.path.join(leases.root, "upload.tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(b"CAFF")
+    return leases.place(tmp_path, digest)
+
+
+def reclaim(reclaimer: FileReclaimer, *paths: str):
+    reclaimer.submit(*paths)
+    reclaimer.stop()
+
+
+def test_store_folder_is_kept_while_an_upload_leases_it(tmp_path):
+    # A delete queued the folder, then an identical upload was placed in it
+    leases = store.Leases(str(tmp_path))
+    folder = place(leases, "ab" * 32)
+    reclaimer = FileReclaimer([str(tmp_path)], leases, lambda folder: False)
+    reclaim(reclaimer, folder)
+    assert os.path.exists(os.path.join(folder, store.SOURCE_FILENAME))
+
+    leases.release(folder)
+    reclaim(reclaimer, folder)
+    assert not os.path.exists(folder)
+
+
+def test_store_folder_is_kept_while_a_caff_references_it(tmp_path):
+    leases = store.Leases(str(tmp_path))
+    folder = place(leases, "cd" * 32)
+    leases.release(folder)
+    referenced = {folder}
+    reclaimer = FileReclaimer([str(tmp_path)], leases, lambda folder: folder in referenced)
+    reclaim(reclaimer, folder)
+    assert os.path.exists(folder)
+
+    referenced.clear()
+    reclaim(reclaimer, folder)
+    assert not os.path.exists(folder)
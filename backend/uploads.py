@@ -0,0 +1,266 @@
+import tarfile
+import zipfile
+from functools import partial
+from typing import BinaryIO, Callable, NamedTuple
+
+import multipart
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import parse_options_header
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+
+import store
+from caff import CaffParseError, CaffTooLargeError
+
+# Reads a multipart/form-data upload straight off the request stream. FastAPI's
+# UploadFile spools the whole body before the endpoint runs; here every part
+# chunk goes through the CAFF validator first, and only accepted bytes are
+# written to the store.
+
+PART_BEGIN = "part_begin"
+PART_DATA = "part_data"
+PART_END = "part_end"
+HEADER_FIELD = "header_field"
+HEADER_VALUE = "header_value"
+HEADER_END = "header_end"
+HEADERS_FINISHED = "headers_finished"
+
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz")
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str, reason: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        # caff_uploads_total label
+        self.reason = reason
+
+
+class ReceivedFile(NamedTuple):
+    filename: str
+    digest: str
+    tmp_path: str
+    size: int
+
+
+class RejectedFile(NamedTuple):
+    filename: str
+    error: UploadRejected
+
+
+class SizeLimit:
+    # Validator for parts that are not CAFFs themselves, e.g. archives
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.received = 0
+
+    def feed(self, chunk: bytes):
+        self.received += len(chunk)
+        if self.received > self.max_bytes:
+            raise CaffTooLargeError("Upload is larger than the size limit!")
+
+    def finish(self):
+        pass
+
+
+class Validators:
+    # Feeds every chunk to each validator in turn
+    def __init__(self, *validators):
+        self.validators = validators
+
+    def feed(self, chunk: bytes):
+        for validator in self.validators:
+            validator.feed(chunk)
+
+    def finish(self):
+        for validator in self.validators:
+            validator.finish()
+
+
+def is_archive(filename: str) -> bool:
+    return filename.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def rejection(e: Exception) -> UploadRejected:
+    if isinstance(e, CaffTooLargeError):
+        return UploadRejected(413, str(e), "too_large")
+    return UploadRejected(400, str(e), "invalid")
+
+
+def __collector(events: list, kind: str):
+    def collect(data: bytes = b"", start: int = 0, end: int = 0):
+        events.append((kind, data[start:end]))
+    return collect
+
+
+async def receive_file(request: Request, field: str, root: str,
+                       accept: Callable[[str], bool], new_validator: Callable[[str], object]) -> ReceivedFile | None:
+    # The first file in `field`, or None when the form has none. Stops
+    # reading the request at the first bad chunk.
+    received = await receive_files(request, field, root, accept, new_validator, max_files=1, stop_on_error=True)
+    return received[0] if received else None
+
+
+async def receive_files(request: Request, field: str, root: str, accept: Callable[[str], bool],
+                        new_validator: Callable[[str], object], max_files: int,
+                        stop_on_error: bool = False) -> list[ReceivedFile | RejectedFile]:
+    # Every file in `field`, each checked by its own validator. A rejected
+    # file does not stop the others unless stop_on_error is set.
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise UploadRejected(400, "Expected a multipart/form-data upload", "invalid")
+    events: list[tuple[str, bytes]] = []
+    parser = multipart.MultipartParser(params[b"boundary"], {
+        "on_" + kind: __collector(events, kind)
+        for kind in (PART_BEGIN, PART_DATA, PART_END, HEADER_FIELD, HEADER_VALUE, HEADER_END, HEADERS_FINISHED)})
+
+    files: list[ReceivedFile | RejectedFile] = []
+    incoming: store.IncomingFile | None = None
+    validator = None
+    pending = bytearray()
+    header_field = header_value = disposition = b""
+    filename = None
+
+    def reject(error: UploadRejected):
+        nonlocal validator
+        if stop_on_error:
+            raise error
+        files.append(RejectedFile(filename, error))
+        # The rest of the part is read and dropped
+        validator = None
+        pending.clear()
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            for kind, data in events:
+                if kind == PART_BEGIN:
+                    disposition = b""
+                elif kind == HEADER_FIELD:
+                    header_field += data
+                elif kind == HEADER_VALUE:
+                    header_value += data
+                elif kind == HEADER_END:
+                    if header_field.lower() == b"content-disposition":
+                        disposition = header_value
+                    header_field = header_value = b""
+                elif kind == HEADERS_FINISHED:
+                    options = parse_options_header(disposition)[1]
+                    if options.get(b"name") != field.encode() or b"filename" not in options:
+                        continue
+                    filename = options[b"filename"].decode("utf-8", errors="replace")
+                    if len(files) >= max_files:
+                        if stop_on_error:
+                            continue
+                        reject(UploadRejected(413, "Too many files in one request", "too_large"))
+                    elif not accept(filename):
+                        reject(UploadRejected(415, "Illegal file extension", "extension"))
+                    else:
+                        validator = new_validator(filename)
+                elif kind == PART_DATA and validator is not None:
+                    try:
+                        validator.feed(data)
+                    except CaffParseError as e:
+                        incoming = await __discard(incoming)
+                        reject(rejection(e))
+                        continue
+                    pending += data
+                elif kind == PART_END and validator is not None:
+                    try:
+                        validator.finish()
+                    except CaffParseError as e:
+                        incoming = await __discard(incoming)
+                        reject(rejection(e))
+                        continue
+                    incoming = await __flush(incoming, root, pending)
+                    digest = await run_in_threadpool(incoming.close)
+                    files.append(ReceivedFile(filename, digest, incoming.path, incoming.size))
+                    incoming = validator = None
+            events.clear()
+            if len(pending) >= store.CHUNK_SIZE:
+                incoming = await __flush(incoming, root, pending)
+        parser.finalize()
+        if validator is not None:
+            raise UploadRejected(400, "Truncated multipart body", "invalid")
+        return files
+    except BaseException as e:
+        await __discard(incoming)
+        for file in files:
+            if isinstance(file, ReceivedFile):
+                store.discard(file.tmp_path)
+        if isinstance(e, MultipartParseError):
+            raise UploadRejected(400, "Malformed multipart body: " + str(e), "invalid")
+        raise
+
+
+async def __flush(incoming: store.IncomingFile | None, root: str, pending: bytearray) -> store.IncomingFile:
+    # The temporary file is only created once the first chunk passed the validator
+    if incoming is None:
+        incoming = await run_in_threadpool(store.IncomingFile, root)
+    if pending:
+        await run_in_threadpool(incoming.write, bytes(pending))
+        pending.clear()
+    return incoming
+
+
+async def __discard(incoming: store.IncomingFile | None) -> None:
+    if incoming is not None:
+        await run_in_threadpool(incoming.discard)
+    return None
+
+
+def extract_archive(archive_path: str, root: str, new_validator: Callable[[str], object],
+                    max_files: int, max_bytes: int) -> list[ReceivedFile | RejectedFile]:
+    # Copies the .caff members of a zip or tar into the store, each through
+    # its own validator. Member names are only reported back, never used as
+    # paths. The whole archive is rejected once its members unpack to more
+    # than max_bytes, so a small archive cannot fill the disk. Blocking, run
+    # it in a thread.
+    files = []
+    unpacked = 0
+
+    def too_large() -> UploadRejected:
+        return UploadRejected(413, "Archive unpacks to more than the size limit", "too_large")
+
+    def add(name: str, size: int, open_member: Callable[[], BinaryIO]):
+        nonlocal unpacked
+        if len(files) >= max_files:
+            files.append(RejectedFile(name, UploadRejected(413, "Too many files in one request", "too_large")))
+            return
+        # The declared size is checked before the member is opened, the limit
+        # below catches members that unpack to more than they declare
+        if unpacked + size > max_bytes:
+            raise too_large()
+        limit = SizeLimit(max_bytes - unpacked)
+        try:
+            with open_member() as src:
+                digest, tmp_path = store.write_incoming(src, root, Validators(limit, new_validator(name)))
+        except CaffParseError as e:
+            if limit.received > limit.max_bytes:
+                raise too_large()
+            files.append(RejectedFile(name, rejection(e)))
+            return
+        unpacked += limit.received
+        files.append(ReceivedFile(name, digest, tmp_path, limit.received))
+
+    try:
+        if zipfile.is_zipfile(archive_path):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir() and info.filename.lower().endswith(".caff"):
+                        add(info.filename, info.file_size, partial(archive.open, info))
+        else:
+            # Members are read in order, the archive is never seeked backwards
+            with tarfile.open(archive_path, "r|*") as archive:
+                for member in archive:
+                    if member.isfile() and member.name.lower().endswith(".caff"):
+                        add(member.name, member.size, partial(archive.extractfile, member))
+    except (zipfile.BadZipFile, tarfile.TarError, EOFError, UploadRejected) as e:
+        for file in files:
+            if isinstance(file, ReceivedFile):
+                store.discard(file.tmp_path)
+        if isinstance(e, UploadRejected):
+            raise
+        raise UploadRejected(400, "Unreadable archive: " + str(e), "invalid")
+    return files
@@ -7,6 +7,7 @@ export default interface CaffDto {
     year: number,
     hour: number,
     rawfile: string,
+    content_hash: string | null,
     creator: string,
     comments: CommentDto[]
 }
\ No newline at end of file
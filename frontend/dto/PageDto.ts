@@ -0,0 +1,4 @@
+export default interface PageDto<T> {
+    items: T[],
+    next_cursor: string | null
+}
\ No newline at end of file
@@ -66,7 +66,7 @@ const Details: NextPage = () => {
         {!isLoading && isError && <div className="text-xl mt-32">Hiba történt :,(</div>}
         {!isLoading && !isError && caffId !== undefined && data &&
           <>
-            <Image className="rounded w-auto h-auto max-w-3xl max-h-max" priority src={`http://localhost:8000/preview/${caffId}.gif`} alt="Caff preview gif" width={0} height={0}></Image>
+            <Image className="rounded w-auto h-auto max-w-3xl max-h-max" priority src={data.content_hash ? `http://localhost:8000/previews/${caffId}/${data.content_hash}/animated` : `http://localhost:8000/previews/${caffId}/animated`} alt="Caff preview" width={0} height={0}></Image>
             <section className="flex flex-row m-2 items-center">
               <h2 className="text-lg m-1 pr-2 border-r-2 border-violet-500"><span className="font-bold mr-1">Keszítő:</span> {data && data.creator}</h2>
               <h2 className="text-lg m-1 pr-2 border-r-2 border-violet-500"><span className="font-bold  mr-1">Készítés időpontja:</span>{data && data.year}.{data.month < 10 ? "0" : ""}{data?.month}.{data.day < 10 ? "0" : ""}{data?.day} {data?.hour}:00</h2>
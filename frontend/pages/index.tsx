@@ -3,6 +3,7 @@ import Image from "next/image";
 import Link from "next/link";
 import Header from "../components/Header";
 import CaffDto from "../dto/CaffDto";
+import PageDto from "../dto/PageDto";
 import useApi from "../hooks/useApi";
 import { useState } from "react";
 import LoadingSpinner from "../components/LoadingSpinner";
@@ -17,7 +18,7 @@ const Home: NextPage = () => {
     sanitizedQuery = params.toString();
   }
   const url = sanitizedQuery ? `/api?${sanitizedQuery}` : "/api";
-  const { data, isLoading, isError, } = useApi<CaffDto[]>(url);
+  const { data, isLoading, isError, } = useApi<PageDto<CaffDto>>(url);
 
   return (
     <>
@@ -42,10 +43,10 @@ const Home: NextPage = () => {
             </div>
           }
           {isError && <div className="text-xl mt-32">Hiba történt :,(</div>}
-          {!isLoading && !isError && data && data.map((caff) => (
+          {!isLoading && !isError && data && data.items.map((caff) => (
             <div key={caff.id} className="border border-solid border-gray-400 bg-gray-50 p-4 m-2 rounded">
               <Link href={`/details/${caff.id}`}>
-                <Image className="rounded w-auto h-auto max-w-xs" priority src={`http://localhost:8000/preview/${caff.id}.gif`} alt="Caff preview gif" width={256} height={256}></Image>
+                <Image className="rounded w-auto h-auto max-w-xs" priority src={caff.content_hash ? `http://localhost:8000/previews/${caff.id}/${caff.content_hash}/thumb` : `http://localhost:8000/previews/${caff.id}/thumb`} alt="Caff preview" width={256} height={256}></Image>
               </Link>
               <div className="flex flex-row justify-between mt-1">
                 <span className="font-semibold text-lg">{caff.creator}</span>
@@ -53,7 +54,7 @@ const Home: NextPage = () => {
               </div>
             </div>
           ))}
-          {!isLoading && !isError && data && data.length === 0 &&
+          {!isLoading && !isError && data && data.items.length === 0 &&
             <p className="text-xl">Nincs találat</p>}
         </section>
       </main>
@@ -2,10 +2,11 @@ import { NextPage } from "next";
 import Header from "../components/Header";
 import LoadingSpinner from "../components/LoadingSpinner";
 import LogDto from "../dto/LogDto";
+import PageDto from "../dto/PageDto";
 import useApi from "../hooks/useApi";
 
 const Logs: NextPage = () => {
-  const { data, isLoading, isError, } = useApi<LogDto[]>("/api/logs");
+  const { data, isLoading, isError, } = useApi<PageDto<LogDto>>("/api/logs");
 
   return (
     <>
@@ -18,7 +19,7 @@ const Logs: NextPage = () => {
             </div>
           }
           {isError && <div className="text-xl mt-32">Hiba történt :,(</div>}
-          {!isLoading && !isError && data && data.map((log) => {
+          {!isLoading && !isError && data && data.items.map((log) => {
             const id = (new Date()).getTime() * Math.random();
             return (
               <div key={id} className="m-2 flex flex-row items-center">
@@ -30,7 +31,7 @@ const Logs: NextPage = () => {
             );
           }
           )}
-          {!isLoading && !isError && data && data.length === 0 &&
+          {!isLoading && !isError && data && data.items.length === 0 &&
             <p className="text-xl">Nincs találat</p>}
         </section>
       </main>